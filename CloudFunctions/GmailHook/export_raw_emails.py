@@ -0,0 +1,71 @@
+"""
+Stream a user's raw emails out as JSON lines.
+
+Header records are paged from Firestore in timestamp order and the full
+messages are read from the blob store a few at a time, so memory stays flat
+however large the mailbox is. Records saved before the blob store existed
+still carry the message inline in raw_data and are exported as they are.
+
+    python export_raw_emails.py student@example.com > mail.jsonl
+    RAW_EMAIL_STORE=file:///tmp/raw-emails python export_raw_emails.py student@example.com
+"""
+import sys
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import firestore
+
+from blob_store import open_blob_store, get_json
+
+PAGE_SIZE = 200
+READ_WORKERS = 8
+
+
+def iter_headers(db, user_email, page_size = PAGE_SIZE):
+    """
+    Yield the user's raw_emails header records, oldest first.
+
+    Needs a composite index on (user_email, timestamp).
+    """
+    query = (db.collection('raw_emails')
+             .where('user_email', '==', user_email)
+             .order_by('timestamp')
+             .limit(page_size))
+    last = None
+    while True:
+        page = list((query.start_after(last) if last else query).stream())
+        for snapshot in page:
+            yield snapshot.to_dict()
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+def iter_raw_emails(db, store, user_email, workers = READ_WORKERS):
+    """
+    Yield (header, message) pairs, reading blobs concurrently but in order.
+    """
+    def load(header):
+        if 'blob_key' in header:
+            return header, get_json(store, header['blob_key'])
+        return header, header.pop('raw_data', None)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for header in iter_headers(db, user_email):
+            pending.append(pool.submit(load, header))
+            # Bounded read-ahead keeps at most 2 * workers messages in memory
+            if len(pending) >= 2 * workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a user's raw emails as JSON lines.")
+    parser.add_argument("user_email")
+    args = parser.parse_args()
+
+    store = open_blob_store()
+    for header, message in iter_raw_emails(firestore.Client(), store, args.user_email):
+        sys.stdout.write(json.dumps({'header': header, 'message': message}, default=str) + '\n')
@@ -0,0 +1,148 @@
+"""
+Per-user lease on the Gmail history cursor.
+
+Gmail can notify about the same mailbox several times in quick succession,
+and each notification starts a gmail_webhook run. Only the run holding the
+user's lease reads history and moves the `last_history_id` cursor; a
+notification that arrives meanwhile just flags the user as having pending
+changes and returns. The lease holder then makes one more catch-up pass before letting
+go, so any number of overlapping notifications cost at most one extra pass.
+
+Lease state lives on the users/{email} document and is only changed in
+Firestore transactions. The cursor is compare-and-set: it is written only
+by the current lease holder and never moves backwards. A lease that is not
+renewed within SYNC_LEASE_S (e.g. the holder crashed) can be taken over.
+
+Every service that reads history gets the same notifications and must see
+every email, so each keeps its own lease and cursor, under a field prefix
+(`archive_last_history_id`, `publish_sync_pending`, ...). A service whose
+prefixed cursor is not set yet starts from the unprefixed `last_history_id`
+the services used to share.
+
+The same module is copied into every service that reads mailbox history
+(GmailHook, fetch-latest-emails-pubsub); keep the copies identical.
+"""
+import os
+import time
+import uuid
+from google.cloud import firestore
+
+SYNC_LEASE_S = float(os.getenv("SYNC_LEASE_S", 120))
+# Cursor all services shared before each had its own; read until a service writes its prefixed one
+LEGACY_HISTORY_FIELD = 'last_history_id'
+
+
+class LeaseLost(Exception):
+    """
+    The lease expired and another run took it over.
+    """
+
+
+class HistoryLease:
+    def __init__(self, db, user_ref, prefix, lease_s = SYNC_LEASE_S):
+        """
+        Args:
+            db: Firestore client.
+            user_ref: Reference to the users/{email} document.
+            prefix (str): Field prefix of this service's lease and cursor, e.g. 'publish_'.
+            lease_s (float): Lease duration, renewed at every checkpoint.
+        """
+        self.db = db
+        self.user_ref = user_ref
+        self.owner_field = f'{prefix}sync_lease_owner'
+        self.until_field = f'{prefix}sync_lease_until'
+        self.pending_field = f'{prefix}sync_pending'
+        self.history_field = f'{prefix}last_history_id'
+        self.lease_s = lease_s
+        self.owner = uuid.uuid4().hex
+        self.last_history_id = None
+
+    def _run(self, fn):
+        return firestore.transactional(fn)(self.db.transaction())
+
+    def _cursor(self, user_data):
+        return user_data.get(self.history_field, user_data.get(LEGACY_HISTORY_FIELD))
+
+    def acquire(self):
+        """
+        Take the lease, or record a pending notification for the current holder.
+
+        Returns:
+            bool: True if this run holds the lease and should sync the mailbox.
+        """
+        def acquire_in(transaction):
+            user_data = self.user_ref.get(transaction=transaction).to_dict() or {}
+            now = time.time()
+            if user_data.get(self.owner_field) and user_data.get(self.until_field, 0) > now:
+                transaction.update(self.user_ref, {self.pending_field: True})
+                return False
+            transaction.update(self.user_ref, {
+                self.owner_field: self.owner,
+                self.until_field: now + self.lease_s,
+                self.pending_field: False
+            })
+            self.last_history_id = self._cursor(user_data)
+            return True
+
+        return self._run(acquire_in)
+
+    def advance(self, history_id):
+        """
+        Move last_history_id forward to history_id and renew the lease.
+
+        Raises:
+            LeaseLost: If another run now holds the lease.
+        """
+        def advance_in(transaction):
+            user_data = self.user_ref.get(transaction=transaction).to_dict() or {}
+            if user_data.get(self.owner_field) != self.owner:
+                raise LeaseLost(f"Sync lease for {self.user_ref.id} was taken over")
+            fields = {self.until_field: time.time() + self.lease_s}
+            current = self._cursor(user_data)
+            if current is None or int(history_id) > int(current):
+                fields[self.history_field] = history_id
+            transaction.update(self.user_ref, fields)
+            return fields.get(self.history_field, current)
+
+        self.last_history_id = self._run(advance_in)
+
+    def finish(self):
+        """
+        Release the lease, unless notifications arrived while it was held.
+
+        Returns:
+            bool: True if the caller keeps the lease and should run another
+            pass from last_history_id.
+        """
+        def finish_in(transaction):
+            user_data = self.user_ref.get(transaction=transaction).to_dict() or {}
+            if user_data.get(self.owner_field) != self.owner:
+                return False
+            self.last_history_id = self._cursor(user_data)
+            if user_data.get(self.pending_field):
+                transaction.update(self.user_ref, {
+                    self.pending_field: False,
+                    self.until_field: time.time() + self.lease_s
+                })
+                return True
+            transaction.update(self.user_ref, {
+                self.owner_field: firestore.DELETE_FIELD,
+                self.until_field: firestore.DELETE_FIELD
+            })
+            return False
+
+        return self._run(finish_in)
+
+    def release(self):
+        """
+        Give the lease up after a failure, leaving any pending flag for the next run.
+        """
+        def release_in(transaction):
+            user_data = self.user_ref.get(transaction=transaction).to_dict() or {}
+            if user_data.get(self.owner_field) == self.owner:
+                transaction.update(self.user_ref, {
+                    self.owner_field: firestore.DELETE_FIELD,
+                    self.until_field: firestore.DELETE_FIELD
+                })
+
+        self._run(release_in)
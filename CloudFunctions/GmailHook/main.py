@@ -1,13 +1,22 @@
 import base64
 import functions_framework
 import json
-from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from google.cloud import firestore
+from oauth_credentials import CredentialStore
+from gmail_sync import fetch_messages, iter_history_pages
+from history_lease import HistoryLease
+from blob_store import open_blob_store, put_json
 
 # Initialize Firestore client
 db = firestore.Client()
 
+# Compressed raw messages; Firestore keeps only a small header record per email
+raw_email_store = open_blob_store()
+
+# Live access tokens shared by invocations on this instance, refreshed once per user
+credential_store = CredentialStore(db, flush_interval_s=60)
+
 @functions_framework.cloud_event
 def gmail_webhook(cloud_event):
     """
@@ -27,6 +36,9 @@ def gmail_webhook(cloud_event):
     4. Saves raw email data to the 'raw_emails' collection in Firestore.
     5. Updates the user's last processed history ID in Firestore.
 
+    One run per user holds a lease on the history cursor; a notification
+    arriving during that run is coalesced into one more pass of it.
+
     Errors are logged for missing user data, API request failures, and message processing issues.
     """
     pubsub_message = base64.b64decode(cloud_event.data['message']['data'])
@@ -41,43 +53,65 @@ def gmail_webhook(cloud_event):
         print(f"User {user_email} not found in Firestore")
         return
 
-    user_data = user_doc.to_dict()
-    credentials = Credentials(
-        token=user_data['token'],
-        refresh_token=user_data['refresh_token'],
-        token_uri=user_data['token_uri'],
-        client_id=user_data['client_id'],
-        client_secret=user_data['client_secret'],
-        scopes=user_data['scopes']
-    )
-
-    # Get the last processed history_id or use a default value
-    last_history_id = user_data.get('last_history_id', '1')
-
-    # Fetch new emails
-    gmail_service = build('gmail', 'v1', credentials=credentials)
+    # Only one run per user reads history; notifications that arrive while it
+    # runs are folded into a single catch-up pass of that run. The lease and
+    # cursor are this function's own: fetch-latest-emails-pubsub publishes the same emails
+    lease = HistoryLease(db, user_ref, 'archive_')
+    if not lease.acquire():
+        print(f"Sync already running for {user_email}, coalesced into it")
+        return
 
     try:
-        history = gmail_service.users().history().list(userId=user_email, startHistoryId=last_history_id).execute()
-        for event in history.get('history', []):
-            for added_message in event.get('messagesAdded', []):
-                try:
-                    msg = gmail_service.users().messages().get(userId=user_email,
-                                                               id=added_message['message']['id']).execute()
-                    # Save raw email to Firestore
-                    save_raw_email(msg, user_email)
-                except Exception as e:
-                    print(f"Error processing message: {e}")
-
-        # Update the last processed history_id
-        user_ref.update({'last_history_id': new_history_id})
-        print(f"Successfully processed new emails for {user_email}")
-    except Exception as e:
-        print(f"Error fetching history: {e}")
-        # If this is the first time and there's no history, set the initial history_id
-        if 'last_history_id' not in user_data:
-            user_ref.update({'last_history_id': new_history_id})
-            print(f"Initialized last_history_id")
+        user_data = user_doc.to_dict()
+        credentials = credential_store.get(user_email, user_data)
+
+        # Fetch new emails
+        gmail_service = build('gmail', 'v1', credentials=credentials)
+
+        while True:
+            try:
+                sync_history(gmail_service, user_email, lease)
+                print(f"Successfully processed new emails for {user_email}")
+            except Exception as e:
+                print(f"Error fetching history: {e}")
+                # If this is the first time and there's no history, set the initial history_id
+                if lease.last_history_id is None:
+                    lease.advance(new_history_id)
+                    print(f"Initialized last_history_id")
+
+            if not lease.finish():
+                break
+    except Exception:
+        lease.release()
+        raise
+    finally:
+        # Write back any token refreshed during this invocation
+        credential_store.flush()
+
+
+def sync_history(gmail_service, user_email, lease):
+    """
+    Save every email added since the lease's last_history_id, checkpointing per history page.
+    """
+    # Get the last processed history_id or use a default value
+    last_history_id = lease.last_history_id or '1'
+
+    # Pages of history are processed and checkpointed one at a time, so a
+    # crash only replays the page that was in flight
+    for message_ids, checkpoint_history_id in iter_history_pages(gmail_service, user_email, last_history_id):
+        # Up to 100 messages per round trip instead of one request each
+        for message_id, msg, error in fetch_messages(gmail_service, user_email, message_ids):
+            if error:
+                print(f"Error fetching message {message_id}: {error}")
+                continue
+            try:
+                # Save raw email to Firestore
+                save_raw_email(msg, user_email)
+            except Exception as e:
+                print(f"Error processing message: {e}")
+
+        # Update the last processed history_id; never moves it backwards
+        lease.advance(checkpoint_history_id)
 
 
 def save_raw_email(msg, user_email):
@@ -87,16 +121,27 @@ def save_raw_email(msg, user_email):
     sender = next((header['value'] for header in msg['payload']['headers'] if header['name'].lower() == 'from'),
                   'Unknown Sender')
 
-    # Save to 'raw_emails' collection
-    db.collection('raw_emails').add({
+    # The full message goes to the blob store, keyed by message ID, so the
+    # Firestore record stays small whatever the email's size
+    blob_key = raw_email_key(user_email, msg['id'])
+    put_json(raw_email_store, blob_key, msg)
+
+    # Save the header record to the 'raw_emails' collection; the document ID
+    # makes a re-delivered email overwrite its record instead of adding one
+    db.collection('raw_emails').document(f"{user_email}:{msg['id']}").set({
         'user_email': user_email,
         'message_id': msg['id'],
         'thread_id': msg['threadId'],
         'subject': subject,
         'sender': sender,
         'snippet': msg['snippet'],
-        'timestamp': msg['internalDate'],
-        'raw_data': msg  # This saves the entire raw message data
+        'timestamp': int(msg['internalDate']),
+        'size_estimate': msg.get('sizeEstimate'),
+        'blob_key': blob_key
     })
 
-    print(f"Saved raw email: Subject: {subject}, From: {sender}")
\ No newline at end of file
+    print(f"Saved raw email: Subject: {subject}, From: {sender}")
+
+
+def raw_email_key(user_email, message_id):
+    return f"{user_email}/{message_id}.json.gz"
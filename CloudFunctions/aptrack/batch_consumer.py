@@ -0,0 +1,148 @@
+"""
+Size-or-time micro-batching over a Pub/Sub streaming pull.
+
+Messages are grouped into batches that close at max_messages, max_bytes or
+max_wait_s after the batch's first message, whichever comes first, so a
+trickle is handled within max_wait_s and a burst in bounded slices. Flow
+control caps the messages the subscriber holds unacknowledged, which bounds
+memory however deep the backlog is. A batch's messages are acked only after
+process_batch returns, and nacked for redelivery if it raises.
+
+The consumer stops at max_runtime_s even if messages keep arriving: the
+streaming pull is cancelled and whatever was received but not yet batched is
+nacked. Only the batch already being processed runs past it, so
+max_runtime_s plus one batch's processing time must stay under the function
+timeout, or the instance is killed mid-batch.
+"""
+import time
+import threading
+
+
+class BatchConsumer:
+    def __init__(self, subscriber, subscription_path, process_batch, max_messages = 50,
+                 max_bytes = 1024 * 1024, max_wait_s = 0.5, idle_timeout_s = 5, max_runtime_s = 45,
+                 flow_control = None):
+        """
+        Args:
+            subscriber: pubsub_v1.SubscriberClient.
+            subscription_path (str): Subscription to pull from.
+            process_batch (callable): Takes the list of messages of one batch;
+                raising nacks the whole batch.
+            max_messages (int): Messages that close a batch.
+            max_bytes (int): Payload bytes that close a batch.
+            max_wait_s (float): Age of a batch's first message that closes it.
+            idle_timeout_s (float): Stop after this long without messages.
+            max_runtime_s (float): Stop after this long, backlog or not; below
+                the function timeout less one batch's processing time.
+            flow_control: pubsub_v1.types.FlowControl; by default two batches'
+                worth of messages and bytes may be outstanding at once.
+        """
+        self.subscriber = subscriber
+        self.subscription_path = subscription_path
+        self.process_batch = process_batch
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_wait_s = max_wait_s
+        self.idle_timeout_s = idle_timeout_s
+        self.max_runtime_s = max_runtime_s
+        self.flow_control = flow_control
+        self._pending = []
+        self._pending_bytes = 0
+        self._first_at = None
+        self._last_at = None
+        self._cond = threading.Condition()
+        self.batches = 0
+        self.acked = 0
+        self.nacked = 0
+
+    def _on_message(self, message):
+        with self._cond:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_at = now
+            self._last_at = now
+            self._pending.append(message)
+            self._pending_bytes += len(message.data)
+            if self._batch_full():
+                self._cond.notify()
+
+    def _batch_full(self):
+        return len(self._pending) >= self.max_messages or self._pending_bytes >= self.max_bytes
+
+    def _next_batch(self, started):
+        """
+        Wait for the next batch to close; an empty list means stop.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                # Out of time: what is pending is nacked by run(), not started
+                if now - started >= self.max_runtime_s:
+                    return []
+                if self._pending and (self._batch_full() or now - self._first_at >= self.max_wait_s):
+                    break
+                if now - self._last_at >= self.idle_timeout_s:
+                    if not self._pending:
+                        return []
+                    break
+                deadline = min(started + self.max_runtime_s, self._last_at + self.idle_timeout_s)
+                if self._pending:
+                    deadline = min(deadline, self._first_at + self.max_wait_s)
+                self._cond.wait(max(deadline - now, 0))
+
+            batch, self._pending = self._pending[:self.max_messages], self._pending[self.max_messages:]
+            self._pending_bytes = sum(len(message.data) for message in self._pending)
+            self._first_at = time.monotonic() if self._pending else None
+            return batch
+
+    def run(self):
+        """
+        Pull and process batches until idle or out of time.
+
+        Returns:
+            list: The return values of process_batch, one per successful batch.
+        """
+        flow_control = self.flow_control
+        if flow_control is None:
+            from google.cloud import pubsub_v1
+            # Two batches may be outstanding: the one being processed and the next filling up
+            flow_control = pubsub_v1.types.FlowControl(max_messages=2 * self.max_messages,
+                                                       max_bytes=2 * self.max_bytes)
+
+        started = self._last_at = time.monotonic()
+        future = self.subscriber.subscribe(self.subscription_path, callback=self._on_message, flow_control=flow_control)
+        print(f"Listening for messages on {self.subscription_path}..")
+
+        results = []
+        try:
+            while True:
+                batch = self._next_batch(started)
+                if not batch:
+                    break
+                self.batches += 1
+                try:
+                    results.append(self.process_batch(batch))
+                except Exception as e:
+                    print(f"Batch of {len(batch)} failed, nacking for redelivery: {e}")
+                    for message in batch:
+                        message.nack()
+                    self.nacked += len(batch)
+                    continue
+                for message in batch:
+                    message.ack()
+                self.acked += len(batch)
+        finally:
+            future.cancel()
+            try:
+                future.result(timeout=10)
+            except Exception:
+                pass
+            # Anything received after the last batch closed goes back right away
+            with self._cond:
+                leftover, self._pending = self._pending, []
+            for message in leftover:
+                message.nack()
+            self.nacked += len(leftover)
+
+        print(f"Processed {self.batches} batch(es): {self.acked} acked, {self.nacked} nacked")
+        return results
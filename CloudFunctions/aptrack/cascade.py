@@ -0,0 +1,85 @@
+"""
+Confidence-based routing of emails between the CRF classifier and Gemini.
+
+By default aptrack drops every email the CRF labels irrelevant (the hard
+filter). With CASCADE_ENABLED=1 each email instead gets the classifier's
+probability that it is irrelevant and is routed by it:
+  drop       at or above CASCADE_DROP_THRESHOLD; never reaches the LLM
+  relevant   below it and labeled relevant by the CRF; sent as before
+  uncertain  below it but labeled irrelevant by the CRF; sent to the LLM with
+             a prompt whose Irrelevant status lets it drop them
+Uncertain emails are the ones the hard filter would have dropped, so they
+are exactly the extra Gemini calls the cascade spends to recover relevant
+mail the CRF mislabels; premonotion logs how many of them the LLM drops.
+Only they can be dropped by the LLM: relevant ones get premonotion's
+original prompt and are published whatever it answers.
+
+The cascade is an opt-in experiment. It does not save calls against the
+hard filter unless the drop threshold is set below the scores of
+CRF-relevant emails, which then loses them. With it off, aptrack does not
+score emails and premonotion only ever uses the original prompt, so
+nothing changes from the hard filter. Pick the threshold with
+LoadTest/cascade_bench.py, which tunes on one half of a labeled corpus and
+reports on the other.
+"""
+import os
+
+import numpy as np
+
+CASCADE_ENABLED = os.getenv("CASCADE_ENABLED", "0") == "1"
+CASCADE_DROP_THRESHOLD = float(os.getenv("CASCADE_DROP_THRESHOLD", 0.68))
+
+IRRELEVANT = 'irrelevant'
+
+
+def irrelevant_scores(crf_object, texts):
+    """
+    Score how likely each email is irrelevant.
+
+    Uses the SVC's probabilities when it was trained with probability=True,
+    otherwise a softmax over its one-vs-rest decision values, which ranks
+    emails the same way but is not calibrated (for CRFO.pkl scores fall
+    roughly between 0.05 and 0.75); tune the threshold with
+    LoadTest/cascade_bench.py.
+
+    Returns:
+        list[float | None]: One score in [0, 1] per text, or None for every
+        text if the model does not expose what is needed.
+    """
+    vectorizer = getattr(crf_object, 'vectorizer', None)
+    model = getattr(crf_object, 'model', None)
+    encoder = getattr(crf_object, 'encoder', None)
+    if vectorizer is None or model is None or encoder is None:
+        return [None] * len(texts)
+
+    classes = list(encoder.inverse_transform(model.classes_))
+    if IRRELEVANT not in classes:
+        return [None] * len(texts)
+
+    features = vectorizer.transform(texts)
+    if getattr(model, 'probability', False):
+        probabilities = model.predict_proba(features)
+    else:
+        decision = np.asarray(model.decision_function(features))
+        if decision.ndim == 1:
+            # Binary SVCs return the decision value of classes_[1] only
+            decision = np.column_stack([-decision, decision])
+        decision = np.exp(decision - decision.max(axis=1, keepdims=True))
+        probabilities = decision / decision.sum(axis=1, keepdims=True)
+    return probabilities[:, classes.index(IRRELEVANT)].tolist()
+
+
+def route(label, score, drop_threshold = CASCADE_DROP_THRESHOLD, enabled = None):
+    """
+    Args:
+        enabled (bool): Overrides CASCADE_ENABLED, e.g. for benchmarks.
+
+    Returns:
+        str: 'drop', 'relevant' or 'uncertain'.
+    """
+    enabled = CASCADE_ENABLED if enabled is None else enabled
+    if not enabled or score is None:
+        return 'drop' if label == IRRELEVANT else 'relevant'
+    if score >= drop_threshold:
+        return 'drop'
+    return 'uncertain' if label == IRRELEVANT else 'relevant'
@@ -1,83 +1,175 @@
 import base64
 import functions_framework
 
-from concurrent.futures import TimeoutError
-
 import joblib
 from google.cloud import storage
 
 from google.cloud import pubsub_v1
+from pubsub_publisher import BatchPublisher
+from dedupe_store import DedupeStore
+from blob_store import EMAIL_CONTENT_STORE, open_blob_store, load_contents
+from model_loader import GcsModelSource, ModelLoader
+from batch_consumer import BatchConsumer
+from cascade import CASCADE_ENABLED, irrelevant_scores, route
 
 from dill import load
 
+import os
 import json
+from collections import Counter
 
 storage_client = storage.Client()
 
 subscriber = pubsub_v1.SubscriberClient()
 
-def publish_message(messages):
-    psub_client = pubsub_v1.PublisherClient()
-    
-    topic_path = psub_client.topic_path('midterm-440408','rel-mail')
-
-    try:
-        message_data = messages.encode("utf-8")
-        future = psub_client.publish(topic_path, data=message_data)
-        
-        print(f"Published message to rel-mail. ID: {future.result()}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+content_store = open_blob_store(EMAIL_CONTENT_STORE)
+
+crf_loader = ModelLoader(GcsModelSource(storage_client, 'talk2data-bkt', 'CRFO.pkl'), deserialize=load)
+
+# A batch closes at BATCH_MAX_MESSAGES, BATCH_MAX_BYTES or BATCH_MAX_WAIT_MS after
+# its first message, whichever comes first. Emails of the same thread are
+# coalesced only within a batch, so BATCH_MAX_WAIT_MS is also the coalescing
+# window: it used to be a fixed 5 s pull. Raising it coalesces more follow-ups
+# at a trickle, at the cost of latency (see LoadTest/consumer_bench.py)
+BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", 50))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 1024 * 1024))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", 500))
+# The invocation ends once the subscription has been quiet this long
+IDLE_TIMEOUT_S = float(os.getenv("IDLE_TIMEOUT_S", 5))
+# The invocation also ends after MAX_RUNTIME_S however deep the backlog, and
+# the batch in flight then still has to finish: keep it well under the
+# function's timeout (60 s unless deployed with --timeout), or the instance is
+# killed mid-batch and the batch's dedupe claims are held until their lease ends
+MAX_RUNTIME_S = float(os.getenv("MAX_RUNTIME_S", 45))
+THREAD_COALESCING = os.getenv("THREAD_COALESCING", "1") == "1"
+
+def coalesce_threads(message_list):
+    """
+    Keep only the newest email of each Gmail thread in a batch.
+
+    Recruiting threads carry a confirmation, reminders and follow-ups; the
+    newest message holds the current status, so the older ones are not
+    classified or extracted again. The kept record lists the IDs it stands for.
+
+    Args:
+        message_list (list[dict]): Records from unprocessed-emails.
+
+    Returns:
+        list[dict]: One record per (user, thread), in first-seen order. Records
+        without a thread_id are kept as they are.
+    """
+    newest = {}
+    coalesced = {}
+    order = []
+    for record in message_list:
+        if not record.get('thread_id'):
+            order.append(record)
+            continue
+        key = (record['email'], record['thread_id'])
+        if key not in newest:
+            order.append(key)
+            newest[key] = record
+            coalesced[key] = []
+        elif record.get('internal_date', 0) > newest[key].get('internal_date', 0):
+            coalesced[key].append(newest[key].get('message_id'))
+            newest[key] = record
+        else:
+            coalesced[key].append(record.get('message_id'))
+
+    result = []
+    for item in order:
+        if isinstance(item, dict):
+            result.append(item)
+        else:
+            result.append({**newest[item], 'coalesced_message_ids': coalesced[item]})
+    print(f"Coalesced {len(message_list)} emails into {len(result)} by thread")
+    return result
 
 def load_CRFObject():
-    object_path = '/tmp/CRFObject.pkl'
-
-    bucket = storage_client.bucket('talk2data-bkt')
-
-    blob = bucket.blob('CRFO.pkl')
-
-    blob_ = blob.download_to_filename(object_path)
+    # In memory across warm invocations; GCS is checked for a new version at
+    # most every MODEL_CHECK_INTERVAL_MIN minutes
+    return crf_loader.get()
+
+def classify_batch(crf_object, messages, dedupe):
+    """
+    Classify one micro-batch and publish the relevant emails to rel-mail.
+
+    Raises if publishing fails, so the batch is nacked and redelivered; the
+    batch's dedupe claims are released first so the redelivery is not dropped.
+    Also raises, after publishing the rest, if another run holds some of the
+    emails in progress, so they are redelivered rather than dropped.
+
+    Returns:
+        list[dict]: The relevant and uncertain emails that were published.
+    """
+    message_list = []
+    for message in messages:
+        try:
+            message_list.append(json.loads(message.data.decode('utf-8')))
+        except ValueError as e:
+            # Redelivering a malformed message would not help; it is acked with the batch
+            print(f"Skipping malformed message {message.message_id}: {e}")
 
-    with open(object_path, 'rb') as f:
-        crf_object = load(f)
+    # Redelivered emails were classified by an earlier run
+    claimed, busy = dedupe.claim_records(message_list)
 
-    return crf_object
+    class_final = []
+    routes = Counter()
+    if claimed:
+        try:
+            message_list = coalesce_threads(claimed) if THREAD_COALESCING else claimed
+
+            # Messages carry claim checks; the bodies are loaded together, only for classification
+            text_data = load_contents(content_store, message_list)
+
+            classified_results = crf_object.run(text_data)
+            # Scoring is a second vectorize and SVC pass, only paid for when the cascade is on
+            scores = irrelevant_scores(crf_object, text_data) if CASCADE_ENABLED else [None] * len(text_data)
+
+            for i in range(len(message_list)):
+                # With the cascade on, mail the CRF labels irrelevant but not confidently goes on to the LLM as uncertain
+                cascade = route(classified_results[i], scores[i])
+                routes[cascade] += 1
+                if cascade != 'drop':
+                    e_mail = message_list[i]['email']
+                    # Forward the claim check, not the body; legacy records keep their inline content
+                    body = {key: message_list[i][key] for key in ('content_ref', 'preview', 'content') if key in message_list[i]}
+                    class_final.append({'email': e_mail, 'message_id': message_list[i].get('message_id'),
+                                        'thread_id': message_list[i].get('thread_id'), **body, 'status': classified_results[i],
+                                        'cascade': cascade, 'irrelevant_score': scores[i]})
+
+            if class_final:
+                publisher = BatchPublisher('rel-mail')
+                publisher.publish(json.dumps(class_final), label='rel-mail batch')
+                _, failed = publisher.wait()
+                if failed:
+                    raise RuntimeError(f"Publishing to rel-mail failed: {failed}")
+        except Exception:
+            dedupe.release_records(claimed)
+            raise
+        # Published, so redeliveries of these emails are duplicates from now on
+        dedupe.complete_records(claimed)
+
+        print(f"Classified {len(message_list)} emails: {routes['relevant']} relevant, "
+              f"{routes['uncertain']} uncertain, {routes['drop']} dropped")
+    if busy:
+        raise RuntimeError(f"{len(busy)} emails are being classified by another run; nacking the batch to retry them")
+    return class_final
 
 @functions_framework.http
 def hello_main(cloud_event):
     crf_object = load_CRFObject()
 
     subscription_path = subscriber.subscription_path('midterm-440408', 'aptrack-sub')
-    
-    message_list = []
-
-    def callback(message):
-        print(f"Received message.")
-        b = json.loads(message.data.decode('utf-8'))
-        message_list.append(b)
-        message.ack()
-
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
-    print(f"Listening for messages on {subscription_path}..\n")
-
-    with subscriber:
-        try:
-            streaming_pull_future.result(timeout=5)
-        except TimeoutError:
-            streaming_pull_future.cancel()
-            streaming_pull_future.result()
-
-    text_data = [email['content'] for email in message_list]
-
-    classified_results = crf_object.run(text_data)
-
-    class_final = []
-
-    for i in range(len(message_list)):
-        if classified_results[i] != 'irrelevant':
-            e_mail = message_list[i]['email']
-            class_final.append({'email': e_mail, 'content': message_list[i]['content'], 'status': classified_results[i]})
 
-    publish_message(json.dumps(class_final))
+    dedupe = DedupeStore('aptrack')
+    # Messages are acked per batch, only once its classification is published
+    consumer = BatchConsumer(subscriber, subscription_path,
+                             lambda messages: classify_batch(crf_object, messages, dedupe),
+                             max_messages=BATCH_MAX_MESSAGES, max_bytes=BATCH_MAX_BYTES,
+                             max_wait_s=BATCH_MAX_WAIT_MS / 1000, idle_timeout_s=IDLE_TIMEOUT_S,
+                             max_runtime_s=MAX_RUNTIME_S)
+    class_final = [email for batch in consumer.run() for email in batch]
+    print(dedupe.summary())
 
     return {'h': class_final}
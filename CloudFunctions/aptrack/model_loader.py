@@ -0,0 +1,153 @@
+"""
+Cached, versioned loading of model artifacts.
+
+The deserialized model is kept in memory across warm invocations. The
+source is asked for the artifact's version (GCS generation and MD5) at most
+once every check interval, and the artifact is only downloaded when that
+version changes. Downloads land in a content-addressed cache named after the
+artifact's MD5, so an instance that already has the bytes (e.g. after a
+rollback to a previous version) skips the download too.
+"""
+import os
+import time
+import base64
+import shutil
+import hashlib
+import threading
+
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "/tmp/models")
+MODEL_CHECK_INTERVAL_S = float(os.getenv("MODEL_CHECK_INTERVAL_MIN", 10)) * 60
+# /tmp on Cloud Functions is memory-backed, so only the newest artifacts are kept
+MODEL_CACHE_KEEP = int(os.getenv("MODEL_CACHE_KEEP", 2))
+
+
+def file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GcsModelSource:
+    def __init__(self, storage_client, bucket_name, blob_name):
+        self.blob = storage_client.bucket(bucket_name).blob(blob_name)
+
+    def stat(self):
+        """
+        Returns:
+            tuple[str, str]: The object's generation and its MD5 as hex.
+        """
+        # Metadata only; the object itself is not read
+        self.blob.reload()
+        return str(self.blob.generation), base64.b64decode(self.blob.md5_hash).hex()
+
+    def download(self, path):
+        self.blob.download_to_filename(path)
+
+    def __str__(self):
+        return f"gs://{self.blob.bucket.name}/{self.blob.name}"
+
+
+class LocalModelSource:
+    """
+    A model file on disk, e.g. models/CRFO.pkl for local runs and benchmarks.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def stat(self):
+        return str(os.stat(self.path).st_mtime_ns), file_md5(self.path)
+
+    def download(self, path):
+        shutil.copyfile(self.path, path)
+
+    def __str__(self):
+        return self.path
+
+
+class ModelLoader:
+    def __init__(self, source, deserialize, cache_dir = MODEL_CACHE_DIR, check_interval_s = MODEL_CHECK_INTERVAL_S):
+        """
+        Args:
+            source: GcsModelSource or LocalModelSource.
+            deserialize (callable): Turns an open binary file into the model, e.g. dill.load.
+            cache_dir (str): Directory of the content-addressed artifact cache.
+            check_interval_s (float): Minimum time between version checks.
+        """
+        self.source = source
+        self.deserialize = deserialize
+        self.cache_dir = cache_dir
+        self.check_interval_s = check_interval_s
+        self.model = None
+        self.version = None
+        self.checked_at = None
+        self.last_load = {}
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return the current model, loading it if it is missing or has changed.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.model is not None and now - self.checked_at < self.check_interval_s:
+                return self.model
+
+            try:
+                version = self.source.stat()
+            except Exception as e:
+                if self.model is None:
+                    raise
+                # Keep serving the loaded model; try again after the next interval
+                print(f"Could not check {self.source} for a new model version: {e}")
+                self.checked_at = now
+                return self.model
+
+            self.checked_at = now
+            if self.model is None or version != self.version:
+                self._load(version)
+            return self.model
+
+    def _load(self, version):
+        generation, md5 = version
+        start = time.perf_counter()
+        path = os.path.join(self.cache_dir, f"{md5}.pkl")
+        downloaded = not os.path.exists(path)
+        if downloaded:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            partial = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+            self.source.download(partial)
+            if file_md5(partial) != md5:
+                os.remove(partial)
+                raise ValueError(f"Downloaded model from {self.source} does not match MD5 {md5}")
+            os.replace(partial, path)
+            self._evict(keep=path)
+        else:
+            # Mark as recently used for eviction
+            os.utime(path)
+        fetched = time.perf_counter()
+
+        with open(path, 'rb') as f:
+            self.model = self.deserialize(f)
+        self.version = version
+
+        self.last_load = {
+            'generation': generation,
+            'md5': md5,
+            'downloaded': downloaded,
+            'fetch_s': fetched - start,
+            'deserialize_s': time.perf_counter() - fetched
+        }
+        print(f"Loaded model {self.source} generation {generation} "
+              f"({'downloaded' if downloaded else 'from cache'}) in "
+              f"{self.last_load['fetch_s'] + self.last_load['deserialize_s']:.3f}s "
+              f"(fetch {self.last_load['fetch_s']:.3f}s, deserialize {self.last_load['deserialize_s']:.3f}s)")
+
+    def _evict(self, keep):
+        artifacts = sorted((os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                            if name.endswith('.pkl')), key=os.path.getmtime, reverse=True)
+        for path in artifacts[MODEL_CACHE_KEEP:]:
+            if path != keep:
+                os.remove(path)
@@ -0,0 +1,124 @@
+"""
+Helpers shared by the Gmail webhook functions.
+
+The same module is copied into every service that reads mailboxes
+(GmailHook, fetch-latest-emails-pubsub); keep the copies identical.
+"""
+import time
+from itertools import islice
+
+# Gmail accepts at most 100 calls in one HTTP batch request
+BATCH_SIZE = 100
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRY_DELAY_S = 1.0
+# history.list returns at most 500 records per page
+HISTORY_PAGE_SIZE = 500
+
+
+def iter_history_pages(gmail_service, user_email, start_history_id, page_size = HISTORY_PAGE_SIZE):
+    """
+    Read the mailbox history after start_history_id one page at a time.
+
+    Follows nextPageToken until the history is exhausted and only keeps the
+    IDs of added messages, so the full history is never held in memory. A
+    message that shows up in several history records is yielded once.
+
+    Args:
+        gmail_service: Gmail API service built for the user.
+        user_email (str): Mailbox owner.
+        start_history_id (str): Last history ID already processed.
+        page_size (int): History records per page, at most 500.
+
+    Yields:
+        tuple[list[str], str]: IDs of messages added on the page and not seen on
+        an earlier page, and the history ID to checkpoint once they are processed.
+    """
+    seen = set()
+    page_token = None
+    while True:
+        params = {'userId': user_email, 'startHistoryId': start_history_id,
+                  'historyTypes': ['messageAdded'], 'maxResults': page_size}
+        if page_token:
+            params['pageToken'] = page_token
+        response = gmail_service.users().history().list(**params).execute()
+
+        records = response.get('history', [])
+        message_ids = []
+        for record in records:
+            for added_message in record.get('messagesAdded', []):
+                message_id = added_message['message']['id']
+                if message_id not in seen:
+                    seen.add(message_id)
+                    message_ids.append(message_id)
+
+        page_token = response.get('nextPageToken')
+        # Records come oldest first; the last page is checkpointed at the
+        # mailbox's current history ID
+        if page_token:
+            checkpoint = records[-1]['id'] if records else start_history_id
+        else:
+            checkpoint = response.get('historyId', records[-1]['id'] if records else start_history_id)
+        yield message_ids, checkpoint
+
+        if not page_token:
+            return
+
+
+def fetch_messages(gmail_service, user_email, message_ids, batch_size = BATCH_SIZE, **get_params):
+    """
+    Fetch messages through Gmail's HTTP batch endpoint.
+
+    Up to batch_size messages.get calls share one round trip over the
+    service's authorized session. Calls that fail with a rate-limit or server
+    error are retried once in a later batch; other failures are reported per
+    message without affecting the rest of the batch.
+
+    Args:
+        gmail_service: Gmail API service built for the user.
+        user_email (str): Mailbox owner.
+        message_ids (iterable[str]): Message IDs; consumed lazily, one batch at a time.
+        batch_size (int): Calls per batch request, at most 100.
+        **get_params: Extra messages.get parameters, e.g. format='full'.
+
+    Yields:
+        tuple: (message_id, message, error), with exactly one of message and error set.
+    """
+    message_ids = iter(message_ids)
+    while True:
+        chunk = list(dict.fromkeys(islice(message_ids, batch_size)))
+        if not chunk:
+            return
+
+        results = _execute_batch(gmail_service, user_email, chunk, get_params)
+        retry = [message_id for message_id in chunk if _is_retryable(results[message_id][1])]
+        if retry:
+            time.sleep(RETRY_DELAY_S)
+            results.update(_execute_batch(gmail_service, user_email, retry, get_params))
+
+        for message_id in chunk:
+            message, error = results[message_id]
+            yield message_id, message, error
+
+
+def _execute_batch(gmail_service, user_email, message_ids, get_params):
+    results = {}
+
+    def on_response(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    batch = gmail_service.new_batch_http_request(callback=on_response)
+    for message_id in message_ids:
+        batch.add(gmail_service.users().messages().get(userId=user_email, id=message_id, **get_params),
+                  request_id=message_id)
+    try:
+        batch.execute()
+    except Exception as e:
+        # The whole round trip failed; report it against every message in it
+        for message_id in message_ids:
+            results.setdefault(message_id, (None, e))
+    return results
+
+
+def _is_retryable(error):
+    status = getattr(getattr(error, 'resp', None), 'status', None)
+    return status is not None and int(status) in RETRYABLE_STATUSES
@@ -1,19 +1,42 @@
+import os
 import base64
 import functions_framework
 import json
-from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from google.cloud import firestore
-from google.cloud import pubsub_v1
+from oauth_credentials import CredentialStore
+from gmail_sync import fetch_messages, iter_history_pages
+from history_lease import HistoryLease
+from prefilter import METADATA_HEADERS, PrefilterStats, classify_headers, get_header
+from mime_extract import extract_body
+from pubsub_publisher import BatchPublisher
+from dedupe_store import DedupeStore
+from blob_store import EMAIL_CONTENT_STORE, open_blob_store, put_content
 # import vertexai
 # from vertexai.generative_models import GenerativeModel
 
 # Initialize Firestore client
 db = firestore.Client()
 
+# Email bodies travel by reference: Pub/Sub messages carry a claim check
+content_store = open_blob_store(EMAIL_CONTENT_STORE)
+
+# Live access tokens shared by invocations on this instance, refreshed once per user
+credential_store = CredentialStore(db, flush_interval_s=60)
+
 # Initialize Vertex AI client
 # ertexai.init(project='midterm-440408', location='us-central1')
 
+# An email whose fetch or processing failed this many times is moved to the
+# dead_letter_emails collection, so the rest of its history page can be checkpointed
+MAX_PUBLISH_ATTEMPTS = int(os.getenv("MAX_PUBLISH_ATTEMPTS", 5))
+DEAD_LETTER_COLLECTION = 'dead_letter_emails'
+
+class PublishIncomplete(RuntimeError):
+    """
+    Raised before a history page is checkpointed when some of its emails were not published.
+    """
+
 @functions_framework.cloud_event
 def gmail_webhook(cloud_event):
     pubsub_message = base64.b64decode(cloud_event.data['message']['data'])
@@ -28,58 +51,150 @@ def gmail_webhook(cloud_event):
         print(f"User {user_email} not found in Firestore")
         return
 
-    user_data = user_doc.to_dict()
-    credentials = Credentials(
-        token=user_data['token'],
-        refresh_token=user_data['refresh_token'],
-        token_uri=user_data['token_uri'],
-        client_id=user_data['client_id'],
-        client_secret=user_data['client_secret'],
-        scopes=user_data['scopes']
-    )
-
-    last_history_id = user_data.get('last_history_id', '1')
+    # Only one run per user reads history; notifications that arrive while it
+    # runs are folded into a single catch-up pass of that run. The lease and
+    # cursor are this function's own: GmailHook archives the same emails
+    lease = HistoryLease(db, user_ref, 'publish_')
+    if not lease.acquire():
+        print(f"Sync already running for {user_email}, coalesced into it")
+        return
 
-    gmail_service = build('gmail', 'v1', credentials=credentials)
-    
     try:
-        history = gmail_service.users().history().list(userId=user_email, startHistoryId=last_history_id).execute()
-
-        for event in history.get('history', []):
-            for added_message in event.get('messagesAdded', []):
-                try:
-                    msg = gmail_service.users().messages().get(userId=user_email, id=added_message['message']['id'], format='full').execute()
-                    for head in msg['payload']['headers']:
-                        if head['name'] == 'From':
-                            sender = head['value']
-                        elif head['name'] == 'Date':
-                            receive_datetime = head['value']
-                    payload = msg.get('payload', '')
-                    if payload:
-                        if 'parts' in payload:
-                            for part in payload['parts']:
-                                if part['mimeType'] == 'text/plain':
-                                    msg_content = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                        elif 'body' in payload:
-                            msg_content = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-                    message_details = {
-                        'data' : msg_content,
-                        'sender' : sender,
-                        'datetime' : receive_datetime
-                    }
-                    process_and_store_email(message_details, user_email)
-                except Exception as e:
-                    print(f"Error processing message: {e}")
-
-        user_ref.update({'last_history_id': new_history_id})
-        print(f"Successfully processed new emails for {user_email}")
-    except Exception as e:
-        print(f"Error fetching history: {e}")
-        if 'last_history_id' not in user_data:
-            user_ref.update({'last_history_id': new_history_id})
-            print(f"Initialized last_history_id to {new_history_id}")
-
-def process_and_store_email(message_details, user_email):
+        user_data = user_doc.to_dict()
+        credentials = credential_store.get(user_email, user_data)
+
+        gmail_service = build('gmail', 'v1', credentials=credentials)
+
+        prefilter_stats = PrefilterStats()
+        publisher = BatchPublisher('unprocessed-emails')
+        dedupe = DedupeStore('publish', db=db)
+        while True:
+            try:
+                sync_history(gmail_service, user_email, lease, prefilter_stats, publisher, dedupe)
+                print(f"Successfully processed new emails for {user_email}")
+            except Exception as e:
+                print(f"Error fetching history: {e}")
+                # A page that failed to publish is replayed, never skipped by initializing the cursor
+                if lease.last_history_id is None and not isinstance(e, PublishIncomplete):
+                    lease.advance(new_history_id)
+                    print(f"Initialized last_history_id to {new_history_id}")
+
+            if not lease.finish():
+                break
+        print(f"{user_email}: {prefilter_stats.summary()}, {dedupe.summary()}")
+    except Exception:
+        lease.release()
+        raise
+    finally:
+        # Write back any token refreshed during this invocation
+        credential_store.flush()
+
+def sync_history(gmail_service, user_email, lease, prefilter_stats, publisher, dedupe):
+    """
+    Publish every new candidate email since the lease's last_history_id, checkpointing per history page.
+    """
+    last_history_id = lease.last_history_id or '1'
+
+    # Pages of history are processed and checkpointed one at a time, so a
+    # crash only replays the page that was in flight
+    for message_ids, checkpoint_history_id in iter_history_pages(gmail_service, user_email, last_history_id):
+        # Phase one: headers and labels only, to skip mail that is clearly
+        # not about a job application
+        candidate_ids = []
+        for message_id, msg, error in fetch_messages(gmail_service, user_email, message_ids,
+                                                     format='metadata', metadataHeaders=METADATA_HEADERS):
+            if error:
+                print(f"Error fetching message {message_id}: {error}")
+                continue
+            keep, reason = classify_headers(msg)
+            prefilter_stats.record(reason, keep)
+            if keep:
+                candidate_ids.append(message_id)
+
+        # Emails already published by an earlier or overlapping run are skipped;
+        # busy ones are being published by another run right now
+        candidate_ids, busy = dedupe.claim(user_email, candidate_ids)
+
+        # Claimed once more than the limit: the runs that took it were killed before finishing
+        crashed = {message_id: f"no run finished it in {MAX_PUBLISH_ATTEMPTS} attempts" for message_id in candidate_ids
+                   if dedupe.attempts(user_email, message_id) > MAX_PUBLISH_ATTEMPTS}
+        if crashed:
+            dead_letter(user_email, crashed, dedupe)
+            candidate_ids = [message_id for message_id in candidate_ids if message_id not in crashed]
+
+        # Phase two: full bodies for the candidates, up to 100 messages per round trip
+        errors = {}
+        for message_id, msg, error in fetch_messages(gmail_service, user_email, candidate_ids, format='full'):
+            if error:
+                print(f"Error fetching message {message_id}: {error}")
+                # A message deleted since the history was read can never be published; don't hold the page for it
+                if getattr(getattr(error, 'resp', None), 'status', None) not in (404, '404'):
+                    errors[message_id] = error
+                continue
+            try:
+                process_message(msg, user_email, publisher)
+            except Exception as e:
+                print(f"Error processing message: {e}")
+                errors[message_id] = e
+
+        # Every email on the page is handed to Pub/Sub before the page is checkpointed
+        _, failed = publisher.wait()
+        # A message that keeps failing would hold the page, and the mailbox, for good
+        given_up = {message_id: error for message_id, error in errors.items()
+                    if dedupe.attempts(user_email, message_id) >= MAX_PUBLISH_ATTEMPTS}
+        if given_up:
+            dead_letter(user_email, given_up, dedupe)
+        retry = [message_id for message_id in errors if message_id not in given_up]
+        # Published or dead-lettered, so later runs skip them for the full TTL
+        dedupe.complete(user_email, [message_id for message_id in candidate_ids + list(crashed)
+                                     if message_id not in retry and message_id not in failed])
+        if retry or failed or busy:
+            # Stop before the checkpoint so the next run replays this page;
+            # the released claims let it publish what did not make it out, and
+            # the busy ones are checked again once the other run's lease ends.
+            # A failed publish is Pub/Sub's fault, not the email's, so it is not counted as an attempt
+            dedupe.release(user_email, retry)
+            dedupe.release(user_email, list(failed), count_attempt=False)
+            raise PublishIncomplete(f"{len(retry) + len(failed)} emails not published, {len(busy)} in progress elsewhere, "
+                                    f"history up to {checkpoint_history_id} will be replayed")
+        # Never moves the cursor backwards
+        lease.advance(checkpoint_history_id)
+
+def dead_letter(user_email, errors, dedupe):
+    """
+    Record emails that are given up on, for inspection and manual replay.
+
+    Args:
+        errors (dict): Gmail message ID -> the error of its last attempt.
+    """
+    batch = db.batch()
+    for message_id, error in errors.items():
+        print(f"Dead-lettering message {message_id} after {dedupe.attempts(user_email, message_id)} attempts: {error}")
+        batch.set(db.collection(DEAD_LETTER_COLLECTION).document(f"{user_email}:{message_id}"), {
+            'user_email': user_email,
+            'message_id': message_id,
+            'error': str(error),
+            'attempts': dedupe.attempts(user_email, message_id),
+            'dead_lettered_at': firestore.SERVER_TIMESTAMP
+        })
+    batch.commit()
+
+def process_message(msg, user_email, publisher):
+    content = extract_body(msg.get('payload', {}))
+    if not content:
+        print(f"No text body in message {msg['id']}, skipping")
+        return
+    message_details = {
+        'message_id' : msg['id'],
+        'thread_id' : msg.get('threadId'),
+        'internal_date' : int(msg.get('internalDate', 0)),
+        'data' : content,
+        'sender' : get_header(msg, 'From'),
+        'datetime' : get_header(msg, 'Date')
+    }
+    process_and_store_email(message_details, user_email, publisher)
+
+def process_and_store_email(message_details, user_email, publisher):
     # Extract email content
     content = message_details.get('data', '')  # Use full message body in practice
     '''
@@ -113,20 +228,14 @@ def process_and_store_email(message_details, user_email):
             'original_snippet': content  # Optional: store original snippet for reference
         })
     '''
-    publish_message(json.dumps({'email': user_email, 'content': content}))
-    
-def publish_message(messages):
-    psub_client = pubsub_v1.PublisherClient()
-    
-    topic_path = psub_client.topic_path('midterm-440408', 'unprocessed-emails')
-
-    try:
-        message_data = messages.encode("utf-8")
-        future = psub_client.publish(topic_path, data=message_data)
-        
-        print(f"Published message ID: {future.result()}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    # The body goes to the content store and the message only carries a
+    # reference and a preview, keeping Pub/Sub payloads small
+    claim_check = put_content(content_store, user_email, message_details.get('message_id'), content)
+    # Ordered per user so a user's emails reach classification in arrival order
+    publisher.publish(json.dumps({'email': user_email, 'message_id': message_details.get('message_id'),
+                                  'thread_id': message_details.get('thread_id'),
+                                  'internal_date': message_details.get('internal_date'), **claim_check}),
+                      ordering_key=user_email, label=message_details.get('message_id'))
 
 def parse_vertex_ai_response(response):
     # Implement parsing logic based on your model's output format
@@ -0,0 +1,158 @@
+"""
+Plain-text body extraction from Gmail API message payloads.
+
+The part tree is walked iteratively, so deeply nested multipart messages
+cost no recursion. Attachments are skipped without decoding them. text/plain
+is preferred, and HTML-only emails fall back to an HTML-to-text conversion.
+Quoted reply chains are stripped. At most MAX_BODY_BYTES are decoded per
+message, however large the email is.
+"""
+import os
+import re
+import base64
+from html.parser import HTMLParser
+
+MAX_BODY_BYTES = int(os.getenv("MAX_BODY_BYTES", 64 * 1024))
+
+# Lines that start the quoted part of a reply. Forwards are kept: a forwarded
+# recruiter email is the content that matters.
+QUOTE_MARKERS = [
+    re.compile(r'^On .{0,200}wrote:\s*$'),
+    re.compile(r'^-{2,}\s*Original Message\s*-{2,}', re.IGNORECASE),
+    re.compile(r'^_{10,}\s*$'),
+]
+BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'section'}
+SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'blockquote'}
+
+
+def extract_body(payload, max_bytes = MAX_BODY_BYTES):
+    """
+    Extract the readable body of an email.
+
+    Args:
+        payload (dict): The 'payload' of a messages.get(format='full') response.
+        max_bytes (int): Decoded bytes kept from the chosen part.
+
+    Returns:
+        str: Body text without quoted replies, or '' if the email has no text part.
+    """
+    plain, html = find_text_parts(payload)
+    if plain is not None:
+        text = decode_part(plain, max_bytes)
+    elif html is not None:
+        text = html_to_text(decode_part(html, max_bytes))
+    else:
+        return ''
+    return strip_quoted(text)
+
+
+def find_text_parts(payload):
+    """
+    Return the first text/plain and first text/html parts that are not attachments.
+    """
+    plain = html = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type.startswith('multipart/'):
+            # Reversed so parts are visited in document order
+            stack.extend(reversed(part.get('parts', [])))
+        elif is_attachment(part):
+            continue
+        elif mime_type == 'text/plain' and plain is None:
+            plain = part
+        elif mime_type == 'text/html' and html is None:
+            html = part
+        if plain is not None:
+            break
+    return plain, html
+
+
+def is_attachment(part):
+    body = part.get('body', {})
+    if part.get('filename') or 'attachmentId' in body:
+        return True
+    disposition = header_value(part, 'Content-Disposition')
+    return disposition.lower().startswith('attachment')
+
+
+def header_value(part, name):
+    return next((header['value'] for header in part.get('headers', [])
+                 if header['name'].lower() == name.lower()), '')
+
+
+def decode_part(part, max_bytes):
+    data = part.get('body', {}).get('data', '')
+    # base64 packs 3 bytes into 4 characters; only the needed prefix is decoded
+    encoded_limit = -(-max_bytes // 3) * 4
+    raw = base64.urlsafe_b64decode(pad_base64(data[:encoded_limit]))[:max_bytes]
+    charset = re.search(r'charset="?([\w-]+)', header_value(part, 'Content-Type'), re.IGNORECASE)
+    try:
+        return raw.decode(charset.group(1) if charset else 'utf-8', errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def pad_base64(data):
+    return data + '=' * (-len(data) % 4)
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        # Tag that opened the region being skipped, and how deeply it is nested.
+        # Only that tag is counted, so unclosed tags inside cannot leak the skip.
+        self.skip_tag = None
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_depth += 1
+            return
+        css_class = dict(attrs).get('class') or ''
+        # Gmail wraps quoted replies in div.gmail_quote, Outlook in blockquote
+        if tag in SKIPPED_TAGS or 'gmail_quote' in css_class:
+            self.skip_tag, self.skip_depth = tag, 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_endtag(self, tag):
+        if self.skip_tag:
+            if tag == self.skip_tag:
+                self.skip_depth -= 1
+                if self.skip_depth == 0:
+                    self.skip_tag = None
+        elif tag in BLOCK_TAGS:
+            self.chunks.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_tag:
+            self.chunks.append(data)
+
+
+def html_to_text(html):
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    text = ''.join(parser.chunks)
+    lines = (re.sub(r'[ \t\xa0]+', ' ', line).strip() for line in text.splitlines())
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(lines)).strip()
+
+
+def strip_quoted(text):
+    """
+    Drop quoted lines and everything after the first reply marker. Text that is
+    nothing but quotes is returned unchanged.
+    """
+    kept = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if any(marker.match(stripped) for marker in QUOTE_MARKERS):
+            break
+        if stripped.startswith('>'):
+            continue
+        kept.append(line)
+    return '\n'.join(kept).strip() or text.strip()
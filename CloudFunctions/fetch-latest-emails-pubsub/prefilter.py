@@ -0,0 +1,90 @@
+"""
+Header-only prefilter that decides which new emails are worth downloading in
+full and sending on for classification.
+
+Only From, Subject, List-Unsubscribe and the Gmail labels (including the
+inbox category) are looked at, so it runs on format='metadata' responses.
+Every rule is configurable through environment variables holding
+comma-separated, case-insensitive values.
+"""
+import os
+from collections import Counter
+
+
+def _env_list(name, default):
+    return [value.strip().lower() for value in os.getenv(name, default).split(',') if value.strip()]
+
+
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "1") == "1"
+# Matching From or Subject always keeps the email, whatever the other rules say
+PREFILTER_KEEP_KEYWORDS = _env_list("PREFILTER_KEEP_KEYWORDS",
+                                    "application,applying,applied,interview,assessment,offer,candidate,"
+                                    "recruit,hiring,position,career,talent,greenhouse,lever.co,workday,"
+                                    "hackerrank,codesignal,your interest")
+PREFILTER_SKIP_CATEGORIES = _env_list("PREFILTER_SKIP_CATEGORIES",
+                                      "CATEGORY_PROMOTIONS,CATEGORY_SOCIAL,CATEGORY_FORUMS")
+PREFILTER_SKIP_SENDERS = _env_list("PREFILTER_SKIP_SENDERS",
+                                   "newsletter,receipt,billing,classroom.google.com,piazza.com,brightspace")
+# Mailing-list mail (newsletters, digests, announcements) carries List-Unsubscribe
+PREFILTER_SKIP_LIST_MAIL = os.getenv("PREFILTER_SKIP_LIST_MAIL", "1") == "1"
+
+# Headers phase one asks Gmail for
+METADATA_HEADERS = ['From', 'Subject', 'Date', 'List-Unsubscribe']
+
+
+def get_header(msg, name):
+    return next((header['value'] for header in msg.get('payload', {}).get('headers', [])
+                 if header['name'].lower() == name.lower()), '')
+
+
+def classify_headers(msg):
+    """
+    Decide from headers and labels whether an email may be job-application mail.
+
+    Args:
+        msg (dict): A messages.get response in metadata or full format.
+
+    Returns:
+        tuple[bool, str]: Whether to fetch the full email, and the rule that decided.
+    """
+    if not PREFILTER_ENABLED:
+        return True, 'disabled'
+
+    sender = get_header(msg, 'From').lower()
+    subject = get_header(msg, 'Subject').lower()
+    if any(keyword in sender or keyword in subject for keyword in PREFILTER_KEEP_KEYWORDS):
+        return True, 'keyword'
+
+    labels = {label.lower() for label in msg.get('labelIds', [])}
+    if labels & set(PREFILTER_SKIP_CATEGORIES):
+        return False, 'category'
+    if any(pattern in sender for pattern in PREFILTER_SKIP_SENDERS):
+        return False, 'sender'
+    if PREFILTER_SKIP_LIST_MAIL and get_header(msg, 'List-Unsubscribe'):
+        return False, 'list_mail'
+    return True, 'default'
+
+
+class PrefilterStats:
+    """
+    Counts prefilter decisions so each invocation can report its prefilter rate.
+    """
+
+    def __init__(self):
+        self.decisions = Counter()
+
+    def record(self, reason, kept):
+        self.decisions[(reason, kept)] += 1
+
+    @property
+    def seen(self):
+        return sum(self.decisions.values())
+
+    @property
+    def kept(self):
+        return sum(count for (_, kept), count in self.decisions.items() if kept)
+
+    def summary(self):
+        skipped = {reason: count for (reason, kept), count in self.decisions.items() if not kept}
+        rate = 1 - self.kept / self.seen if self.seen else 0.0
+        return f"prefilter skipped {self.seen - self.kept}/{self.seen} emails ({rate:.0%}) {skipped}"
@@ -0,0 +1,133 @@
+"""
+Compressed blob storage for raw email bodies.
+
+Blobs are gzip-compressed and addressed by key. The backend is chosen by
+URL: gs://bucket/prefix for Cloud Storage, file:///path (or a plain path)
+for the local filesystem, which is handy for local runs and exports.
+
+    store = open_blob_store(os.getenv("RAW_EMAIL_STORE"))
+    store.put("user@example.com/18c2f.json.gz", data)
+    store.get("user@example.com/18c2f.json.gz")
+
+It also backs the claim-check pattern of the email pipeline: instead of the
+body, Pub/Sub messages carry a content_ref into EMAIL_CONTENT_STORE plus a
+short preview, and only the stages that need bodies load them, in bulk.
+
+The same module is copied into every service that reads or writes blobs
+(GmailHook, fetch-latest-emails-pubsub, aptrack, premonotion); keep the copies identical.
+"""
+import os
+import gzip
+import json
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+RAW_EMAIL_STORE = os.getenv("RAW_EMAIL_STORE", "gs://talk2data-bkt/raw-emails")
+EMAIL_CONTENT_STORE = os.getenv("EMAIL_CONTENT_STORE", "gs://talk2data-bkt/email-content")
+COMPRESS_LEVEL = int(os.getenv("RAW_EMAIL_COMPRESS_LEVEL", 6))
+PREVIEW_CHARS = 280
+READ_WORKERS = 8
+
+
+class LocalBlobStore:
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError(f"Blob key escapes the store: {key}")
+        return path
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name so readers never see a partial blob
+        with open(path + '.tmp', 'wb') as f:
+            f.write(gzip.compress(data, COMPRESS_LEVEL))
+        os.replace(path + '.tmp', path)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def url(self, key):
+        return 'file://' + self._path(key)
+
+
+class GcsBlobStore:
+    def __init__(self, bucket_name, prefix = '', client = None):
+        if client is None:
+            from google.cloud import storage
+            client = storage.Client()
+        self.bucket = client.bucket(bucket_name)
+        self.prefix = prefix.strip('/')
+
+    def _name(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def put(self, key, data):
+        blob = self.bucket.blob(self._name(key))
+        blob.content_encoding = 'gzip'
+        blob.upload_from_string(gzip.compress(data, COMPRESS_LEVEL), content_type='application/octet-stream')
+
+    def get(self, key):
+        # raw_download keeps GCS from transparently gunzipping the body
+        return gzip.decompress(self.bucket.blob(self._name(key)).download_as_bytes(raw_download=True))
+
+    def url(self, key):
+        return f"gs://{self.bucket.name}/{self._name(key)}"
+
+
+def open_blob_store(url = RAW_EMAIL_STORE):
+    """
+    Open the blob store a URL points at.
+
+    Args:
+        url (str): gs://bucket/prefix, file:///path or a filesystem path.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == 'gs':
+        return GcsBlobStore(parsed.netloc, parsed.path)
+    if parsed.scheme in ('', 'file'):
+        return LocalBlobStore(parsed.path if parsed.scheme else url)
+    raise ValueError(f"Unsupported blob store URL: {url}")
+
+
+def put_json(store, key, value):
+    store.put(key, json.dumps(value, separators=(',', ':')).encode('utf-8'))
+
+
+def get_json(store, key):
+    return json.loads(store.get(key))
+
+
+def put_content(store, user_email, message_id, content):
+    """
+    Store an email body and return the claim check that replaces it in messages.
+
+    Returns:
+        dict: content_ref (the blob key) and a short preview of the body.
+    """
+    content_ref = f"{user_email}/{message_id}.txt.gz"
+    store.put(content_ref, content.encode('utf-8'))
+    return {'content_ref': content_ref, 'preview': content[:PREVIEW_CHARS]}
+
+
+def load_contents(store, records, workers = READ_WORKERS):
+    """
+    Resolve the bodies of pipeline records with concurrent blob reads.
+
+    Records published before claim checks still carry 'content' inline and
+    are returned as they are.
+
+    Returns:
+        list[str]: One body per record, in order.
+    """
+    def load(record):
+        if 'content' in record:
+            return record['content']
+        return store.get(record['content_ref']).decode('utf-8')
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(load, records))
@@ -0,0 +1,320 @@
+"""
+Idempotency for the email pipeline, keyed by (user, Gmail message ID).
+
+Gmail push notifications are delivered at least once, history ranges overlap
+and Cloud Functions retry, so the same email can reach a stage more than
+once. Claims have two states:
+  in progress  taken before the work, for DEDUPE_LEASE_S only, so a run that
+               is killed mid-work (timeout, OOM) frees its keys by itself
+  done         set once the work's output was published or acked, for
+               DEDUPE_TTL_S; a key done by that stage is a duplicate and skipped
+A key another run holds in progress is busy: it is neither processed nor
+dropped, and the caller leaves it for a retry after that run finishes or its
+lease lapses. A stage that fails after claiming releases its keys so a retry
+can redo them.
+
+Each claim counts the attempts at its key, failed and killed runs included,
+so a stage can give up on an email that fails every time instead of
+retrying it forever. Releasing a key after a transient failure that was not
+the email's fault can leave the count unchanged.
+
+Claims live in the Firestore `processed_messages` collection, with a TTL
+policy on `expire_at` deleting them (gcloud firestore fields ttls update
+expire_at --collection-group=processed_messages --enable-ttl).
+DEDUPE_BACKEND=memory keeps them in process instead, for local runs.
+
+The same module is copied into every pipeline stage (fetch-latest-emails-pubsub,
+aptrack, premonotion, push-to-notion); keep the copies identical.
+"""
+import os
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+DEDUPE_BACKEND = os.getenv("DEDUPE_BACKEND", "firestore")
+# Longer than any retry or history replay, short enough to keep the collection small
+DEDUPE_TTL_S = int(os.getenv("DEDUPE_TTL_S", 7 * 24 * 3600))
+# Longer than a stage run can take: the 540 s Cloud Functions maximum timeout
+DEDUPE_LEASE_S = int(os.getenv("DEDUPE_LEASE_S", 600))
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+RELEASED = 'released'
+DEDUPE_COLLECTION = 'processed_messages'
+# Firestore batches hold at most 500 writes
+WRITE_BATCH_SIZE = 500
+
+
+class FirestoreDedupeBackend:
+    def __init__(self, db = None):
+        if db is None:
+            from google.cloud import firestore
+            db = firestore.Client()
+        self.db = db
+
+    def _ref(self, key):
+        return self.db.collection(DEDUPE_COLLECTION).document(key)
+
+    def claim(self, keys, lease_s):
+        """
+        Create in-progress claims for the keys that are free.
+
+        Returns:
+            tuple[dict, set]: The keys claimed, each with its attempt count
+            including this one, and the keys another run holds in progress.
+        """
+        from google.api_core.exceptions import Conflict, FailedPrecondition
+
+        now = datetime.now(timezone.utc)
+        snapshots = {snapshot.id: snapshot for snapshot in self.db.get_all([self._ref(key) for key in keys])
+                     if snapshot.exists}
+        existing = {key: snapshot.to_dict() for key, snapshot in snapshots.items()}
+        # The TTL sweep can lag, so expired claims still on disk count as free
+        expired = {key for key, claim in existing.items() if claim.get('expire_at', now) <= now}
+        # Released claims keep their attempt count and are taken over like expired ones
+        expired |= {key for key, claim in existing.items() if claim.get('state') == RELEASED}
+        free = [key for key in keys if key not in existing or key in expired]
+        # Claims written before there were states were taken for the full TTL; they count as done
+        busy = {key for key, claim in existing.items() if key not in expired and claim.get('state') == IN_PROGRESS}
+
+        claimed = {}
+        attempts = {key: existing.get(key, {}).get('attempts', 0) + 1 for key in free}
+
+        def fields(key):
+            return {'state': IN_PROGRESS, 'expire_at': now + timedelta(seconds=lease_s), 'claimed_at': now,
+                    'attempts': attempts[key]}
+
+        def precondition(key):
+            # An expired claim is only taken over if nobody rewrote it since it was read
+            return self.db.write_option(last_update_time=snapshots[key].update_time)
+
+        for start in range(0, len(free), WRITE_BATCH_SIZE):
+            chunk = free[start:start + WRITE_BATCH_SIZE]
+            batch = self.db.batch()
+            for key in chunk:
+                # create() fails if a concurrent stage run claimed the key first
+                if key in expired:
+                    batch.update(self._ref(key), fields(key), option=precondition(key))
+                else:
+                    batch.create(self._ref(key), fields(key))
+            try:
+                batch.commit()
+                claimed.update((key, attempts[key]) for key in chunk)
+            except (Conflict, FailedPrecondition):
+                for key in chunk:
+                    try:
+                        if key in expired:
+                            self._ref(key).update(fields(key), option=precondition(key))
+                        else:
+                            self._ref(key).create(fields(key))
+                        claimed[key] = attempts[key]
+                    except (Conflict, FailedPrecondition):
+                        # Claimed by a concurrent run a moment ago
+                        busy.add(key)
+        return claimed, busy
+
+    def complete(self, keys, ttl_s):
+        keys = list(keys)
+        now = datetime.now(timezone.utc)
+        fields = {'state': DONE, 'expire_at': now + timedelta(seconds=ttl_s), 'done_at': now}
+        for start in range(0, len(keys), WRITE_BATCH_SIZE):
+            batch = self.db.batch()
+            for key in keys[start:start + WRITE_BATCH_SIZE]:
+                batch.set(self._ref(key), fields)
+            batch.commit()
+
+    def release(self, keys, ttl_s, count_attempt = True):
+        from google.cloud import firestore
+
+        keys = list(keys)
+        now = datetime.now(timezone.utc)
+        # Kept, not deleted, so the next claim sees the attempt count
+        fields = {'state': RELEASED, 'expire_at': now + timedelta(seconds=ttl_s), 'released_at': now}
+        if not count_attempt:
+            fields['attempts'] = firestore.Increment(-1)
+        for start in range(0, len(keys), WRITE_BATCH_SIZE):
+            batch = self.db.batch()
+            for key in keys[start:start + WRITE_BATCH_SIZE]:
+                batch.set(self._ref(key), fields, merge=True)
+            batch.commit()
+
+
+class MemoryDedupeBackend:
+    """
+    Process-local stand-in for FirestoreDedupeBackend.
+    """
+
+    def __init__(self):
+        # key -> (state, expiry, attempts)
+        self.claims = {}
+        self._lock = threading.Lock()
+
+    def claim(self, keys, lease_s):
+        now = time.time()
+        claimed = {}
+        busy = set()
+        with self._lock:
+            for key in keys:
+                state, expiry, attempts = self.claims.get(key, (None, 0, 0))
+                if expiry <= now or state == RELEASED:
+                    self.claims[key] = (IN_PROGRESS, now + lease_s, attempts + 1)
+                    claimed[key] = attempts + 1
+                elif state == IN_PROGRESS:
+                    busy.add(key)
+        return claimed, busy
+
+    def complete(self, keys, ttl_s):
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                self.claims[key] = (DONE, now + ttl_s, self.claims.get(key, (None, 0, 0))[2])
+
+    def release(self, keys, ttl_s, count_attempt = True):
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                attempts = self.claims.get(key, (None, 0, 0))[2]
+                self.claims[key] = (RELEASED, now + ttl_s, attempts if count_attempt else max(attempts - 1, 0))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend(db = None):
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = MemoryDedupeBackend() if DEDUPE_BACKEND == 'memory' else FirestoreDedupeBackend(db)
+        return _backend
+
+
+class DedupeStore:
+    """
+    Claims (user, message ID) pairs for one pipeline stage and counts duplicates.
+    """
+
+    def __init__(self, stage, db = None, backend = None, ttl_s = DEDUPE_TTL_S, lease_s = DEDUPE_LEASE_S):
+        """
+        Args:
+            stage (str): Pipeline stage, e.g. 'publish' or 'premonotion'; each stage dedupes on its own.
+            db: Firestore client to reuse for the Firestore backend.
+            backend: Explicit backend, overriding DEDUPE_BACKEND.
+            ttl_s (int): How long a completed claim blocks duplicates.
+            lease_s (int): How long an in-progress claim blocks other runs.
+        """
+        self.stage = stage
+        self.backend = backend or get_backend(db)
+        self.ttl_s = ttl_s
+        self.lease_s = lease_s
+        self.seen = 0
+        self.duplicates = 0
+        self.busy = 0
+        # key -> attempt count of the claims this store took
+        self._attempts = {}
+
+    def key(self, user_email, message_id):
+        return f"{self.stage}:{user_email}:{message_id}"
+
+    def claim(self, user_email, message_ids):
+        """
+        Claim messages of one user for this stage, in progress until complete() or release().
+
+        Args:
+            user_email (str): Mailbox owner.
+            message_ids (list[str]): Gmail message IDs.
+
+        Returns:
+            tuple[list[str], list[str]]: The message IDs not handled before,
+            and those another run is handling now, each in input order.
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        if not message_ids:
+            return [], []
+        keys = {self.key(user_email, message_id): message_id for message_id in message_ids}
+        claimed, busy = self.backend.claim(list(keys), self.lease_s)
+        self._attempts.update(claimed)
+        fresh = [keys[key] for key in keys if key in claimed]
+        busy = [keys[key] for key in keys if key in busy]
+        self.seen += len(message_ids)
+        self.duplicates += len(message_ids) - len(fresh) - len(busy)
+        self.busy += len(busy)
+        return fresh, busy
+
+    def claim_records(self, records, user_field = 'email', id_field = 'message_id'):
+        """
+        Drop records whose (user, message ID) this stage has already handled.
+
+        Records without a message ID, e.g. published before IDs were
+        attached, are always kept.
+
+        Returns:
+            tuple[list[dict], list[dict]]: The records to process, and those
+            another run is handling now, which the caller must leave for a retry.
+        """
+        fresh = set()
+        busy = set()
+        for user_email, message_ids in self._by_user(records, user_field, id_field).items():
+            claimed, held = self.claim(user_email, message_ids)
+            fresh.update((user_email, message_id) for message_id in claimed)
+            busy.update((user_email, message_id) for message_id in held)
+        kept = []
+        held = []
+        for record in records:
+            key = (record.get(user_field), record.get(id_field))
+            if not record.get(id_field) or key in fresh:
+                kept.append(record)
+                fresh.discard(key)
+            elif key in busy:
+                held.append(record)
+                busy.discard(key)
+        return kept, held
+
+    def complete(self, user_email, message_ids):
+        """
+        Mark claimed messages done, so they stay duplicates for the TTL.
+        """
+        self.backend.complete([self.key(user_email, message_id) for message_id in message_ids], self.ttl_s)
+
+    def complete_records(self, records, user_field = 'email', id_field = 'message_id'):
+        for user_email, message_ids in self._by_user(records, user_field, id_field).items():
+            self.complete(user_email, message_ids)
+
+    def attempts(self, user_email, message_id):
+        """
+        Returns:
+            int: How many times the message was claimed for this stage, the
+            current claim included, or 0 if this store did not claim it.
+        """
+        return self._attempts.get(self.key(user_email, message_id), 0)
+
+    def release(self, user_email, message_ids, count_attempt = True):
+        """
+        Free claims so a retry processes the messages again.
+
+        Args:
+            count_attempt (bool): False when the failure was not the messages'
+                own, e.g. Pub/Sub was unavailable, so it does not count towards
+                giving up on them.
+        """
+        keys = [self.key(user_email, message_id) for message_id in message_ids]
+        self.backend.release(keys, self.ttl_s, count_attempt)
+
+    def release_records(self, records, user_field = 'email', id_field = 'message_id'):
+        for user_email, message_ids in self._by_user(records, user_field, id_field).items():
+            self.release(user_email, message_ids)
+
+    @staticmethod
+    def _by_user(records, user_field, id_field):
+        by_user = {}
+        for record in records:
+            if record.get(id_field):
+                by_user.setdefault(record[user_field], []).append(record[id_field])
+        return by_user
+
+    @property
+    def duplicate_rate(self):
+        return self.duplicates / self.seen if self.seen else 0.0
+
+    def summary(self):
+        return (f"dedupe[{self.stage}]: {self.duplicates}/{self.seen} duplicates ({self.duplicate_rate:.0%}), "
+                f"{self.busy} in progress elsewhere")
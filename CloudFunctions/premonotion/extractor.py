@@ -0,0 +1,70 @@
+"""
+The Gemini extraction prompt and the parsing of its response.
+
+Kept apart from main.py, which needs Vertex AI at import, so the prompt can
+be evaluated offline: LoadTest/eval_bench.py runs it against a labeled
+corpus with recorded responses standing in for the model.
+
+PROMPT lets the model answer Irrelevant; premonotion only uses it for the
+emails aptrack's opt-in cascade marks uncertain. Emails the classifier
+judged relevant get RELEVANT_PROMPT, the prompt as it was before the
+cascade, so the default path extracts exactly as it did.
+"""
+import json
+
+PROMPT = """
+I will attach a list of email bodies below, please extract the following information for each of them and provide them in the format below:
+
+title#Name of the Company that the user applied for 
+position#Position that was applied for
+deadline#Any upcoming deadlines mentioned in the email, return it in the format YYYY-MM-DD. If not mentioned, return the last date of the year.
+date_of_application#Date that the application was sent. If not present in the email body, return date today's date in YYYY-MM-DD format
+notes#Summarize in a 4-7 words the update status of this application
+status#Each email will be one of - 
+    Applied - If this is just an acknowledgement email
+    OA - If an online assessment or a test has been scheduled
+    Interview - If an interview has been scheduled
+    Offer - If there was an offer made (can be an acceptance)
+    Rejection - If the applicant was rejected.
+{irrelevant_status}
+return all this fields as a JSON object of the following form:
+{
+    title: ...,
+    position: ...,
+    deadline: ...,
+    date_of_application: ...,
+    notes: ..., 
+    status: ...
+}
+Here are the emails, each new email body starts after a "-----", return a list of all these json objects for each email body:
+"""
+IRRELEVANT_STATUS = "    Irrelevant - If the email is not about a job application the user made.\n"
+RELEVANT_PROMPT = PROMPT.replace("{irrelevant_status}", "")
+PROMPT = PROMPT.replace("{irrelevant_status}", IRRELEVANT_STATUS)
+
+
+def build_prompt(bodies, prompt = PROMPT):
+    return prompt + '-----'.join(bodies)
+
+
+def parse_response(text):
+    return json.loads(text.strip("```json\n").strip('\n```\n'))
+
+
+def extract(bodies, generate, prompt = PROMPT):
+    """
+    Extract application details from a batch of email bodies.
+
+    Args:
+        bodies (list[str]): Email bodies.
+        generate (callable): Sends a prompt to the model and returns its text.
+        prompt (str): PROMPT, or RELEVANT_PROMPT to leave out the Irrelevant status.
+
+    Returns:
+        list[dict]: One object per body, with the fields PROMPT asks for.
+    """
+    responses = parse_response(generate(build_prompt(bodies, prompt)))
+    if len(responses) != len(bodies):
+        # Misaligned results would attach details to the wrong emails
+        raise ValueError(f"Expected {len(bodies)} extractions, the model returned {len(responses)}")
+    return responses
@@ -1,59 +1,51 @@
 import base64
 import functions_framework
 import json
-from google.cloud import pubsub_v1
+from pubsub_publisher import BatchPublisher
+from dedupe_store import DedupeStore
+from blob_store import EMAIL_CONTENT_STORE, open_blob_store, load_contents
+from extractor import PROMPT, RELEVANT_PROMPT, extract
 
 import vertexai
 from vertexai.generative_models import GenerativeModel
 vertexai.init(project='midterm-440408', location='us-central1')
 
-model = GenerativeModel("gemini-1.5-flash-002") 
-prompt = """
-I will attach a list of email bodies below, please extract the following information for each of them and provide them in the format below:
-
-title#Name of the Company that the user applied for 
-position#Position that was applied for
-deadline#Any upcoming deadlines mentioned in the email, return it in the format YYYY-MM-DD. If not mentioned, return the last date of the year.
-date_of_application#Date that the application was sent. If not present in the email body, return date today's date in YYYY-MM-DD format
-notes#Summarize in a 4-7 words the update status of this application
-status#Each email will be one of - 
-    Applied - If this is just an acknowledgement email
-    OA - If an online assessment or a test has been scheduled
-    Interview - If an interview has been scheduled
-    Offer - If there was an offer made (can be an acceptance)
-    Rejection - If the applicant was rejected.
-
-return all this fields as a JSON object of the following form:
-{
-    title: ...,
-    position: ...,
-    deadline: ...,
-    date_of_application: ...,
-    notes: ..., 
-    status: ...
-}
-Here are the emails, each new email body starts after a "-----", return a list of all these json objects for each email body:
-"""
+content_store = open_blob_store(EMAIL_CONTENT_STORE)
 
-psub_client = pubsub_v1.PublisherClient()
-    
-topic_path = psub_client.topic_path('midterm-440408','processed-emails')
+model = GenerativeModel("gemini-1.5-flash-002") 
 
-def publish_message(messages):
-    try:
-        message_data = json.dumps(messages).encode("utf-8")
-        future = psub_client.publish(topic_path, data=message_data)
-        print(f"Published message ID: {future.result()}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+def call_llm(msg, prompt = RELEVANT_PROMPT):
+    return extract(msg, lambda text: model.generate_content(text).text, prompt)
 
+def extract_messages(messages):
+    """
+    Extract every message, letting the LLM judge only the uncertain ones irrelevant.
 
-def call_llm(msg):
-    # call llm with email content...
+    Emails aptrack's classifier kept as relevant go through the prompt as it
+    was before the cascade; only those its opt-in cascade marks uncertain are
+    sent, in a call of their own, with the prompt that has an Irrelevant status.
 
-    a = model.generate_content(prompt + '-----'.join(msg))
+    Returns:
+        list[dict]: One extraction per message, in order.
+    """
+    responses = [None] * len(messages)
+    for uncertain, prompt in ((False, RELEVANT_PROMPT), (True, PROMPT)):
+        indices = [i for i, msg in enumerate(messages) if (msg.get('cascade') == 'uncertain') == uncertain]
+        if not indices:
+            continue
+        # Bodies are fetched from the content store only now, when the LLM needs them
+        bodies = load_contents(content_store, [messages[i] for i in indices])
+        for i, response in zip(indices, call_llm(bodies, prompt)):
+            responses[i] = response
+    return responses
 
-    return json.loads(a.text.strip("```json\n").strip('\n```\n'))
+def retry_busy(busy):
+    """
+    Fail the event if another run is extracting some of its emails, so Pub/Sub
+    redelivers it and they are neither extracted twice nor dropped.
+    """
+    if busy:
+        raise RuntimeError(f"{len(busy)} emails are being extracted by another run; retrying the event")
 
 # Triggered from a message on a Cloud Pub/Sub topic.
 @functions_framework.cloud_event
@@ -62,20 +54,66 @@ def hello_pubsub(cloud_event):
     
     messages = json.loads(base64.b64decode(cloud_event.data["message"]["data"]))
 
-    responses = call_llm([ msg['content'] for msg in messages ])
+    # Skip emails whose extraction already ran; a redelivered batch may be all duplicates
+    dedupe = DedupeStore('premonotion')
+    messages, busy = dedupe.claim_records(messages)
+    print(dedupe.summary())
+    if not messages:
+        retry_busy(busy)
+        return
+
+    try:
+        responses = extract_messages(messages)
+    except Exception:
+        # Pub/Sub retries the event; it must not find these emails claimed
+        dedupe.release_records(messages)
+        raise
 
     print(responses)
 
+    publisher = BatchPublisher('processed-emails')
+    dropped_uncertain = 0
+    labelled = {}
+    unpublished = []
     for idx in range(len(messages)):
         msg = messages[idx]
         resp = responses[idx]
-        f = {
-            "email": msg['email'],
-            "title": resp['title'],
-            "position": resp['position'],
-            "status": resp['status'],
-            "notes": resp['notes'],
-            "deadline": resp['deadline'],
-            "data_of_application": resp['date_of_application']
-        }
-        publish_message(f)
\ No newline at end of file
+        try:
+            # aptrack forwards emails its classifier is unsure about; the LLM makes the call on those only
+            if msg.get('cascade') == 'uncertain' and resp.get('status') == 'Irrelevant':
+                dropped_uncertain += 1
+                continue
+            f = {
+                "email": msg['email'],
+                "message_id": msg.get('message_id'),
+                "title": resp['title'],
+                "position": resp['position'],
+                "status": resp['status'],
+                "notes": resp['notes'],
+                "deadline": resp['deadline'],
+                "data_of_application": resp['date_of_application']
+            }
+        except Exception as e:
+            print(f"Malformed extraction for {msg.get('message_id')}: {e}")
+            unpublished.append(msg)
+            continue
+        label = f"{msg['email']} #{idx}"
+        labelled[label] = msg
+        # Ordered per user so a later status never lands before an earlier one
+        publisher.publish(f, ordering_key=msg['email'], label=label)
+
+    _, failed = publisher.wait()
+    unpublished += [labelled[label] for label in failed]
+    # Published or judged irrelevant, so a retry of the event skips these
+    unpublished_ids = {id(msg) for msg in unpublished}
+    dedupe.complete_records([msg for msg in messages if id(msg) not in unpublished_ids])
+    if unpublished:
+        # Pub/Sub retries the event; only the emails that made it out stay claimed
+        dedupe.release_records(unpublished)
+        raise RuntimeError(f"{len(unpublished)} of {len(messages)} emails not published to processed-emails")
+
+    # Uncertain emails are the extra calls aptrack's cascade spends beyond its hard filter
+    uncertain = sum(msg.get('cascade') == 'uncertain' for msg in messages)
+    if uncertain:
+        print(f"Dropped {dropped_uncertain} of {uncertain} emails uncertain in aptrack as irrelevant")
+    retry_busy(busy)
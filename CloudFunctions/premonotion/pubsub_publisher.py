@@ -0,0 +1,117 @@
+"""
+Batched, non-blocking Pub/Sub publishing shared by the email pipeline.
+
+One PublisherClient per instance batches messages by count, size and
+latency. Each invocation publishes through its own BatchPublisher, which
+collects the publish futures and waits for them together, so a run that
+emits many messages pays for a handful of RPCs instead of one blocking round
+trip per message.
+
+The same module is copied into every function that publishes
+(fetch-latest-emails-pubsub, aptrack, premonotion); keep the copies identical.
+"""
+import os
+import json
+import time
+import threading
+
+PROJECT_ID = 'midterm-440408'
+
+PUBSUB_BATCH_MAX_MESSAGES = int(os.getenv("PUBSUB_BATCH_MAX_MESSAGES", 100))
+PUBSUB_BATCH_MAX_BYTES = int(os.getenv("PUBSUB_BATCH_MAX_BYTES", 1024 * 1024))
+PUBSUB_BATCH_MAX_LATENCY_S = float(os.getenv("PUBSUB_BATCH_MAX_LATENCY_S", 0.05))
+PUBSUB_PUBLISH_TIMEOUT_S = float(os.getenv("PUBSUB_PUBLISH_TIMEOUT_S", 60))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_publisher_client():
+    """
+    Return this instance's PublisherClient, creating it on first use.
+
+    Message ordering is enabled so messages sharing an ordering key (the
+    user's email) are delivered in publish order.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            # Imported here so the module can be used with a fake client
+            # where google-cloud-pubsub is not installed
+            from google.cloud import pubsub_v1
+            _client = pubsub_v1.PublisherClient(
+                batch_settings=pubsub_v1.types.BatchSettings(
+                    max_messages=PUBSUB_BATCH_MAX_MESSAGES,
+                    max_bytes=PUBSUB_BATCH_MAX_BYTES,
+                    max_latency=PUBSUB_BATCH_MAX_LATENCY_S
+                ),
+                publisher_options=pubsub_v1.types.PublisherOptions(enable_message_ordering=True)
+            )
+        return _client
+
+
+class BatchPublisher:
+    """
+    Publishes to one topic and waits for every publish once, in wait().
+    """
+
+    def __init__(self, topic, client = None, project_id = PROJECT_ID):
+        """
+        Args:
+            topic (str): Topic name, e.g. 'unprocessed-emails'.
+            client: A PublisherClient; defaults to the shared instance client.
+            project_id (str): Project that owns the topic.
+        """
+        self.client = client or get_publisher_client()
+        self.topic_path = self.client.topic_path(project_id, topic)
+        self._pending = []
+
+    def publish(self, data, ordering_key = '', label = None, **attributes):
+        """
+        Queue one message without waiting for it.
+
+        Args:
+            data (bytes | str | dict | list): Payload; str is UTF-8 encoded and
+                dicts and lists are sent as JSON.
+            ordering_key (str): Messages with the same key are delivered in order.
+            label (str): Identifies the message in failure reports.
+            **attributes: Pub/Sub message attributes.
+        """
+        if isinstance(data, (dict, list)):
+            data = json.dumps(data)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        label = label if label is not None else str(len(self._pending))
+        try:
+            future = self.client.publish(self.topic_path, data, ordering_key=ordering_key, **attributes)
+        except Exception as e:
+            future = e
+        self._pending.append((label, ordering_key, future))
+
+    def wait(self, timeout = PUBSUB_PUBLISH_TIMEOUT_S):
+        """
+        Wait for every queued message.
+
+        Returns:
+            tuple[list[str], dict]: Message IDs of the published messages, and
+            label -> error message for the ones that failed.
+        """
+        deadline = time.monotonic() + timeout
+        published = []
+        failed = {}
+        pending, self._pending = self._pending, []
+        for label, ordering_key, future in pending:
+            try:
+                if isinstance(future, Exception):
+                    raise future
+                published.append(future.result(timeout=max(deadline - time.monotonic(), 0)))
+            except Exception as e:
+                failed[label] = str(e)
+                # A failed ordered publish pauses its key until resumed
+                if ordering_key:
+                    self.client.resume_publish(self.topic_path, ordering_key)
+
+        print(f"Published {len(published)} message(s) to {self.topic_path}, {len(failed)} failed")
+        for label, error in failed.items():
+            print(f"Failed to publish {label}: {error}")
+        return published, failed
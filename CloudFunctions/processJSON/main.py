@@ -6,6 +6,7 @@ import hashlib
 import requests
 import functions_framework
 from random import randrange
+from datetime import datetime
 
 from flask import jsonify, request
 from google.cloud import aiplatform_v1beta1
@@ -803,6 +804,7 @@ def process_and_store_embeddings(request):
             chunks = create_overlapping_character_chunks(page["content"], chunk_size, overlap)
 
             # Generate embeddings and prepare metadata
+            page_embeddings = []
             for idx, chunk in enumerate(chunks, start=1):
                 datapoint_id = f"{email}-{page_id}-{idx}"  # Generate unique datapoint_id
                 embedding = embed_text([chunk])[0]  # Generate embedding for the chunk
@@ -813,9 +815,23 @@ def process_and_store_embeddings(request):
                     "content": chunk,
                     "page_title": page["page_title"],
                     "last_updated": page["last_updated"],
-                    "datapoint_id": datapoint_id
+                    "datapoint_id": datapoint_id,
+                    "datapoint_type": "chunk"
                 })
                 all_embeddings.append(embedding)
+                page_embeddings.append(embedding)
+
+            # Page-level vector used by processquery to shortlist pages before searching chunks
+            if page_embeddings:
+                all_chunks_metadata.append({
+                    "user_email": email,
+                    "page_id": page_id,
+                    "page_title": page["page_title"],
+                    "last_updated": page["last_updated"],
+                    "datapoint_id": f"{email}-{page_id}-page",
+                    "datapoint_type": "page"
+                })
+                all_embeddings.append(mean_embedding(page_embeddings))
 
         # Upload embeddings to Matching Engine
         status = upload_embeddings_v2(all_chunks_metadata, all_embeddings, project_id, region, index_id)
@@ -845,12 +861,38 @@ def create_overlapping_character_chunks(input_text, chunk_size, overlap):
     return chunks
 
 
+def notion_time_to_epoch(timestamp):
+    """
+    Convert a Notion ISO 8601 timestamp (e.g. "2024-12-01T10:00:00.000Z") to epoch seconds.
+    """
+    return int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp())
+
+
+def mean_embedding(embeddings):
+    """
+    Compute the normalized mean of a list of embedding vectors.
+
+    Args:
+        embeddings (list[list[float]]): Chunk embeddings of a single page.
+
+    Returns:
+        list[float]: Unit-length centroid of the given vectors.
+    """
+    dims = len(embeddings[0])
+    centroid = [sum(vector[d] for vector in embeddings) / len(embeddings) for d in range(dims)]
+    norm = sum(value * value for value in centroid) ** 0.5
+    if norm == 0:
+        return centroid
+    return [value / norm for value in centroid]
+
+
 def upload_embeddings_v2(json_data, embeddings, project_id, region, index_id):
     """
     Upload embeddings to Google Cloud Matching Engine.
 
     Args:
         json_data (list): Original data with metadata (user_email, page_title, content, last_updated, etc.).
+            Entries with datapoint_type "page" carry no content and hold the page-level vector.
         embeddings (list): List of generated embeddings.
         project_id (str): GCP project ID.
         region (str): GCP region.
@@ -866,18 +908,28 @@ def upload_embeddings_v2(json_data, embeddings, project_id, region, index_id):
     print(json_data)
     for i, item in enumerate(json_data):
         datapoint_id = item["datapoint_id"]
+        datapoint_type = item.get("datapoint_type", "chunk")
 
         restrictions = [
             IndexDatapoint.Restriction(namespace="page_title", allow_list=[item["page_title"]]),
-            IndexDatapoint.Restriction(namespace="content", allow_list=[item["content"]]),
-            IndexDatapoint.Restriction(namespace="last_updated", allow_list=[item["last_updated"]]),
-            IndexDatapoint.Restriction(namespace="user_email", allow_list=[item["user_email"]])
+            IndexDatapoint.Restriction(namespace="user_email", allow_list=[item["user_email"]]),
+            IndexDatapoint.Restriction(namespace="datapoint_type", allow_list=[datapoint_type])
         ]
+        if datapoint_type == "chunk":
+            restrictions.append(IndexDatapoint.Restriction(namespace="content", allow_list=[item["content"]]))
+
+        # Numeric so processquery can push date-range filters into the vector search
+        numeric_restrictions = []
+        if item["last_updated"]:
+            numeric_restrictions.append(
+                IndexDatapoint.NumericRestriction(namespace="last_updated", value_int=notion_time_to_epoch(item["last_updated"]))
+            )
 
         datapoint = IndexDatapoint(
             datapoint_id=datapoint_id,
             feature_vector=embeddings[i],
-            restricts=restrictions
+            restricts=restrictions,
+            numeric_restricts=numeric_restrictions
         )
         print(f"Datapoints: {datapoint}")
         datapoints.append(datapoint)
@@ -0,0 +1,87 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent calls into batched calls.
+
+    Requests submitted from different threads are collected until either
+    `max_batch_size` items are waiting or `max_wait_ms` milliseconds have
+    passed since the first one arrived. The whole batch is then handed to
+    `batch_fn`, and each caller receives the result at its own position.
+    Up to `max_concurrency` batches run at once, so one slow call does not
+    hold up the batches queued behind it.
+    """
+
+    def __init__(self, batch_fn, max_batch_size = 16, max_wait_ms = 10, max_concurrency = 4):
+        """
+        Args:
+            batch_fn (callable): Takes a list of items and returns a list of
+                results of the same length and order.
+            max_batch_size (int): Maximum number of items per batch.
+            max_wait_ms (float): Maximum time the first item of a batch waits
+                for company before the batch is flushed.
+            max_concurrency (int): Maximum number of batches in flight.
+        """
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(max_concurrency)
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="batch")
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, item):
+        """
+        Add an item to the next batch and block until its result is ready.
+
+        Args:
+            item: A single input for `batch_fn`.
+
+        Returns:
+            The result of `batch_fn` for this item. Exceptions raised by
+            `batch_fn` are re-raised in every caller of the batch.
+        """
+        future = Future()
+        self._queue.put((item, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Wait for a free slot first, so items keep accumulating into the
+            # next batch while every slot is busy
+            self._slots.acquire()
+            batch = self._collect()
+            self._pool.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = list(self.batch_fn(items))
+            if len(results) != len(batch):
+                # zip would leave the callers without a result blocked forever
+                raise ValueError(f"batch_fn returned {len(results)} results for {len(batch)} items")
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        finally:
+            self._slots.release()
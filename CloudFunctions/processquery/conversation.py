@@ -0,0 +1,162 @@
+import datetime
+
+# Rough token estimate used for budgeting prompts without an extra count_tokens call
+CHARS_PER_TOKEN = 4
+
+REFORMULATE_PROMPT = """Rewrite the follow-up question so it can be understood without the conversation.
+Keep it short and keep every subject, name or term it refers to. Return only the rewritten question.
+
+Conversation summary:
+{summary}
+
+Recent turns:
+{turns}
+
+Follow-up question: {query}
+"""
+
+SUMMARIZE_PROMPT = """Update the running summary of a conversation between a student and a notes assistant
+with the exchanges below. Keep the topics, definitions and open questions that later questions may refer to.
+Return only the new summary, in at most {max_words} words.
+
+Current summary:
+{summary}
+
+New exchanges:
+{turns}
+"""
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def truncate_to_tokens(text, max_tokens, keep_end = False):
+    """
+    Cut text down to roughly max_tokens tokens, keeping its start, or its end with keep_end.
+    """
+    max_chars = max(0, max_tokens) * CHARS_PER_TOKEN
+    if keep_end:
+        return text[-max_chars:] if max_chars else ""
+    return text[:max_chars]
+
+
+def format_turns(turns):
+    return "\n".join(f"Student: {turn['user']}\nAssistant: {turn['assistant']}" for turn in turns)
+
+
+def load_conversation(db, conversation_id):
+    """
+    Read the stored state of a conversation.
+
+    Returns:
+        dict: {"summary": str, "turns": list[dict]}, empty for a new conversation.
+    """
+    doc = db.collection('conversations').document(conversation_id).get()
+    if doc.exists:
+        state = doc.to_dict()
+        return {"summary": state.get("summary", ""), "turns": state.get("turns", [])}
+    return {"summary": "", "turns": []}
+
+
+def save_conversation(db, conversation_id, state):
+    # updated_at lets a Firestore TTL policy expire abandoned conversations
+    db.collection('conversations').document(conversation_id).set({
+        "summary": state["summary"],
+        "turns": state["turns"],
+        "updated_at": datetime.datetime.now(datetime.timezone.utc)
+    })
+
+
+def build_context(state, max_tokens):
+    """
+    Render the conversation for the answer prompt within a token budget.
+
+    The most recent turns are kept first, then the summary, so the budget is
+    spent on what a follow-up is most likely to refer to.
+
+    Returns:
+        str: Conversation context, empty if there is no history.
+    """
+    parts = []
+    remaining = max_tokens
+    for turn in reversed(state["turns"]):
+        rendered = format_turns([turn])
+        if estimate_tokens(rendered) > remaining:
+            break
+        parts.insert(0, rendered)
+        remaining -= estimate_tokens(rendered)
+
+    if state["summary"] and remaining > 0:
+        parts.insert(0, "Summary of earlier conversation: " + truncate_to_tokens(state["summary"], remaining))
+
+    return "\n".join(parts)
+
+
+def reformulate_query(generate, state, query):
+    """
+    Turn a follow-up like "explain that again with an example" into a standalone
+    question so its embedding retrieves the right notes.
+
+    Args:
+        generate (callable): Sends a prompt to Gemini and returns the response.
+
+    Returns:
+        str: The standalone question, or the original query for a new conversation.
+    """
+    if not state["summary"] and not state["turns"]:
+        return query
+
+    response = generate(REFORMULATE_PROMPT.format(
+        summary=state["summary"] or "(none)",
+        turns=format_turns(state["turns"]) or "(none)",
+        query=query
+    ))
+    return response.text.strip() or query
+
+
+def summarize_turns(generate, summary, turns, summary_max_tokens):
+    """
+    Fold turns into the rolling summary with one generation call.
+
+    Args:
+        generate (callable): Sends a prompt to Gemini and returns the response.
+
+    Returns:
+        str: The new summary.
+    """
+    response = generate(SUMMARIZE_PROMPT.format(
+        max_words=summary_max_tokens * 3 // 4,
+        summary=summary or "(empty)",
+        turns=format_turns(turns)
+    ))
+    return truncate_to_tokens(response.text.strip(), summary_max_tokens)
+
+
+def add_turn(state, query, answer, max_turns, summarize):
+    """
+    Append a turn and fold the turns that fall out of the verbatim window into
+    the rolling summary.
+
+    If summarize fails, e.g. because the request ran out of time, the turns
+    stay verbatim and a later request folds them; beyond twice the window the
+    oldest are dropped, so the stored state stays bounded either way.
+
+    Args:
+        summarize (callable): Takes the current summary and the turns to fold
+            and returns the new summary.
+
+    Returns:
+        dict: The updated state.
+    """
+    state["turns"].append({"user": query, "assistant": answer})
+    overflow = state["turns"][:-max_turns] if len(state["turns"]) > max_turns else []
+    if overflow:
+        try:
+            # Applied only once it returns, so a call that outlives its timeout cannot touch the state
+            state["summary"] = summarize(state["summary"], overflow)
+            state["turns"] = state["turns"][len(overflow):]
+        except Exception as e:
+            print(f"Could not summarize {len(overflow)} turns, keeping them verbatim: {e}")
+            state["turns"] = state["turns"][-2 * max_turns:]
+    return state
@@ -0,0 +1,158 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from google.api_core import exceptions as api_exceptions
+
+from metrics import HEDGED_CALLS
+
+# Requests one instance serves at once, and attempts per hedged stage
+INSTANCE_CONCURRENCY = int(os.getenv("INSTANCE_CONCURRENCY", "32"))
+HEDGE_MAX_ATTEMPTS = int(os.getenv("HEDGE_MAX_ATTEMPTS", "2"))
+
+# Only stages without a client-side timeout run here. A request has one stage
+# in flight, so this size keeps attempts from queueing behind each other even
+# when every request is hedging; attempts that lose a hedge keep their thread
+# until they finish on their own.
+_executor = ThreadPoolExecutor(max_workers=INSTANCE_CONCURRENCY * HEDGE_MAX_ATTEMPTS, thread_name_prefix="hedge")
+
+
+class QueryError(Exception):
+    """
+    Failure of one stage of the query path, returned to the client as JSON.
+    """
+    status = 500
+    code = "internal_error"
+    message = "There was an error generating a response."
+
+    def __init__(self, stage, detail = ""):
+        super().__init__(f"{self.code} in {stage}: {detail}")
+        self.stage = stage
+        self.detail = detail
+
+    def to_response(self):
+        return {"response": self.message, "error": self.code, "stage": self.stage}
+
+
+class DeadlineExceeded(QueryError):
+    status = 504
+    code = "deadline_exceeded"
+    message = "Searching your notes is taking too long right now. Please try again."
+
+
+class UpstreamError(QueryError):
+    status = 502
+    code = "upstream_error"
+    message = "We couldn't reach the notes service. Please try again."
+
+
+class NoRelevantNotes(QueryError):
+    status = 200
+    code = "no_relevant_notes"
+    message = "Oops! Unfortunately we don't have any relevant data that we could pull from your notes!\nTry updating your notes!"
+
+
+class Deadline:
+    """
+    Time budget of one request, shared by all of its stages.
+    """
+
+    def __init__(self, budget_s, stage_timeouts_s = None):
+        """
+        Args:
+            budget_s (float): Total time the request may take.
+            stage_timeouts_s (dict[str, float]): Upper bound per stage. Stages
+                not listed may use whatever is left of the budget.
+        """
+        self.expires_at = time.monotonic() + budget_s
+        self.stage_timeouts_s = stage_timeouts_s or {}
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def stage_timeout(self, stage):
+        return min(self.remaining(), self.stage_timeouts_s.get(stage, float("inf")))
+
+
+def call_in_thread(stage, fn, timeout):
+    """
+    Call fn in the calling thread, passing it the timeout to enforce itself.
+
+    Meant for calls whose client takes a deadline (e.g. a gRPC timeout), so
+    nothing waits in a shared pool and nothing outlives the timeout.
+
+    Args:
+        stage (str): Stage name reported in errors.
+        fn (callable): Takes the timeout in seconds.
+        timeout (float): Seconds the call may take.
+
+    Raises:
+        DeadlineExceeded: If the call timed out.
+        UpstreamError: If the call failed.
+    """
+    if timeout <= 0:
+        raise DeadlineExceeded(stage, "no time left in the request budget")
+    try:
+        return fn(timeout)
+    except QueryError:
+        raise
+    except (api_exceptions.DeadlineExceeded, TimeoutError) as e:
+        raise DeadlineExceeded(stage, f"no response within {timeout:.2f}s") from e
+    except Exception as e:
+        raise UpstreamError(stage, str(e)) from e
+
+
+def call_with_deadline(stage, fn, timeout, hedge_after = None, max_attempts = 1):
+    """
+    Call fn within a timeout, optionally hedging it.
+
+    If the first attempt has not returned after `hedge_after` seconds, or has
+    failed, another attempt is started, up to `max_attempts`. The first
+    successful result wins. Only use hedging for idempotent calls.
+
+    Args:
+        stage (str): Stage name reported in errors and metrics.
+        fn (callable): Zero-argument call to make.
+        timeout (float): Seconds before giving up on every attempt.
+        hedge_after (float): Seconds to wait before starting another attempt.
+        max_attempts (int): Total number of attempts allowed.
+
+    Returns:
+        The result of the first successful attempt.
+
+    Raises:
+        DeadlineExceeded: If no attempt succeeded within the timeout.
+        UpstreamError: If every attempt failed.
+    """
+    if timeout <= 0:
+        raise DeadlineExceeded(stage, "no time left in the request budget")
+
+    start = time.monotonic()
+    expires_at = start + timeout
+    pending = {_executor.submit(fn)}
+    attempts = 1
+    last_error = None
+
+    while pending:
+        wake_at = expires_at
+        if hedge_after is not None and attempts < max_attempts:
+            wake_at = min(wake_at, start + hedge_after * attempts)
+        done, pending = wait(pending, timeout=max(0.0, wake_at - time.monotonic()), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            if future.exception() is None:
+                return future.result()
+            last_error = future.exception()
+            print(f"Attempt of {stage} failed: {last_error}")
+
+        now = time.monotonic()
+        if now >= expires_at:
+            raise DeadlineExceeded(stage, f"no response within {timeout:.2f}s")
+
+        hedge_due = hedge_after is not None and now >= start + hedge_after * attempts
+        if attempts < max_attempts and (hedge_due or not pending):
+            pending.add(_executor.submit(fn))
+            attempts += 1
+            HEDGED_CALLS.labels(stage).inc()
+
+    raise UpstreamError(stage, str(last_error)) from last_error
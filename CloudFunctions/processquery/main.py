@@ -3,15 +3,78 @@ import vertexai
 from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel, TextGenerationModel, ChatModel
 from vertexai.generative_models import GenerativeModel
 from google.cloud import aiplatform
-from google.cloud.aiplatform_v1beta1.types import IndexDatapoint, UpsertDatapointsRequest
+from google.cloud import firestore
+from google.cloud.aiplatform_v1beta1.types import IndexDatapoint, UpsertDatapointsRequest, FindNeighborsRequest
 from google.cloud.aiplatform_v1beta1.services.index_service import IndexServiceClient
-from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace
+from google.cloud.aiplatform_v1beta1.services.match_service import MatchServiceClient
+from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import Namespace, NumericNamespace, MatchNeighbor
+import os
 import hashlib
 import json
+from datetime import datetime, timezone
 from flask import jsonify, request
+from batcher import MicroBatcher
+from metrics import timed, record_tokens, start_request, finish_request, metrics_response, REQUEST_ID_HEADER
+from deadlines import Deadline, QueryError, NoRelevantNotes, call_with_deadline, call_in_thread, HEDGE_MAX_ATTEMPTS
+from conversation import load_conversation, save_conversation, build_context, reformulate_query, add_turn, summarize_turns, estimate_tokens, truncate_to_tokens
 
 model = GenerativeModel("gemini-1.5-flash-002")
 
+# generate_content goes through these private GenerativeModel internals of the
+# SDK version pinned in requirements.txt; fail at startup, not on the first
+# request, if an upgrade removes them
+GENERATE_CONTENT_INTERNALS = ("_prepare_request", "_prediction_client", "_parse_response")
+missing_internals = [name for name in GENERATE_CONTENT_INTERNALS if not hasattr(type(model), name)]
+if missing_internals:
+    raise ImportError(f"GenerativeModel has no {', '.join(missing_internals)}; update generate_content for this SDK version")
+
+# "flat" searches every chunk of the user, "two_stage" shortlists pages first (A/B switch)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "flat")
+PAGE_SHORTLIST_SIZE = int(os.getenv("PAGE_SHORTLIST_SIZE", "3"))
+
+# Coalesce concurrent requests into batched embedding / find_neighbors calls
+QUERY_BATCHING = os.getenv("QUERY_BATCHING", "0") == "1"
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "16"))
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "10"))
+QUERY_BATCH_MAX_CONCURRENCY = int(os.getenv("QUERY_BATCH_MAX_CONCURRENCY", "4"))
+
+# Conversation memory: last turns kept verbatim, older ones folded into a rolling summary
+CONVERSATION_MAX_TURNS = int(os.getenv("CONVERSATION_MAX_TURNS", "3"))
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", "300"))
+CONVERSATION_CONTEXT_MAX_TOKENS = int(os.getenv("CONVERSATION_CONTEXT_MAX_TOKENS", "800"))
+# Hard cap on the answer prompt; the question, the conversation and the
+# retrieved text are truncated to fit, in that order of priority
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "4000"))
+MAX_QUESTION_TOKENS = int(os.getenv("MAX_QUESTION_TOKENS", "500"))
+
+# Per-request time budget, upper bounds per stage and hedging of idempotent calls
+REQUEST_DEADLINE_S = float(os.getenv("REQUEST_DEADLINE_S", "25"))
+STAGE_TIMEOUTS_S = {
+    "endpoint_init": 3,
+    "reformulation": 3,
+    "summarization": 3,
+    "embedding": 2,
+    "find_neighbors": 2,
+    "read_index_datapoints": 2,
+}
+HEDGING = os.getenv("HEDGING", "1") == "1"
+HEDGE_DELAYS_S = {
+    "endpoint_init": 0.5,
+    "embedding": 0.3,
+    "find_neighbors": 0.25,
+    "read_index_datapoints": 0.25,
+}
+
+match_clients = {}
+index_endpoints = {}
+db = None
+
+def get_db():
+    global db
+    if db is None:
+        db = firestore.Client()
+    return db
+
 def embed_text(input_text, task = "QUESTION_ANSWERING") -> list[list[float]]:
     """
     Generate embeddings for a user query using Vertex AI Model Garden's pre-trained model.
@@ -34,7 +97,231 @@ def embed_text(input_text, task = "QUESTION_ANSWERING") -> list[list[float]]:
     return [embedding.values for embedding in embeddings]
 
 
-def query_user_embeddings(user_email, query_embedding, project_id, region, endpoint_id, index_id, top_k = 5):
+def find_neighbors_batch(items):
+    """
+    Run several nearest-neighbor queries, each with its own filter, in as few
+    Matching Engine round trips as possible.
+
+    The SDK's find_neighbors applies one filter to every query, so this goes
+    through the MatchService API directly where restricts are set per query.
+
+    Args:
+        items (list[dict]): Queries with keys index_endpoint, index_id,
+            query_embedding, filter (list[Namespace]), numeric_filter
+            (list[NumericNamespace]), num_neighbors and return_full_datapoint.
+
+    Returns:
+        list[list[MatchNeighbor]]: Neighbors for each query, in input order.
+    """
+    results = [None] * len(items)
+
+    # return_full_datapoint is per request, so at most one call per endpoint and flag
+    groups = {}
+    for pos, item in enumerate(items):
+        key = (item["index_endpoint"].resource_name, item["index_id"], item["return_full_datapoint"])
+        groups.setdefault(key, []).append(pos)
+
+    for (endpoint_name, index_id, return_full_datapoint), positions in groups.items():
+        index_endpoint = items[positions[0]]["index_endpoint"]
+        domain = index_endpoint.public_endpoint_domain_name
+        if domain not in match_clients:
+            match_clients[domain] = MatchServiceClient(client_options={"api_endpoint": domain})
+
+        queries = [
+            FindNeighborsRequest.Query(
+                datapoint=IndexDatapoint(
+                    datapoint_id=str(pos),
+                    feature_vector=items[pos]["query_embedding"],
+                    restricts=[
+                        IndexDatapoint.Restriction(namespace=ns.name, allow_list=ns.allow_tokens, deny_list=ns.deny_tokens)
+                        for ns in items[pos]["filter"]
+                    ],
+                    numeric_restricts=[
+                        IndexDatapoint.NumericRestriction(
+                            namespace=ns.name,
+                            value_int=ns.value_int,
+                            op=IndexDatapoint.NumericRestriction.Operator[ns.op]
+                        )
+                        for ns in items[pos]["numeric_filter"]
+                    ]
+                ),
+                neighbor_count=items[pos]["num_neighbors"]
+            )
+            for pos in positions
+        ]
+        response = match_clients[domain].find_neighbors(FindNeighborsRequest(
+            index_endpoint=endpoint_name,
+            deployed_index_id=index_id,
+            queries=queries,
+            return_full_datapoint=return_full_datapoint
+        ))
+
+        if len(response.nearest_neighbors) != len(positions):
+            raise ValueError(f"find_neighbors returned {len(response.nearest_neighbors)} results for {len(positions)} queries")
+        for pos, nearest in zip(positions, response.nearest_neighbors):
+            results[pos] = [
+                MatchNeighbor(
+                    id=neighbor.datapoint.datapoint_id,
+                    distance=neighbor.distance,
+                    restricts=[
+                        Namespace(restrict.namespace, list(restrict.allow_list), list(restrict.deny_list))
+                        for restrict in neighbor.datapoint.restricts
+                    ]
+                )
+                for neighbor in nearest.neighbors
+            ]
+    return results
+
+
+embedding_batcher = MicroBatcher(embed_text, QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT_MS, QUERY_BATCH_MAX_CONCURRENCY) if QUERY_BATCHING else None
+neighbor_batcher = MicroBatcher(find_neighbors_batch, QUERY_BATCH_MAX_SIZE, QUERY_BATCH_MAX_WAIT_MS, QUERY_BATCH_MAX_CONCURRENCY) if QUERY_BATCHING else None
+
+
+def call_stage(stage, fn, deadline):
+    """
+    Run one stage of the query path within its share of the request deadline,
+    hedging it when it is idempotent (listed in HEDGE_DELAYS_S).
+    """
+    if HEDGING and stage in HEDGE_DELAYS_S:
+        return call_with_deadline(stage, fn, deadline.stage_timeout(stage), HEDGE_DELAYS_S[stage], HEDGE_MAX_ATTEMPTS)
+    return call_with_deadline(stage, fn, deadline.stage_timeout(stage))
+
+
+def generate_content(prompt, timeout):
+    """
+    model.generate_content with a client-side deadline.
+
+    The SDK method takes no timeout, so this makes the same three steps it
+    does (prepare the request, call the prediction client, parse the
+    response) and passes the timeout to the RPC.
+    """
+    request = model._prepare_request(contents=prompt)
+    return model._parse_response(model._prediction_client.generate_content(request=request, timeout=timeout))
+
+
+def generate_stage(stage, prompt_fn, deadline):
+    """
+    Run a Gemini stage in the request thread, bounded by its share of the deadline.
+
+    Args:
+        prompt_fn (callable): Takes a generate(prompt) function and returns the stage's result.
+    """
+    return call_in_thread(stage, lambda timeout: prompt_fn(lambda prompt: generate_content(prompt, timeout)),
+                          deadline.stage_timeout(stage))
+
+
+def embed_query(text, deadline):
+    """
+    Embed a single query, sharing the embedding call with concurrent requests when batching is on.
+    """
+    def embed():
+        if embedding_batcher:
+            return embedding_batcher.submit(text)
+        return embed_text([text])[0]
+
+    with timed("embedding"):
+        return call_stage("embedding", embed, deadline)
+
+
+def find_user_neighbors(index_endpoint, index_id, query_embedding, filter_list, num_neighbors, return_full_datapoint = False, numeric_filter = None):
+    """
+    Find neighbors of a single query, sharing the find_neighbors call with concurrent requests when batching is on.
+
+    Returns:
+        list[MatchNeighbor]: Neighbors of the query, closest first.
+    """
+    if neighbor_batcher:
+        return neighbor_batcher.submit({
+            "index_endpoint": index_endpoint,
+            "index_id": index_id,
+            "query_embedding": query_embedding,
+            "filter": filter_list,
+            "numeric_filter": numeric_filter or [],
+            "num_neighbors": num_neighbors,
+            "return_full_datapoint": return_full_datapoint
+        })
+
+    response = index_endpoint.find_neighbors(
+        deployed_index_id=index_id,
+        queries=[query_embedding],
+        num_neighbors=num_neighbors,
+        filter=filter_list,
+        numeric_filter=numeric_filter or [],
+        return_full_datapoint=return_full_datapoint
+    )
+    return response[0]
+
+
+def parse_query_filters(filters):
+    """
+    Turn the optional "filters" object of a query into index filters.
+
+    Args:
+        filters (dict): May contain "page_titles" (list[str]) and "updated_after" /
+            "updated_before" (ISO 8601 dates or datetimes, UTC if no offset is given).
+
+    Returns:
+        tuple[list[str], list[NumericNamespace]]: Page titles to restrict to and
+        numeric filters on the last_updated restrict.
+
+    Raises:
+        ValueError: If a filter has the wrong type or an unparseable date.
+    """
+    filters = filters or {}
+    page_titles = filters.get("page_titles") or []
+    if not isinstance(page_titles, list) or not all(isinstance(title, str) for title in page_titles):
+        raise ValueError("filters.page_titles must be a list of strings")
+
+    numeric_filter = []
+    for key, op in (("updated_after", "GREATER_EQUAL"), ("updated_before", "LESS")):
+        if filters.get(key):
+            try:
+                timestamp = datetime.fromisoformat(filters[key].replace("Z", "+00:00"))
+            except (AttributeError, ValueError):
+                raise ValueError(f"filters.{key} must be an ISO 8601 date")
+            if timestamp.tzinfo is None:
+                timestamp = timestamp.replace(tzinfo=timezone.utc)
+            numeric_filter.append(NumericNamespace(name="last_updated", value_int=int(timestamp.timestamp()), op=op))
+
+    return page_titles, numeric_filter
+
+
+def shortlist_user_pages(index_endpoint, index_id, user_email, query_embedding, deadline, num_pages = 3, numeric_filter = None):
+    """
+    First stage of two-stage retrieval: find the pages closest to the query
+    using the page-level vectors written by processJSON.
+
+    Args:
+        index_endpoint (MatchingEngineIndexEndpoint): Endpoint serving the index.
+        index_id (str): Deployed index ID.
+        user_email (str): The email of the user whose pages to search.
+        query_embedding (list[float]): Embedding of the user query.
+        deadline (Deadline): Time budget of the request.
+        num_pages (int): Number of pages to shortlist.
+        numeric_filter (list[NumericNamespace]): Date-range filters on last_updated.
+
+    Returns:
+        list[str]: Titles of the shortlisted pages, closest first. Empty if the
+        user has no page-level vectors yet.
+    """
+    filter_list = [
+        Namespace("user_email", [user_email], []),
+        Namespace("datapoint_type", ["page"], [])
+    ]
+    with timed("page_shortlist"):
+        neighbors = call_stage("find_neighbors", lambda: find_user_neighbors(
+            index_endpoint, index_id, query_embedding, filter_list, num_pages, return_full_datapoint=True, numeric_filter=numeric_filter
+        ), deadline)
+
+    page_titles = []
+    for neighbor in neighbors:
+        for restrict in neighbor.restricts or []:
+            if restrict.name == "page_title":
+                page_titles.extend(restrict.allow_tokens)
+    return list(dict.fromkeys(page_titles))
+
+
+def query_user_embeddings(user_email, query_embedding, project_id, region, endpoint_id, index_id, deadline, top_k = 5, retrieval_mode = "flat", page_titles = None, numeric_filter = None):
     """
     Query embeddings for a specific user and perform similarity search.
 
@@ -44,14 +331,27 @@ def query_user_embeddings(user_email, query_embedding, project_id, region, endpo
         project_id (str): GCP project ID.
         region (str): GCP region.
         index_id (str): Matching Engine Index ID.
+        deadline (Deadline): Time budget of the request.
         top_k (int): Number of top results to retrieve.
+        retrieval_mode (str): "flat" to search all chunks of the user, or "two_stage"
+            to search only chunks of the pages shortlisted by shortlist_user_pages.
+        page_titles (list[str]): Only search chunks of these pages. Skips the shortlist stage.
+        numeric_filter (list[NumericNamespace]): Date-range filters on last_updated.
 
     Returns:
-        list[dict]: Top-K similar embeddings with metadata.
+        str: Contents of the closest chunk.
+
+    Raises:
+        NoRelevantNotes: If nothing in the user's notes matches.
+        QueryError: If a Vertex call fails or runs out of time.
     """
     aiplatform.init(project=project_id, location=region)
     vertexai.init(project=project_id, location=region)
-    index_endpoint = aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=f"projects/{project_id}/locations/{region}/indexEndpoints/{endpoint_id}")
+    endpoint_name = f"projects/{project_id}/locations/{region}/indexEndpoints/{endpoint_id}"
+    if endpoint_name not in index_endpoints:
+        with timed("endpoint_init"):
+            index_endpoints[endpoint_name] = call_stage("endpoint_init", lambda: aiplatform.MatchingEngineIndexEndpoint(index_endpoint_name=endpoint_name), deadline)
+    index_endpoint = index_endpoints[endpoint_name]
 
     #Filter out by emails
     filter_list = [
@@ -59,32 +359,42 @@ def query_user_embeddings(user_email, query_embedding, project_id, region, endpo
         "user_email",  # The metadata field to filter on
         [user_email],  # The allowed values for this namespace
         []  # Deny list can be empty if not used
-        )
+        ),
+    # Page-level vectors only take part in the shortlist stage
+    Namespace("datapoint_type", [], ["page"])
     ]
-    try:
-        response = index_endpoint.find_neighbors(
-            deployed_index_id=index_id,
-            queries=[query_embedding],
-            num_neighbors=top_k,
-            filter=filter_list
-        )
-
-        #print(response)
-
-        results = [
-            {
-                "datapoint_id": neighbor.id,
-                "distance": neighbor.distance
-            }
-            for neighbor in response[0]
-        ]
-    except:
-        print("Oops! Unfortunately we don't have any relevant data that we could pull from your notes!\nTry updating your notes!")
-        return "Oops! Unfortunately we don't have any relevant data that we could pull from your notes!\nTry updating your notes!"
+    if page_titles:
+        filter_list.append(Namespace("page_title", page_titles, []))
+    elif retrieval_mode == "two_stage":
+        page_titles = shortlist_user_pages(index_endpoint, index_id, user_email, query_embedding, deadline, PAGE_SHORTLIST_SIZE, numeric_filter)
+        print(f"Shortlisted pages: {page_titles}")
+        # Fall back to flat search for users whose pages have no page-level vector yet
+        if page_titles:
+            filter_list.append(Namespace("page_title", page_titles, []))
+
+    with timed("find_neighbors"):
+        neighbors = call_stage("find_neighbors", lambda: find_user_neighbors(
+            index_endpoint, index_id, query_embedding, filter_list, top_k, numeric_filter=numeric_filter
+        ), deadline)
+
+    #print(response)
+
+    results = [
+        {
+            "datapoint_id": neighbor.id,
+            "distance": neighbor.distance
+        }
+        for neighbor in neighbors
+    ]
+    if not results:
+        raise NoRelevantNotes("find_neighbors", f"no neighbors for {user_email}")
 
     neighbor_ids = [result["datapoint_id"] for result in results]
     
-    contents = index_endpoint.read_index_datapoints(deployed_index_id=index_id, ids=neighbor_ids)
+    with timed("read_index_datapoints"):
+        contents = call_stage("read_index_datapoints", lambda: index_endpoint.read_index_datapoints(
+            deployed_index_id=index_id, ids=neighbor_ids
+        ), deadline)
 
     cleaned_response = []
     for datapoint in contents:
@@ -95,15 +405,19 @@ def query_user_embeddings(user_email, query_embedding, project_id, region, endpo
                     "contents": entry.allow_list[0]         # Include metadata
                 }
                 cleaned_response.append(cleaned_datapoint)
+    if not cleaned_response:
+        raise NoRelevantNotes("read_index_datapoints", f"no content for {neighbor_ids}")
     print(cleaned_response[0])
     return cleaned_response[0]['contents']
 
-def get_llm_output(text, query):
+def get_llm_output(text, query, deadline, conversation_context = ""):
     """
     Generate output from Vertex AI's pre-trained PaLM model.
 
     Args:
         text (str): The input text to feed into the LLM.
+        deadline (Deadline): Time budget of the request; generation gets whatever is left.
+        conversation_context (str): Earlier conversation, already bounded by build_context.
 
     Returns:
         str: The LLM's generated output.
@@ -112,9 +426,26 @@ def get_llm_output(text, query):
         prompt = """ You are a helpful generative model that will use the text and try to answer the query. Do not halluicnate, stay relevant to the query. \n Here is the query to be processed:- \n
         """
         text_prompt = """\nThis is the relevant text from which you need to answer the query:- \n"""
+        history_prompt = """\nThis is the conversation so far, use it only to resolve what the query refers to:- \n"""
 
-        a = model.generate_content(prompt + query[0] + text_prompt + text)
+        # Everything but the fixed instructions is truncated, so the prompt never exceeds MAX_PROMPT_TOKENS
+        budget = MAX_PROMPT_TOKENS - estimate_tokens(prompt + text_prompt + (history_prompt if conversation_context else ""))
+        question = truncate_to_tokens(query[0], min(MAX_QUESTION_TOKENS, budget))
+        budget -= estimate_tokens(question)
+        # The most recent turns are at the end of the context
+        history = truncate_to_tokens(conversation_context, budget // 2, keep_end=True)
+        budget -= estimate_tokens(history) if history else 0
+        history = history_prompt + history if history else ""
+        fixed = prompt + question + history + text_prompt
+        text = truncate_to_tokens(text, budget)
+
+        with timed("generation"):
+            a = generate_stage("generation", lambda generate: generate(fixed + text), deadline)
+        record_tokens("prompt", a.usage_metadata.prompt_token_count)
+        record_tokens("response", a.usage_metadata.candidates_token_count)
         return a.text
+    except QueryError:
+        raise
     except Exception as e:
         print(f"Error generating output from Vertex AI Chat-Bison: {e}")
         return "There was an error generating a response."
@@ -130,6 +461,29 @@ def process_and_query_embeddings(request):
     Returns:
         Flask response object with status message.
     """
+    if request.path == "/metrics":
+        return metrics_response()
+
+    request_id = start_request(request.headers.get(REQUEST_ID_HEADER))
+    try:
+        with timed("total"):
+            response = answer_query(request)
+    except QueryError as e:
+        print(f"Request {request_id} failed: {e}")
+        response = jsonify(e.to_response()), e.status
+    finally:
+        finish_request()
+
+    body, status = response
+    return body, status, {REQUEST_ID_HEADER: request_id}
+
+def answer_query(request):
+    """
+    Embed the query, retrieve the closest note chunk and answer it with Gemini.
+
+    Returns:
+        tuple: JSON body and HTTP status.
+    """
     request_json = request.get_json(silent=True)
     if not request_json:
         return jsonify({"error": "Invalid input. JSON data is required."}), 400
@@ -139,25 +493,51 @@ def process_and_query_embeddings(request):
     endpoint_id = "5622211971144220672"
     index_id = "deploy_stream_768_1733596750973"
 
-    print("Yooo!")
-
     if not (project_id and endpoint_id):
         return jsonify({"error": "Missing required headers: Project-ID or Index-ID"}), 400
 
     # Extract content for embedding
     query = [request_json['content']]
     user_email = request_json['user_email']
-    print(query)
+    retrieval_mode = request_json.get('retrieval_mode', RETRIEVAL_MODE)
+    conversation_id = request_json.get('conversation_id')
+    try:
+        page_titles, numeric_filter = parse_query_filters(request_json.get('filters'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    deadline = Deadline(REQUEST_DEADLINE_S, STAGE_TIMEOUTS_S)
+    conversation = None
+    conversation_context = ""
+    if conversation_id:
+        with timed("conversation_load"):
+            conversation = load_conversation(get_db(), conversation_id)
+        try:
+            with timed("reformulation"):
+                standalone = generate_stage("reformulation", lambda generate: reformulate_query(generate, conversation, query[0]), deadline)
+            query = [standalone]
+        except Exception as e:
+            print(f"Error reformulating query, using it as is: {e}")
+        conversation_context = build_context(conversation, min(CONVERSATION_CONTEXT_MAX_TOKENS, MAX_PROMPT_TOKENS // 2))
 
     # Generate embeddings
-    embeddings = embed_text(query)
-    embeddings = embeddings[0]
+    embeddings = embed_query(query[0], deadline)
 
     # Get similar embeddings
-    output_content = query_user_embeddings(user_email, embeddings, project_id, region, endpoint_id, index_id, 5)
-    if output_content == "Oops! Unfortunately we don't have any relevant data that we could pull from your notes!\nTry updating your notes!":
-        return jsonify({"response": output_content}), 200
+    output_content = query_user_embeddings(user_email, embeddings, project_id, region, endpoint_id, index_id, deadline, 5, retrieval_mode, page_titles, numeric_filter)
+
+    final_message = get_llm_output(output_content, query, deadline, conversation_context)
+
+    if conversation is not None:
+        def summarize(summary, turns):
+            # Bounded by what is left of the request budget; on timeout the turns are folded later
+            with timed("summarization"):
+                return generate_stage("summarization", lambda generate: summarize_turns(generate, summary, turns, CONVERSATION_SUMMARY_MAX_TOKENS), deadline)
 
-    final_message = get_llm_output(output_content, query)
+        try:
+            add_turn(conversation, query[0], final_message, CONVERSATION_MAX_TURNS, summarize)
+            save_conversation(get_db(), conversation_id, conversation)
+        except Exception as e:
+            print(f"Error updating conversation {conversation_id}: {e}")
 
     return jsonify({"response": final_message}), 200
\ No newline at end of file
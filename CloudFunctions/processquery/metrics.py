@@ -0,0 +1,89 @@
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+STAGE_SECONDS = Histogram(
+    "processquery_stage_seconds",
+    "Time spent in each stage of the query path.",
+    ["stage"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+TOKENS = Histogram(
+    "processquery_tokens",
+    "Gemini tokens per request, by kind (prompt, response).",
+    ["kind"],
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+)
+
+HEDGED_CALLS = Counter(
+    "processquery_hedged_calls",
+    "Extra attempts started for slow or failed idempotent calls.",
+    ["stage"]
+)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+_current = threading.local()
+
+
+def start_request(request_id = None):
+    """
+    Start collecting stage timings for the request handled by this thread.
+
+    Args:
+        request_id (str): ID propagated by the caller, generated if missing.
+
+    Returns:
+        str: The request ID in use.
+    """
+    request_id = request_id or uuid.uuid4().hex
+    _current.timings = {"request_id": request_id}
+    return request_id
+
+
+def finish_request():
+    """
+    Log the timings of the current request as one JSON line so a slow request
+    can be found by its ID.
+    """
+    timings = getattr(_current, "timings", None)
+    if timings is not None:
+        print(json.dumps(timings))
+        _current.timings = None
+
+
+@contextmanager
+def timed(stage):
+    """
+    Time a block, observe it in the stage histogram and attach it to the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        timings = getattr(_current, "timings", None)
+        if timings is not None:
+            timings[f"{stage}_ms"] = round(elapsed * 1000, 1)
+
+
+def record_tokens(kind, count):
+    if count is None:
+        return
+    TOKENS.labels(kind).observe(count)
+    timings = getattr(_current, "timings", None)
+    if timings is not None:
+        timings[f"{kind}_tokens"] = count
+
+
+def metrics_response():
+    """
+    Returns:
+        tuple: Flask response with all metrics in Prometheus text format.
+    """
+    return generate_latest(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
@@ -9,6 +9,7 @@ from flask import Flask, jsonify
 from datetime import datetime
 from firebase_admin import credentials, firestore
 from google.cloud import pubsub_v1
+from dedupe_store import DedupeStore
 
 db = firestore.Client()
 
@@ -462,22 +463,37 @@ def pull_pubsub_messages(request):
             request={"subscription": subscription_path, "max_messages": 10}
         )
 
+        # Records for emails already written to Notion are acknowledged without
+        # another Notion query and write
+        dedupe = DedupeStore('push-to-notion', db=db)
+        records = [json.loads(received_message.message.data.decode("utf-8")) for received_message in response.received_messages]
+        fresh, busy = dedupe.claim_records(records)
+        fresh = {id(record) for record in fresh}
+        busy = {id(record) for record in busy}
+        print(dedupe.summary())
+
         successfully_processed_messages = []
         error_messages = []
-        for received_message in response.received_messages:
-            message_data = received_message.message.data.decode("utf-8")
-            message_data = json.loads(message_data)
-            if process_message(message_data) == -1:
+        for received_message, message_data in zip(response.received_messages, records):
+            if id(message_data) in busy:
+                # Another run is writing it; left unacked, it is redelivered after the ack deadline
+                continue
+            if id(message_data) not in fresh:
+                successfully_processed_messages.append(received_message)
+            elif process_message(message_data) == -1:
+                dedupe.release_records([message_data])
                 error_messages.append(received_message)
             else:
+                # Written to Notion, so redeliveries are duplicates from now on
+                dedupe.complete_records([message_data])
                 successfully_processed_messages.append(received_message)
         
-        # Acknowledge the messages that were successfully processed
-        for message in successfully_processed_messages:
+        # Acknowledge the messages that were successfully processed, duplicates included, in one call
+        if successfully_processed_messages:
             subscriber.acknowledge(
                 request={
                     "subscription": subscription_path,
-                    "ack_ids": [received_message.ack_id],
+                    "ack_ids": [message.ack_id for message in successfully_processed_messages],
                 }
             )
         status = "success" if len(error_messages) == 0 else "partial"
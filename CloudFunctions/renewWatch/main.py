@@ -0,0 +1,115 @@
+import time
+import functions_framework
+from concurrent.futures import ThreadPoolExecutor
+from flask import jsonify
+from googleapiclient.discovery import build
+from google.cloud import firestore
+from oauth_credentials import CredentialStore
+
+db = firestore.Client()
+
+credential_store = CredentialStore(db, flush_interval_s=60)
+
+GMAIL_TOPIC = 'projects/midterm-440408/topics/gmail-notification'
+
+# Gmail watches last 7 days; renew the ones expiring within this window
+RENEW_WINDOW_HOURS = 48
+MAX_CONCURRENT_RENEWALS = 8
+# Firestore batches hold at most 500 writes
+WRITE_BATCH_SIZE = 500
+
+
+def find_expiring_users(db, cutoff_ms):
+    """
+    Fetch users whose Gmail watch expires before cutoff_ms.
+
+    Older documents store the expiration as the string Gmail returns, and
+    Firestore orders strings after numbers, so both forms are queried.
+
+    Args:
+        db: Firestore client.
+        cutoff_ms (int): Epoch milliseconds.
+
+    Returns:
+        dict: user_email -> user document.
+    """
+    users = {}
+    for cutoff in (cutoff_ms, str(cutoff_ms)):
+        for doc in db.collection('users').where('gmail_watch_expiration', '<', cutoff).stream():
+            users[doc.id] = doc.to_dict()
+    return users
+
+
+def renew_watch(user_email, user_data, build_gmail = None):
+    """
+    Renew the Gmail watch of one user.
+
+    Returns:
+        int: New expiration in epoch milliseconds.
+    """
+    build_gmail = build_gmail or (lambda credentials: build('gmail', 'v1', credentials=credentials, cache_discovery=False))
+    credentials = credential_store.get(user_email, user_data)
+    gmail_service = build_gmail(credentials)
+    response = gmail_service.users().watch(userId=user_email, body={
+        'labelIds': ['INBOX'],
+        'topicName': GMAIL_TOPIC
+    }).execute()
+    return int(response['expiration'])
+
+
+def renew_watches(users, max_workers = MAX_CONCURRENT_RENEWALS, build_gmail = None):
+    """
+    Renew the watches of many users with bounded concurrency.
+
+    Args:
+        users (dict): user_email -> user document.
+        max_workers (int): Renewals in flight at once.
+        build_gmail (callable): Builds a Gmail service from credentials; lets a
+            fake Gmail API be swapped in.
+
+    Returns:
+        tuple[dict, dict]: user_email -> new expiration for renewed users, and
+        user_email -> error message for failed ones.
+    """
+    renewed = {}
+    failed = {}
+
+    def renew(user_email):
+        try:
+            renewed[user_email] = renew_watch(user_email, users[user_email], build_gmail)
+        except Exception as e:
+            failed[user_email] = str(e)
+            print(f"Error renewing watch for {user_email}: {e}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(renew, users))
+    return renewed, failed
+
+
+def record_expirations(db, renewed):
+    """
+    Store new watch expirations (as numbers) with batched writes.
+    """
+    items = list(renewed.items())
+    for start in range(0, len(items), WRITE_BATCH_SIZE):
+        batch = db.batch()
+        for user_email, expiration in items[start:start + WRITE_BATCH_SIZE]:
+            batch.update(db.collection('users').document(user_email), {'gmail_watch_expiration': expiration})
+        batch.commit()
+
+
+@functions_framework.http
+def renew_gmail_watches(request):
+    """
+    HTTP Cloud Function, run by Cloud Scheduler, that renews Gmail watches
+    before they lapse so push notifications never stop silently.
+    """
+    cutoff_ms = int((time.time() + RENEW_WINDOW_HOURS * 3600) * 1000)
+    users = find_expiring_users(db, cutoff_ms)
+    print(f"Renewing {len(users)} Gmail watches expiring before {cutoff_ms}")
+
+    renewed, failed = renew_watches(users)
+    record_expirations(db, renewed)
+    credential_store.flush()
+
+    return jsonify({"renewed": len(renewed), "failed": failed}), 200
@@ -0,0 +1,144 @@
+import time
+import threading
+from datetime import datetime
+
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+
+
+class CredentialStore:
+    """
+    In-memory cache of users' Google OAuth credentials.
+
+    Credentials are built from the Firestore users/{email} document once and
+    reused while the access token is valid. Refreshes are single-flight per
+    user: concurrent callers for the same user wait for one refresh instead of
+    each refreshing and writing back. Refreshed tokens are written back to
+    Firestore in batches by flush().
+
+    The same module is copied into every service that reads Gmail credentials
+    (GmailHook, fetch-latest-emails-pubsub, renewWatch, WebApp); keep the copies identical.
+    """
+
+    def __init__(self, db, flush_interval_s = 0, on_write = None):
+        """
+        Args:
+            db: Firestore client holding the users collection.
+            flush_interval_s (float): Write refreshed tokens back once the oldest
+                pending write is this old. 0 writes back right after a refresh;
+                long-lived batching callers call flush() themselves.
+            on_write (callable): Called with the user email after its
+                document has been updated.
+        """
+        self.db = db
+        self.flush_interval_s = flush_interval_s
+        self.on_write = on_write
+        self._credentials = {}
+        self._user_locks = {}
+        self._pending_writes = {}
+        self._pending_since = None
+        self._lock = threading.Lock()
+
+    def _user_lock(self, user_email):
+        with self._lock:
+            return self._user_locks.setdefault(user_email, threading.Lock())
+
+    def get(self, user_email, user_data = None):
+        """
+        Return valid credentials for a user, refreshing them at most once at a time.
+
+        Args:
+            user_email (str): Document ID in the users collection.
+            user_data (dict): The user's document if the caller already read it.
+
+        Returns:
+            Credentials: Valid credentials, or None if the user is unknown.
+        """
+        credentials = self._credentials.get(user_email)
+        if credentials and credentials.valid:
+            return credentials
+
+        with self._user_lock(user_email):
+            # Another caller may have refreshed while we waited for the lock
+            credentials = self._credentials.get(user_email)
+            if credentials and credentials.valid:
+                return credentials
+
+            if user_data is None:
+                user_doc = self.db.collection('users').document(user_email).get()
+                if not user_doc.exists:
+                    return None
+                user_data = user_doc.to_dict()
+            credentials = credentials_from_user_data(user_data)
+
+            if credentials.expired and credentials.refresh_token:
+                credentials.refresh(Request())
+                self._queue_write(user_email, credentials)
+
+            self._credentials[user_email] = credentials
+
+        if self.flush_interval_s == 0 or (self._pending_since and time.monotonic() - self._pending_since >= self.flush_interval_s):
+            self.flush()
+        return credentials
+
+    def forget(self, user_email):
+        with self._lock:
+            self._credentials.pop(user_email, None)
+            self._pending_writes.pop(user_email, None)
+
+    def _queue_write(self, user_email, credentials):
+        with self._lock:
+            self._pending_writes[user_email] = {
+                'token': credentials.token,
+                'refresh_token': credentials.refresh_token,
+                'expiry': credentials.expiry.isoformat() if credentials.expiry else None
+            }
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+
+    def flush(self):
+        """
+        Write all pending refreshed tokens back to Firestore in one batch.
+
+        Returns:
+            int: Number of users written.
+        """
+        with self._lock:
+            pending, self._pending_writes = self._pending_writes, {}
+            self._pending_since = None
+        if not pending:
+            return 0
+
+        batch = self.db.batch()
+        for user_email, fields in pending.items():
+            batch.update(self.db.collection('users').document(user_email), fields)
+        batch.commit()
+
+        if self.on_write:
+            for user_email in pending:
+                self.on_write(user_email)
+        return len(pending)
+
+
+def credentials_from_user_data(user_data):
+    """
+    Build Credentials from a users/{email} document.
+    """
+    expiry = user_data.get('expiry')
+    return Credentials(
+        token=user_data['token'],
+        refresh_token=user_data['refresh_token'],
+        token_uri=user_data['token_uri'],
+        client_id=user_data['client_id'],
+        client_secret=user_data['client_secret'],
+        scopes=user_data['scopes'],
+        expiry=parse_expiry(expiry, user_data.get('refresh_token'))
+    )
+
+
+def parse_expiry(expiry, refresh_token):
+    # Stored as naive UTC, as google-auth expects. Documents written before
+    # expiry was stored get one refresh so the expiry becomes known.
+    if expiry:
+        return datetime.fromisoformat(expiry)
+    return datetime.utcnow() if refresh_token else None
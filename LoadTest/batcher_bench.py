@@ -0,0 +1,63 @@
+"""
+Benchmark processquery's MicroBatcher against per-request calls.
+
+N concurrent clients call a synthetic backend with a fixed per-call round
+trip and an occasional slow call, once directly and once through the
+batcher. The backend serves any number of calls at once, so the unbatched
+path is not artificially limited.
+
+    python LoadTest/batcher_bench.py --clients 32 --requests 640
+    python LoadTest/batcher_bench.py --slow-prob 0.05 --max-concurrency 1
+"""
+import os
+import sys
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+PROCESSQUERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CloudFunctions", "processquery")
+
+
+def run(call, clients, requests):
+    latencies = []
+
+    def one(i):
+        start = time.perf_counter()
+        call(i)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    return requests / elapsed, p50, p99
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark MicroBatcher against per-request calls.")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=640)
+    parser.add_argument("--round-trip-ms", type=float, default=40)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--max-concurrency", type=int, default=4)
+    parser.add_argument("--slow-prob", type=float, default=0.02, help="Share of calls that are slow")
+    parser.add_argument("--slow-ms", type=float, default=1000)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(PROCESSQUERY_DIR))
+    from batcher import MicroBatcher
+
+    def backend(items):
+        slow = random.random() < args.slow_prob
+        time.sleep((args.slow_ms if slow else args.round_trip_ms) / 1000)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(backend, args.max_batch_size, args.max_wait_ms, args.max_concurrency)
+    for name, call in (("unbatched", lambda i: backend([i])[0]), ("batched", batcher.submit)):
+        throughput, p50, p99 = run(call, args.clients, args.requests)
+        print(f"{name:>10}: {throughput:8.1f} req/s  p50 {p50:7.1f} ms  p99 {p99:7.1f} ms")
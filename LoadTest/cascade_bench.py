@@ -0,0 +1,130 @@
+"""
+Measure the classifier cascade in front of the Gemini extractor against the
+hard filter aptrack uses by default.
+
+The CRF model scores every email in a labeled corpus (JSON lines with id,
+content and relevant). The corpus is split into two halves, stratified by
+label: the drop threshold is picked on the tune half and only reported on
+the held-out half, so the numbers are not measured on the emails they were
+tuned on. Each policy is reported with:
+  to LLM     emails sent to Gemini, and the difference against the hard filter
+  lost       relevant emails dropped before the LLM saw them
+  leaked     irrelevant emails that end up as Notion entries
+
+Policies compared:
+  all        no classifier; every email goes to the LLM
+  hard       the default filter: drop whatever the CRF labels irrelevant
+  cascade    cascade.route at each --drop threshold
+
+The threshold picked is the one that loses the fewest relevant emails on
+the tune half, with the fewest LLM calls among those. premonotion only lets
+the LLM answer Irrelevant for uncertain emails, and the LLM is taken to be
+right about those, so the irrelevant emails that leak are the ones routed
+relevant, under every policy.
+
+    python LoadTest/cascade_bench.py
+    python LoadTest/cascade_bench.py --corpus mail.jsonl --drop 0.65 0.7 0.75
+
+Needs the aptrack requirements installed (dill, scikit-learn, numpy).
+"""
+import os
+import sys
+import json
+import argparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APTRACK_DIR = os.path.join(ROOT, "CloudFunctions", "aptrack")
+DEFAULT_MODEL = os.path.join(ROOT, "models", "CRFO.pkl")
+DEFAULT_CORPUS = os.path.join(ROOT, "LoadTest", "corpus", "labeled_emails.jsonl")
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def split(items):
+    """
+    Alternate the emails of each label, by ID, between a tune and a held-out half.
+
+    Returns:
+        tuple[list, list]: (tune, held_out) items, each (email, label, score).
+    """
+    tune, held_out = [], []
+    for relevant in (True, False):
+        group = sorted((item for item in items if item[0]['relevant'] == relevant), key=lambda item: item[0]['id'])
+        tune += group[0::2]
+        held_out += group[1::2]
+    return tune, held_out
+
+
+def evaluate(items, routes):
+    """
+    Args:
+        routes (list[str]): 'drop', 'relevant' or 'uncertain' per item.
+
+    Returns:
+        tuple[int, int, int]: Emails sent to the LLM, relevant emails lost, and
+        emails the LLM saw that the CRF labeled irrelevant (uncertain).
+    """
+    to_llm = sum(r != 'drop' for r in routes)
+    lost = sum(email['relevant'] and r == 'drop' for (email, _, _), r in zip(items, routes))
+    return to_llm, lost, routes.count('uncertain')
+
+
+def report(name, items, routes, hard_to_llm):
+    """
+    Args:
+        hard_to_llm (int): Emails the hard filter sends to the LLM on the same items.
+    """
+    to_llm, lost, uncertain = evaluate(items, routes)
+    leaked = sum(not email['relevant'] and r == 'relevant' for (email, _, _), r in zip(items, routes))
+    relevant = sum(email['relevant'] for email, _, _ in items)
+    print(f"  {name:14} to LLM {to_llm:4d} ({to_llm - hard_to_llm:+d} vs hard, {uncertain} uncertain; "
+          f"saved {1 - to_llm / len(items):6.1%} vs all)  "
+          f"lost {lost:4d} of {relevant} relevant  leaked {leaked:4d} of {len(items) - relevant} irrelevant")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure LLM calls and accuracy of the cascade against the hard filter.")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--drop", type=float, nargs="+", default=[0.5, 0.6, 0.65, 0.67, 0.68, 0.69, 0.7, 0.72, 0.75],
+                        help="CASCADE_DROP_THRESHOLD values to try")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(APTRACK_DIR))
+    from dill import load
+    from cascade import irrelevant_scores, route
+
+    with open(args.model, "rb") as f:
+        crf_object = load(f)
+    corpus = load_corpus(args.corpus)
+    texts = [email['content'] for email in corpus]
+
+    labels = crf_object.run(texts)
+    scores = irrelevant_scores(crf_object, texts)
+    if scores[0] is None:
+        sys.exit(f"{args.model} does not expose scores; the cascade falls back to the hard filter")
+
+    def routes_for(items, drop, enabled = True):
+        return [route(label, score, drop_threshold=drop, enabled=enabled) for _, label, score in items]
+
+    tune, held_out = split(list(zip(corpus, labels, scores)))
+    print(f"Tune half ({len(tune)} emails)")
+    hard_to_llm = evaluate(tune, routes_for(tune, None, enabled=False))[0]
+    report("hard", tune, routes_for(tune, None, enabled=False), hard_to_llm)
+    for drop in args.drop:
+        report(f"cascade {drop:.2f}", tune, routes_for(tune, drop), hard_to_llm)
+
+    def tune_cost(drop):
+        to_llm, lost, _ = evaluate(tune, routes_for(tune, drop))
+        return lost, to_llm
+
+    best = min(args.drop, key=tune_cost)
+
+    print(f"Held-out half ({len(held_out)} emails), threshold {best:.2f} picked on the tune half")
+    hard_to_llm = evaluate(held_out, routes_for(held_out, None, enabled=False))[0]
+    report("all", held_out, ['relevant'] * len(held_out), hard_to_llm)
+    report("hard", held_out, routes_for(held_out, None, enabled=False), hard_to_llm)
+    report(f"cascade {best:.2f}", held_out, routes_for(held_out, best), hard_to_llm)
@@ -0,0 +1,197 @@
+"""
+Benchmark aptrack's micro-batching consumer against the old fixed pull window.
+
+A fake streaming-pull subscriber delivers messages that arrive at a given
+rate, holding back deliveries while flow control's outstanding limit is
+reached. Classification costs a fixed overhead per batch plus a per-email
+cost. Two consumers are compared:
+  window   the old hello_main: ack on receipt, pull for a fixed window, then
+           classify everything that arrived
+  batched  batch_consumer.BatchConsumer with its size-or-time batches, acking
+           after each batch is processed
+
+For each it prints email latency (arrival to classified), the peak number
+of messages held at once, and how many emails are left to classify after
+coalescing emails of the same thread within what is classified together.
+Coalescing only spans one batch, so a batch window shorter than the old pull
+window coalesces fewer follow-ups at a trickle; --thread-size groups
+consecutive arrivals into threads to measure it:
+
+    python LoadTest/consumer_bench.py --rate 2 --messages 20
+    python LoadTest/consumer_bench.py --rate 2 --messages 20 --thread-size 3
+    python LoadTest/consumer_bench.py --rate 2 --messages 20 --thread-size 3 --batch-wait-ms 5000
+    python LoadTest/consumer_bench.py --backlog 2000
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+import statistics
+from collections import namedtuple
+from concurrent.futures import Future
+
+APTRACK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CloudFunctions", "aptrack")
+
+# Same fields as pubsub_v1.types.FlowControl's message and byte limits
+FlowControl = namedtuple("FlowControl", ["max_messages", "max_bytes"])
+
+
+class FakeMessage:
+    def __init__(self, subscriber, message_id, data, arrived_at, thread_id):
+        self.subscriber = subscriber
+        self.message_id = message_id
+        self.data = data
+        self.arrived_at = arrived_at
+        self.thread_id = thread_id
+
+    def ack(self):
+        self.subscriber._settle(self, requeue=False)
+
+    def nack(self):
+        self.subscriber._settle(self, requeue=True)
+
+
+class FakeSubscriberClient:
+    def __init__(self, arrivals, thread_size = 1, payload_bytes = 200):
+        """
+        Args:
+            arrivals (list[float]): Offsets in seconds from subscribe() at which messages are published.
+            thread_size (int): Consecutive arrivals that belong to the same Gmail thread.
+            payload_bytes (int): Size of each message's data.
+        """
+        self.arrivals = arrivals
+        self.thread_size = thread_size
+        self.payload = b"x" * payload_bytes
+        self.outstanding = 0
+        self.peak_outstanding = 0
+        self.acked = 0
+        self._requeued = []
+        self._cond = threading.Condition()
+
+    def _settle(self, message, requeue):
+        with self._cond:
+            self.outstanding -= 1
+            if requeue:
+                self._requeued.append(message)
+            else:
+                self.acked += 1
+            self._cond.notify_all()
+
+    def subscribe(self, subscription_path, callback, flow_control = None):
+        future = Future()
+        started = time.monotonic()
+        limit = flow_control.max_messages if flow_control else float("inf")
+
+        def deliver(message):
+            with self._cond:
+                while self.outstanding >= limit and not future.cancelled():
+                    self._cond.wait(0.05)
+                if future.cancelled():
+                    return False
+                self.outstanding += 1
+                self.peak_outstanding = max(self.peak_outstanding, self.outstanding)
+            callback(message)
+            return True
+
+        def stream():
+            for i, offset in enumerate(self.arrivals):
+                delay = started + offset - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                if not deliver(FakeMessage(self, str(i), self.payload, started + offset, i // self.thread_size)):
+                    return
+                with self._cond:
+                    requeued, self._requeued = self._requeued, []
+                for message in requeued:
+                    if not deliver(message):
+                        return
+
+        threading.Thread(target=stream, daemon=True).start()
+        return future
+
+    def subscription_path(self, project, subscription):
+        return f"projects/{project}/subscriptions/{subscription}"
+
+
+def classify(messages, batch_overhead_s, per_email_s, classified):
+    """
+    Classify what is left after coalescing threads, as aptrack's classify_batch does.
+
+    Args:
+        classified (list[int]): Receives the number of emails left after coalescing.
+    """
+    threads = len({message.thread_id for message in messages})
+    classified.append(threads)
+    time.sleep(batch_overhead_s + per_email_s * threads)
+    done = time.monotonic()
+    return [done - message.arrived_at for message in messages]
+
+
+def run_window(subscriber, window_s, args):
+    received = []
+
+    def callback(message):
+        received.append(message)
+        message.ack()
+
+    future = subscriber.subscribe("projects/midterm-440408/subscriptions/aptrack-sub", callback)
+    time.sleep(window_s)
+    future.cancel()
+    classified = []
+    latencies = classify(list(received), args.batch_overhead_ms / 1000, args.per_email_ms / 1000, classified)
+    # Acked on receipt, so the messages held in memory are everything received
+    return latencies, len(received), sum(classified)
+
+
+def run_batched(subscriber, args):
+    from batch_consumer import BatchConsumer
+
+    classified = []
+    consumer = BatchConsumer(subscriber, "projects/midterm-440408/subscriptions/aptrack-sub",
+                             lambda messages: classify(messages, args.batch_overhead_ms / 1000, args.per_email_ms / 1000,
+                                                       classified),
+                             max_messages=args.batch_messages, max_wait_s=args.batch_wait_ms / 1000,
+                             idle_timeout_s=args.idle_s, max_runtime_s=args.window_s * 10,
+                             flow_control=FlowControl(2 * args.batch_messages, 2 * 1024 * 1024))
+    # Unacked messages are the ones the consumer holds, pending or being classified
+    latencies = [latency for batch in consumer.run() for latency in batch]
+    return latencies, subscriber.peak_outstanding, sum(classified)
+
+
+def summarize(name, result, elapsed_s):
+    latencies, peak_held, classified = result
+    latencies = sorted(latencies)
+    if not latencies:
+        print(f"{name:8} no emails classified")
+        return
+    print(f"{name:8} {len(latencies):5d} emails in {elapsed_s:6.2f} s  "
+          f"latency median {statistics.median(latencies) * 1000:8.1f} ms  "
+          f"p95 {latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1000:8.1f} ms  "
+          f"peak held {peak_held}  classified {classified} after coalescing")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare fixed-window and micro-batched consumption.")
+    parser.add_argument("--messages", type=int, default=20, help="Messages arriving at --rate")
+    parser.add_argument("--rate", type=float, default=2, help="Arrivals per second")
+    parser.add_argument("--backlog", type=int, default=0, help="Messages already waiting at the start")
+    parser.add_argument("--window-s", type=float, default=5, help="Old fixed pull window, which was also the coalescing window")
+    parser.add_argument("--batch-messages", type=int, default=50)
+    parser.add_argument("--batch-wait-ms", type=float, default=500, help="BATCH_MAX_WAIT_MS")
+    parser.add_argument("--thread-size", type=int, default=1, help="Consecutive arrivals per Gmail thread")
+    parser.add_argument("--idle-s", type=float, default=1)
+    parser.add_argument("--batch-overhead-ms", type=float, default=20, help="Fixed classification cost per batch")
+    parser.add_argument("--per-email-ms", type=float, default=2, help="Classification cost per email")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(APTRACK_DIR))
+    arrivals = [0.0] * args.backlog + [i / args.rate for i in range(args.messages)]
+
+    subscriber = FakeSubscriberClient(arrivals, args.thread_size)
+    start = time.monotonic()
+    summarize("window", run_window(subscriber, args.window_s, args), time.monotonic() - start)
+
+    subscriber = FakeSubscriberClient(arrivals, args.thread_size)
+    start = time.monotonic()
+    summarize("batched", run_batched(subscriber, args), time.monotonic() - start)
@@ -0,0 +1,236 @@
+"""
+Offline evaluation of aptrack's CRF classifier and premonotion's extractor.
+
+Both run over a labeled corpus of email bodies (JSON lines with id, content,
+relevant and the expected status, company, position and deadline).
+
+For the CRF model it reports:
+  throughput   emails/s classifying the whole corpus in one call
+  latency      per email, classifying one email per call
+  memory       peak traced allocation while loading and while classifying
+  relevance    agreement of "not irrelevant" with the relevant label
+
+For the extractor it reports field-level accuracy of status, company,
+position and deadline, after normalizing case and whitespace. Fields with no
+expected value are not scored. Emails are sent --batch-size at a time in one
+prompt, as premonotion's call_llm sends each rel-mail batch, so the scores
+include the effect of batching. The LLM is replaceable: responses are
+replayed from a file keyed by the IDs in each batch, so runs are
+deterministic and offline; --llm gemini calls the model and --record saves
+what it returns.
+
+    python LoadTest/eval_bench.py --llm gemini --record LoadTest/corpus/gemini_responses.json
+    python LoadTest/eval_bench.py --responses LoadTest/corpus/gemini_responses.json --skip-crf --verbose
+
+LoadTest/corpus/stub_responses.json is a hand-written answer key, not a
+recording, and was written from the corpus labels, so scoring against it
+measures nothing about the prompt. Without --responses the extractor is
+skipped; --allow-stub scores the stub anyway to check the harness and
+response parsing. Needs the aptrack requirements for the CRF part (dill,
+scikit-learn, numpy) and google-cloud-aiplatform for --llm gemini.
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import statistics
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+PREMONOTION_DIR = os.path.join(ROOT, "CloudFunctions", "premonotion")
+DEFAULT_MODEL = os.path.join(ROOT, "models", "CRFO.pkl")
+DEFAULT_CORPUS = os.path.join(ROOT, "LoadTest", "corpus", "labeled_emails.jsonl")
+DEFAULT_RESPONSES = os.path.join(ROOT, "LoadTest", "corpus", "stub_responses.json")
+
+# premonotion extracts one rel-mail batch per call; aptrack's BATCH_MAX_MESSAGES bounds its size
+DEFAULT_BATCH_SIZE = 50
+
+# Expected field -> key in the extractor's response
+FIELDS = {'status': 'status', 'company': 'title', 'position': 'position', 'deadline': 'deadline'}
+
+
+class RecordedLLM:
+    """
+    Replays responses recorded per batch, keyed by the batch's email IDs.
+    """
+
+    def __init__(self, path, prompt):
+        with open(path) as f:
+            recording = json.load(f)
+        self.responses = recording['responses']
+        # Recordings without a model are hand-written, not model output
+        self.stub = recording.get('model') is None
+        if recording.get('prompt_sha256') != prompt_digest(prompt):
+            print(f"Warning: {path} was recorded for a different prompt; record again to evaluate this one")
+
+    def generate(self, batch_key, prompt):
+        if batch_key not in self.responses:
+            raise LookupError(f"No recorded response for batch {batch_key}; record one with --llm gemini --record "
+                           f"and the same --batch-size")
+        return self.responses[batch_key]
+
+
+class GeminiLLM:
+    def __init__(self, model_name, record_path = None, prompt = ''):
+        import vertexai
+        from vertexai.generative_models import GenerationConfig, GenerativeModel
+        vertexai.init(project='midterm-440408', location='us-central1')
+        self.model_name = model_name
+        self.model = GenerativeModel(model_name)
+        # Greedy decoding keeps recordings as repeatable as the model allows
+        self.config = GenerationConfig(temperature=0)
+        self.record_path = record_path
+        self.prompt = prompt
+        self.responses = {}
+        self.stub = False
+
+    def generate(self, batch_key, prompt):
+        text = self.model.generate_content(prompt, generation_config=self.config).text
+        self.responses[batch_key] = text
+        return text
+
+    def save(self):
+        if not self.record_path:
+            return
+        with open(self.record_path, 'w') as f:
+            json.dump({'model': self.model_name, 'prompt_sha256': prompt_digest(self.prompt),
+                       'responses': self.responses}, f, indent=2)
+        print(f"Recorded {len(self.responses)} responses to {self.record_path}")
+
+
+def prompt_digest(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def normalize(value):
+    return re.sub(r'\s+', ' ', str(value)).strip().lower()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(int(len(values) * fraction) - 1, 0)]
+
+
+def evaluate_crf(model_path, corpus, repeat):
+    from dill import load
+
+    tracemalloc.start()
+    with open(model_path, 'rb') as f:
+        crf_object = load(f)
+    load_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    texts = [email['content'] for email in corpus]
+    crf_object.run(texts[:1])  # Warm-up
+
+    tracemalloc.start()
+    batch_s = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        labels = crf_object.run(texts)
+        batch_s.append(time.perf_counter() - start)
+    run_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    per_email = []
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            crf_object.run([text])
+            per_email.append(time.perf_counter() - start)
+
+    agree = sum((label != 'irrelevant') == email['relevant'] for label, email in zip(labels, corpus))
+    print(f"CRF {model_path}")
+    print(f"  throughput  {len(texts) / statistics.median(batch_s):10.1f} emails/s (batch of {len(texts)})")
+    print(f"  latency     median {statistics.median(per_email) * 1000:.3f} ms  "
+          f"p95 {percentile(per_email, 0.95) * 1000:.3f} ms  per email")
+    # The load peak includes the modules the pickle imports (scikit-learn, scipy)
+    print(f"  memory      load peak {load_peak / 1024:.0f} KiB  classify peak {run_peak / 1024:.0f} KiB")
+    print(f"  relevance   {agree}/{len(corpus)} ({agree / len(corpus):.1%}) agree with the labels")
+
+
+def evaluate_extractor(corpus, llm, batch_size, verbose):
+    sys.path.insert(0, os.path.abspath(PREMONOTION_DIR))
+    from extractor import extract
+
+    emails = [email for email in corpus if email.get('expected')]
+    correct = {field: 0 for field in FIELDS}
+    scored = {field: 0 for field in FIELDS}
+    failures = 0
+    for start in range(0, len(emails), batch_size):
+        batch = emails[start:start + batch_size]
+        batch_key = ','.join(email['id'] for email in batch)
+        # The whole batch in one prompt, as call_llm sends it; a bad response fails every email in it
+        try:
+            responses = extract([email['content'] for email in batch], lambda prompt: llm.generate(batch_key, prompt))
+        except (LookupError, ValueError) as e:
+            print(f"  {batch[0]['id']}..{batch[-1]['id']}: {e}")
+            failures += len(batch)
+            continue
+        for email, response in zip(batch, responses):
+            expected = email['expected']
+            for field, key in FIELDS.items():
+                if expected.get(field) is None:
+                    continue
+                scored[field] += 1
+                if normalize(response.get(key)) == normalize(expected[field]):
+                    correct[field] += 1
+                elif verbose:
+                    print(f"  {email['id']} {field}: expected {expected[field]!r}, got {response.get(key)!r}")
+
+    if llm.stub:
+        print(f"Extractor, batches of {batch_size} (stub answer key: checks the harness, not the prompt)")
+    else:
+        print(f"Extractor, batches of {batch_size}")
+    for field in FIELDS:
+        if scored[field]:
+            print(f"  {field:10} {correct[field]:4d}/{scored[field]:<4d} ({correct[field] / scored[field]:.1%})")
+    if failures:
+        print(f"  {failures} emails without a usable response")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the CRF classifier and the LLM extractor offline.")
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions for the CRF")
+    parser.add_argument("--llm", choices=["recorded", "gemini"], default="recorded")
+    parser.add_argument("--responses", help="Recorded responses to replay (default: the stub answer key)")
+    parser.add_argument("--allow-stub", action="store_true",
+                        help="Score a hand-written answer key, which only checks the harness")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Emails per extraction call")
+    parser.add_argument("--record", help="With --llm gemini, save the responses here")
+    parser.add_argument("--gemini-model", default="gemini-1.5-flash-002")
+    parser.add_argument("--skip-crf", action="store_true")
+    parser.add_argument("--skip-extractor", action="store_true")
+    parser.add_argument("--verbose", action="store_true", help="Print every mismatched field")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if not args.skip_crf:
+        evaluate_crf(args.model, corpus, args.repeat)
+
+    if not args.skip_extractor:
+        sys.path.insert(0, os.path.abspath(PREMONOTION_DIR))
+        from extractor import PROMPT
+
+        if args.llm == "gemini":
+            llm = GeminiLLM(args.gemini_model, args.record, PROMPT)
+        else:
+            llm = RecordedLLM(args.responses or DEFAULT_RESPONSES, PROMPT)
+        if llm.stub and not args.allow_stub:
+            # The stub was written from the labels it would be scored against, so every field would match
+            print("Extractor skipped: no recorded model responses. Record them with --llm gemini --record and "
+                  "pass --responses, or --allow-stub to check the harness on the hand-written answer key")
+        else:
+            evaluate_extractor(corpus, llm, args.batch_size, args.verbose)
+        if args.llm == "gemini":
+            llm.save()
@@ -0,0 +1,256 @@
+"""
+In-memory fake of the parts of the Gmail API the Cloud Functions use.
+
+It mimics the googleapiclient call style (service.users().watch(...).execute())
+so functions that accept a Gmail service or a build_gmail factory can be run
+locally. Every round trip sleeps for `latency_s` and is counted in `calls`;
+an HTTP batch request counts as one round trip.
+
+    from fake_gmail import FakeGmailService
+    gmail = FakeGmailService(latency_s=0.05)
+    renew_watches(users, build_gmail=lambda credentials: gmail)
+    print(gmail.calls)
+
+Running this file reads a backlog of messages the old way (one history.list
+page, one messages.get per message) and through gmail_sync's paginated
+history reader and batched fetch, and prints round trips, time and how many
+messages each way saw.
+
+    python LoadTest/fake_gmail.py --messages 200 --latency-ms 80
+"""
+import os
+import sys
+import time
+import base64
+import argparse
+import threading
+from types import SimpleNamespace
+from collections import Counter
+
+GMAILHOOK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CloudFunctions", "GmailHook")
+
+WATCH_DURATION_MS = 7 * 24 * 3600 * 1000
+
+
+# Gmail rejects batch requests with more calls than this
+MAX_BATCH_SIZE = 100
+
+
+class FakeHttpError(Exception):
+    """
+    Stand-in for googleapiclient.errors.HttpError, with the same resp.status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(f"<HttpError {status}: {message}>")
+        self.resp = SimpleNamespace(status=status)
+
+
+def make_message(message_id, sender, subject, body, thread_id = None, labels = ("INBOX",), headers = None):
+    """
+    Build a message in the shape messages.get(format='full') returns.
+    """
+    all_headers = [{"name": "From", "value": sender},
+                   {"name": "Subject", "value": subject},
+                   {"name": "Date", "value": "Mon, 14 Oct 2024 09:30:00 -0400"}]
+    all_headers += [{"name": name, "value": value} for name, value in (headers or {}).items()]
+    return {
+        "id": message_id,
+        "threadId": thread_id or message_id,
+        "labelIds": list(labels),
+        "snippet": body[:100],
+        "internalDate": str(int(time.time() * 1000)),
+        "payload": {
+            "mimeType": "text/plain",
+            "headers": all_headers,
+            "body": {"size": len(body), "data": base64.urlsafe_b64encode(body.encode()).decode()}
+        }
+    }
+
+
+class FakeRequest:
+    def __init__(self, service, method, handler):
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self):
+        self.service._round_trip(self.method)
+        return self.handler()
+
+
+class FakeGmailService:
+    def __init__(self, latency_s = 0.0, fail_users = ()):
+        """
+        Args:
+            latency_s (float): Simulated time of each HTTP round trip.
+            fail_users (iterable[str]): Users whose calls raise, to exercise error handling.
+        """
+        self.latency_s = latency_s
+        self.fail_users = set(fail_users)
+        self.calls = Counter()
+        self.watches = {}
+        self.mailboxes = {}
+        self.histories = {}
+        self.history_id = 1
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def _round_trip(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency_s)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _check_user(self, user_id):
+        if user_id in self.fail_users:
+            raise RuntimeError(f"Fake Gmail error for {user_id}")
+
+    def add_message(self, user_id, message):
+        """
+        Deliver a message, appending a messageAdded record to the user's history.
+        """
+        self.mailboxes.setdefault(user_id, {})[message["id"]] = message
+        self.record_history(user_id, [message["id"]])
+
+    def record_history(self, user_id, message_ids):
+        """
+        Append one history record listing existing messages as added; calling
+        it again for the same IDs reproduces records that repeat a message.
+        """
+        with self._lock:
+            self.history_id += 1
+            added = [{"message": {key: self.mailboxes[user_id][message_id][key] for key in ("id", "threadId", "labelIds")}}
+                     for message_id in message_ids]
+            self.histories.setdefault(user_id, []).append({"id": str(self.history_id), "messagesAdded": added})
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return FakeMessages(self)
+
+    def history(self):
+        return FakeHistory(self)
+
+    def new_batch_http_request(self, callback = None):
+        return FakeBatchRequest(self, callback)
+
+    def watch(self, userId, body):
+        def handler():
+            self._check_user(userId)
+            expiration = int(time.time() * 1000) + WATCH_DURATION_MS
+            self.watches[userId] = {"topicName": body["topicName"], "expiration": expiration}
+            return {"historyId": "1", "expiration": str(expiration)}
+        return FakeRequest(self, "watch", handler)
+
+
+class FakeMessages:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, userId, id, format = "full", metadataHeaders = None):
+        def handler():
+            self.service._check_user(userId)
+            message = self.service.mailboxes.get(userId, {}).get(id)
+            if message is None:
+                raise FakeHttpError(404, f"Message {id} not found")
+            if format != "metadata":
+                return message
+            wanted = {name.lower() for name in metadataHeaders or []}
+            headers = [header for header in message["payload"]["headers"]
+                       if not wanted or header["name"].lower() in wanted]
+            return {key: value for key, value in message.items() if key != "payload"} | {
+                "payload": {"mimeType": message["payload"]["mimeType"], "headers": headers}
+            }
+        return FakeRequest(self.service, "messages.get", handler)
+
+
+class FakeHistory:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, userId, startHistoryId, pageToken = None, maxResults = 100, historyTypes = None):
+        def handler():
+            self.service._check_user(userId)
+            records = [record for record in self.service.histories.get(userId, [])
+                       if int(record["id"]) > int(startHistoryId)]
+            offset = int(pageToken or 0)
+            response = {"history": records[offset:offset + maxResults], "historyId": str(self.service.history_id)}
+            if offset + maxResults < len(records):
+                response["nextPageToken"] = str(offset + maxResults)
+            return response
+        return FakeRequest(self.service, "history.list", handler)
+
+
+class FakeBatchRequest:
+    """
+    Mirrors googleapiclient's BatchHttpRequest: one round trip, one callback per call.
+    """
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback = None, request_id = None):
+        if len(self.requests) >= MAX_BATCH_SIZE:
+            raise ValueError(f"Exceeded the maximum of {MAX_BATCH_SIZE} calls in a single batch")
+        request_id = request_id if request_id is not None else str(len(self.requests) + 1)
+        self.requests.append((request_id, request, callback or self.callback))
+
+    def execute(self):
+        self.service._round_trip("batch")
+        for request_id, request, callback in self.requests:
+            self.service.calls[request.method] += 1
+            try:
+                response, exception = request.handler(), None
+            except Exception as e:
+                response, exception = None, e
+            if callback:
+                callback(request_id, response, exception)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare one-by-one and batched Gmail message fetches.")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=80, help="Simulated Gmail round-trip time")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(GMAILHOOK_DIR))
+    from gmail_sync import fetch_messages, iter_history_pages
+
+    user = "student@example.com"
+    gmail = FakeGmailService(latency_s=args.latency_ms / 1000)
+    ids = [f"m{i}" for i in range(args.messages)]
+    for message_id in ids:
+        gmail.add_message(user, make_message(message_id, "news@example.com", "Weekly digest", "Hello " * 50))
+
+    # A message repeated in a later history record, as Gmail does
+    gmail.record_history(user, ids[:10])
+
+    start = time.perf_counter()
+    history = gmail.users().history().list(userId=user, startHistoryId="1").execute()
+    for record in history.get("history", []):
+        for added_message in record["messagesAdded"]:
+            gmail.users().messages().get(userId=user, id=added_message["message"]["id"]).execute()
+    sequential_s = time.perf_counter() - start
+    sequential_trips = sum(gmail.calls.values())
+    sequential_seen = gmail.calls["messages.get"]
+
+    gmail.calls.clear()
+    start = time.perf_counter()
+    fetched = 0
+    for message_ids, checkpoint in iter_history_pages(gmail, user, "1"):
+        fetched += sum(1 for _, message, _ in fetch_messages(gmail, user, message_ids) if message)
+    batched_s = time.perf_counter() - start
+    batched_trips = gmail.calls["history.list"] + gmail.calls["batch"]
+
+    print(f"one by one: {sequential_trips} round trips, {sequential_s:.2f} s, {sequential_seen} messages fetched")
+    print(f"batched:    {batched_trips} round trips, {batched_s:.2f} s, {fetched} messages fetched, checkpoint {checkpoint}")
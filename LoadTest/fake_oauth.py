@@ -0,0 +1,132 @@
+"""
+Local fake of Google's OAuth token endpoint.
+
+Point a user's token_uri at http://127.0.0.1:<port>/token and every refresh
+returns a new fake access token, so credential refresh can be exercised
+without Google. Running this file also fires a burst of concurrent
+CredentialStore.get() calls for one expired user and prints how many
+refreshes and Firestore writes the burst caused.
+
+    python LoadTest/fake_oauth.py --burst 50
+"""
+import os
+import sys
+import json
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+GMAILHOOK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CloudFunctions", "GmailHook")
+
+
+class FakeTokenEndpoint:
+    def __init__(self, port = 8090, latency_s = 0.2):
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                threading.Event().wait(latency_s)
+                with endpoint._lock:
+                    endpoint.refreshes += 1
+                    count = endpoint.refreshes
+                body = json.dumps({"access_token": f"fake-token-{count}", "expires_in": 3600, "token_type": "Bearer"}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.token_uri = f"http://127.0.0.1:{port}/token"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class FakeFirestore:
+    """
+    The slice of the Firestore client used by CredentialStore, kept in memory.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.commits = 0
+
+    def collection(self, name):
+        return self
+
+    def document(self, user_email):
+        return FakeDocument(self, user_email)
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeDocument:
+    def __init__(self, db, user_email):
+        self.db = db
+        self.user_email = user_email
+
+    @property
+    def exists(self):
+        return self.user_email in self.db.users
+
+    def get(self):
+        return self
+
+    def to_dict(self):
+        return dict(self.db.users[self.user_email])
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.updates = []
+
+    def update(self, document, fields):
+        self.updates.append((document.user_email, fields))
+
+    def commit(self):
+        self.db.commits += 1
+        for user_email, fields in self.updates:
+            self.db.users[user_email].update(fields)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OAuth token endpoint and single-flight refresh check.")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--burst", type=int, default=50, help="Concurrent credential lookups for one user")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(GMAILHOOK_DIR))
+    from oauth_credentials import CredentialStore
+
+    endpoint = FakeTokenEndpoint(args.port).start()
+    db = FakeFirestore({"student@example.com": {
+        "token": "stale-token",
+        "refresh_token": "refresh-token",
+        "token_uri": endpoint.token_uri,
+        "client_id": "client-id",
+        "client_secret": "client-secret",
+        "scopes": ["https://www.googleapis.com/auth/gmail.readonly"],
+        "expiry": "2000-01-01T00:00:00"
+    }})
+    store = CredentialStore(db, flush_interval_s=60)
+
+    with ThreadPoolExecutor(max_workers=args.burst) as pool:
+        tokens = set(pool.map(lambda _: store.get("student@example.com").token, range(args.burst)))
+    store.flush()
+    endpoint.stop()
+
+    print(f"{args.burst} concurrent lookups -> {endpoint.refreshes} refresh(es), {db.commits} Firestore commit(s), tokens {sorted(tokens)}")
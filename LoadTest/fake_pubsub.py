@@ -0,0 +1,135 @@
+"""
+In-memory fake of google-cloud-pubsub's PublisherClient.
+
+Messages are batched the way the real client batches them (max messages,
+max bytes, max latency), every batch costs one simulated RPC, and publish()
+returns a concurrent.futures.Future. Messages with the same ordering key are
+sent in publish order. It stands in wherever a BatchPublisher takes a client.
+
+Running this file publishes the same messages the old way (a new client per
+message, blocking on each result) and through pubsub_publisher.BatchPublisher,
+and prints RPC counts and time for each.
+
+    python LoadTest/fake_pubsub.py --messages 500 --rpc-ms 30
+
+To run against the Pub/Sub emulator instead, start it, export
+PUBSUB_EMULATOR_HOST, and the real client used by BatchPublisher picks it up.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import Future
+
+FETCH_LATEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CloudFunctions", "fetch-latest-emails-pubsub")
+
+
+class FakePublisherClient:
+    def __init__(self, rpc_latency_s = 0.03, max_messages = 100, max_bytes = 1024 * 1024, max_latency_s = 0.05,
+                 fail_rate = 0.0, creation_s = 0.0):
+        """
+        Args:
+            rpc_latency_s (float): Simulated time of one publish RPC.
+            max_messages, max_bytes, max_latency_s: Batch settings, as in BatchSettings.
+            fail_rate (float): Probability that a message fails, to exercise failure reporting.
+            creation_s (float): Simulated client construction cost (channel setup, auth).
+        """
+        time.sleep(creation_s)
+        self.rpc_latency_s = rpc_latency_s
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_latency_s = max_latency_s
+        self.fail_rate = fail_rate
+        self.rpcs = 0
+        self.published = []
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_started = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._next_id = 0
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data, ordering_key = "", **attributes):
+        if not isinstance(data, bytes):
+            raise TypeError("Data being published to Pub/Sub must be sent as a bytestring.")
+        future = Future()
+        with self._lock:
+            if self._batch_started is None:
+                self._batch_started = time.monotonic()
+            self._batch.append((topic, data, ordering_key, attributes, future))
+            self._batch_bytes += len(data)
+            if len(self._batch) >= self.max_messages or self._batch_bytes >= self.max_bytes:
+                self._wakeup.notify()
+        return future
+
+    def resume_publish(self, topic, ordering_key):
+        pass
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while not self._batch_ready():
+                    timeout = None
+                    if self._batch_started is not None:
+                        timeout = max(self._batch_started + self.max_latency_s - time.monotonic(), 0)
+                    self._wakeup.wait(timeout)
+                batch, self._batch = self._batch[:self.max_messages], self._batch[self.max_messages:]
+                self._batch_bytes = sum(len(item[1]) for item in self._batch)
+                self._batch_started = time.monotonic() if self._batch else None
+            self._send(batch)
+
+    def _batch_ready(self):
+        if not self._batch:
+            return False
+        return (len(self._batch) >= self.max_messages or self._batch_bytes >= self.max_bytes
+                or time.monotonic() - self._batch_started >= self.max_latency_s)
+
+    def _send(self, batch):
+        time.sleep(self.rpc_latency_s)
+        self.rpcs += 1
+        for topic, data, ordering_key, attributes, future in batch:
+            if random.random() < self.fail_rate:
+                future.set_exception(RuntimeError("Fake publish failure"))
+                continue
+            self._next_id += 1
+            self.published.append((topic, ordering_key, data))
+            future.set_result(str(self._next_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-message and batched Pub/Sub publishing.")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--rpc-ms", type=float, default=30, help="Simulated publish RPC time")
+    parser.add_argument("--client-ms", type=float, default=20, help="Simulated client construction time")
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(FETCH_LATEST_DIR))
+    from pubsub_publisher import BatchPublisher
+
+    payloads = [f'{{"email": "student{i % 5}@example.com", "content": "email {i}"}}'.encode() for i in range(args.messages)]
+
+    start = time.perf_counter()
+    rpcs = 0
+    for data in payloads:
+        client = FakePublisherClient(args.rpc_ms / 1000, max_messages=1, creation_s=args.client_ms / 1000)
+        client.publish(client.topic_path("midterm-440408", "unprocessed-emails"), data).result()
+        rpcs += client.rpcs
+    old_s = time.perf_counter() - start
+
+    client = FakePublisherClient(args.rpc_ms / 1000, fail_rate=args.fail_rate, creation_s=args.client_ms / 1000)
+    start = time.perf_counter()
+    publisher = BatchPublisher("unprocessed-emails", client=client)
+    for i, data in enumerate(payloads):
+        publisher.publish(data, ordering_key=f"student{i % 5}@example.com", label=f"email {i}")
+    published, failed = publisher.wait()
+    new_s = time.perf_counter() - start
+
+    print(f"per message: {rpcs} RPCs, {old_s:.2f} s")
+    print(f"batched:     {client.rpcs} RPCs, {new_s:.2f} s, {len(published)} published, {len(failed)} failed")
@@ -0,0 +1,239 @@
+"""
+Load test the chat path (WebApp /chatbot or processquery).
+
+By default it starts local processquery instances backed by stubbed Vertex AI
+services (see stub_vertex.py) and drives them. Pass --url to drive a running
+WebApp or processquery instead.
+
+Examples:
+    # 2 local stub instances, Poisson arrivals at 20 req/s for 60 s
+    python LoadTest/loadtest.py --instances 2 --rate 20 --duration 60
+
+    # closed loop with 50 concurrent users against a running WebApp
+    python LoadTest/loadtest.py --target webapp --url http://localhost:8080/chatbot \\
+        --cookie "session=..." --concurrency 50 --requests 2000
+
+    # replay a recorded query log (JSON lines with "ts", "content", "user_email") at 2x speed
+    python LoadTest/loadtest.py --replay queries.jsonl --speed 2
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+import subprocess
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+STUB_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_vertex.py")
+
+SAMPLE_QUERIES = [
+    "What is a page fault?",
+    "Explain the difference between TCP and UDP",
+    "Summarize my notes on dynamic programming",
+    "What did the professor say about the midterm?",
+    "How does virtual memory work?",
+    "Give me an example of a B-tree insertion",
+]
+
+
+def start_local_instances(count, first_port):
+    """
+    Start `count` stub processquery servers and wait until they accept requests.
+
+    Returns:
+        list[tuple[subprocess.Popen, str]]: Process and base URL of each instance.
+    """
+    instances = []
+    for port in range(first_port, first_port + count):
+        process = subprocess.Popen([sys.executable, STUB_SERVER, "--port", str(port)],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        instances.append((process, f"http://127.0.0.1:{port}"))
+
+    for process, url in instances:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                urllib.request.urlopen(url + "/metrics", timeout=1).read()
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"Stub instance at {url} failed to start")
+                time.sleep(0.2)
+    return instances
+
+
+def peak_memory_mb(pid):
+    """
+    Peak resident memory of a local process, read from /proc (Linux only).
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def scraped_memory_mb(url):
+    """
+    Resident memory reported by an instance's /metrics endpoint, if it exposes one.
+    """
+    metrics_url = url.rsplit("/", 1)[0] + "/metrics" if url.endswith("/chatbot") else url.rstrip("/") + "/metrics"
+    try:
+        body = urllib.request.urlopen(metrics_url, timeout=5).read().decode()
+    except (urllib.error.URLError, ConnectionError):
+        return None
+    for line in body.splitlines():
+        if line.startswith("process_resident_memory_bytes "):
+            return float(line.split()[1]) / 2**20
+    return None
+
+
+def load_workload(args):
+    """
+    Build the list of (arrival offset in seconds, payload) to send.
+    """
+    if args.replay:
+        with open(args.replay) as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        start = records[0].get("ts", 0)
+        return [((record.get("ts", start) - start) / args.speed, record) for record in records]
+
+    workload = []
+    offset = 0.0
+    count = args.requests or int(args.rate * args.duration) or 1000
+    for _ in range(count):
+        if args.rate:
+            offset += random.expovariate(args.rate)  # Poisson arrivals
+            if args.duration and offset > args.duration:
+                break
+        workload.append((offset if args.rate else 0.0, {"content": random.choice(SAMPLE_QUERIES)}))
+    return workload
+
+
+def build_request(url, record, args):
+    user_email = record.get("user_email", args.user_email)
+    if args.target == "webapp":
+        body = {"message": record["content"]}
+    else:
+        body = {"content": record["content"], "user_email": user_email}
+
+    headers = {"Content-Type": "application/json"}
+    if args.cookie:
+        headers["Cookie"] = args.cookie
+    return urllib.request.Request(url, data=json.dumps(body).encode(), headers=headers, method="POST")
+
+
+def run(args, urls):
+    workload = load_workload(args)
+    url_cycle = itertools.cycle(urls)
+    url_lock = threading.Lock()
+    in_flight = threading.Semaphore(args.concurrency)
+    latencies = []
+    errors = Counter()
+    results_lock = threading.Lock()
+
+    def send(sent_from, record):
+        with url_lock:
+            url = next(url_cycle)
+        try:
+            with urllib.request.urlopen(build_request(url, record, args), timeout=args.timeout) as response:
+                response.read()
+            outcome = None
+        except urllib.error.HTTPError as e:
+            outcome = f"HTTP {e.code}"
+        except Exception as e:
+            outcome = type(e).__name__
+        finally:
+            in_flight.release()
+
+        latency = time.perf_counter() - sent_from
+        with results_lock:
+            if outcome:
+                errors[outcome] += 1
+            else:
+                latencies.append(latency)
+
+    # Closed loop (no --rate or --replay) sends each request as soon as a slot frees up
+    closed_loop = not args.rate and not args.replay
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for offset, record in workload:
+            scheduled = start + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            in_flight.acquire()
+            # Open loop measures from the scheduled arrival so queueing in the driver
+            # counts too; closed loop has no schedule, so from when the slot was taken
+            pool.submit(send, time.perf_counter() if closed_loop else scheduled, record)
+    elapsed = time.perf_counter() - start
+
+    return latencies, errors, elapsed
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return float("nan")
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(latencies, errors, elapsed, memory):
+    total = len(latencies) + sum(errors.values())
+    latencies.sort()
+    print(f"requests:    {total} in {elapsed:.1f} s")
+    print(f"throughput:  {len(latencies) / elapsed:.1f} req/s (successful)")
+    print(f"error rate:  {sum(errors.values()) / total * 100 if total else 0:.2f}%", dict(errors) or "")
+    print("latency ms:  " + "  ".join(
+        f"p{pct} {percentile(latencies, pct) * 1000:.0f}" for pct in (50, 90, 95, 99)
+    ) + f"  max {latencies[-1] * 1000 if latencies else float('nan'):.0f}")
+    for url, mb in memory.items():
+        print(f"memory:      {url} peak {mb:.1f} MiB" if mb is not None else f"memory:      {url} n/a")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Talk2Data chat path.")
+    parser.add_argument("--target", choices=["processquery", "webapp"], default="processquery",
+                        help="Request body shape: processquery JSON or WebApp /chatbot JSON")
+    parser.add_argument("--url", action="append",
+                        help="Endpoint to drive (repeatable). Default: start local stub instances")
+    parser.add_argument("--instances", type=int, default=1, help="Local stub instances to start")
+    parser.add_argument("--port", type=int, default=8081, help="First port for local stub instances")
+    parser.add_argument("--concurrency", type=int, default=20, help="Maximum requests in flight")
+    parser.add_argument("--rate", type=float, default=0, help="Poisson arrival rate in req/s, 0 for closed loop")
+    parser.add_argument("--duration", type=float, default=0, help="Test length in seconds (with --rate)")
+    parser.add_argument("--requests", type=int, default=0, help="Number of requests to send")
+    parser.add_argument("--replay", help="JSON lines query log to replay with its original arrival times")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed-up factor")
+    parser.add_argument("--user-email", default="loadtest@example.com")
+    parser.add_argument("--cookie", help="Cookie header for WebApp sessions")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    instances = []
+    if args.url:
+        urls = args.url
+    else:
+        instances = start_local_instances(args.instances, args.port)
+        urls = [url for _, url in instances]
+
+    try:
+        latencies, errors, elapsed = run(args, urls)
+        if instances:
+            memory = {url: peak_memory_mb(process.pid) for process, url in instances}
+        else:
+            memory = {url: scraped_memory_mb(url) for url in urls}
+        report(latencies, errors, elapsed, memory)
+    finally:
+        for process, _ in instances:
+            process.terminate()
@@ -0,0 +1,176 @@
+"""
+Benchmark email body extraction on Gmail-shaped message payloads.
+
+Messages are built with the standard email package and converted to the
+payload structure messages.get(format='full') returns. The corpus covers
+plain, HTML-only, multipart/alternative nested in multipart/mixed, large
+attachments, long reply chains and oversized bodies. Real mail exported as
+.eml files can be used instead with --eml-dir.
+
+The previous inline parser in fetch-latest-emails-pubsub and mime_extract
+are compared on throughput, peak memory and how many emails yield a body.
+
+    python LoadTest/mime_bench.py --messages 2000
+    python LoadTest/mime_bench.py --eml-dir ~/exported-mail
+"""
+import os
+import sys
+import time
+import base64
+import random
+import argparse
+import tracemalloc
+from email import message_from_binary_file, policy
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+FETCH_LATEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CloudFunctions", "fetch-latest-emails-pubsub")
+
+# Gmail inlines part data up to roughly this size and returns an attachmentId above it
+INLINE_ATTACHMENT_LIMIT = 4 * 1024
+
+REPLY_CHAIN = "\n\nOn Mon, Oct 14, 2024 at 9:30 AM Recruiter <jobs@acme.com> wrote:\n" + "> Earlier message\n" * 200
+APPLICATION_TEXT = ("Hi Alex,\n\nThank you for applying to the Software Engineer Intern position at Acme. "
+                    "We would like to invite you to an online assessment due 2024-11-01.\n\nBest,\nAcme Recruiting")
+APPLICATION_HTML = ("<html><head><style>p {color: red}</style></head><body><div><p>Hi Alex,</p>"
+                    "<p>Thank you for applying to the <b>Software Engineer Intern</b> position at Acme.</p>"
+                    "<p>We would like to invite you to an online assessment due 2024-11-01.</p></div>"
+                    "<div class=\"gmail_quote\"><p>Quoted earlier thread</p></div></body></html>")
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def to_gmail_payload(part):
+    """
+    Convert an email.message.Message into Gmail API payload form.
+    """
+    payload = {
+        "mimeType": part.get_content_type(),
+        "filename": part.get_filename() or "",
+        "headers": [{"name": name, "value": str(value)} for name, value in part.items()],
+    }
+    if part.is_multipart():
+        payload["body"] = {"size": 0}
+        payload["parts"] = [to_gmail_payload(child) for child in part.get_payload()]
+        return payload
+    data = part.get_payload(decode=True) or b""
+    if payload["filename"] and len(data) > INLINE_ATTACHMENT_LIMIT:
+        payload["body"] = {"attachmentId": f"att-{id(part)}", "size": len(data)}
+    else:
+        payload["body"] = {"size": len(data), "data": b64(data)}
+    return payload
+
+
+def build_corpus(count, seed = 7):
+    rng = random.Random(seed)
+
+    def plain():
+        return MIMEText(APPLICATION_TEXT)
+
+    def html_only():
+        return MIMEText(APPLICATION_HTML, "html")
+
+    def alternative():
+        message = MIMEMultipart("alternative")
+        message.attach(MIMEText(APPLICATION_TEXT))
+        message.attach(MIMEText(APPLICATION_HTML, "html"))
+        return message
+
+    def mixed_with_attachment():
+        message = MIMEMultipart("mixed")
+        body = MIMEMultipart("alternative")
+        body.attach(MIMEText(APPLICATION_TEXT))
+        body.attach(MIMEText(APPLICATION_HTML, "html"))
+        message.attach(body)
+        attachment = MIMEApplication(rng.randbytes(2 * 1024 * 1024), Name="offer_letter.pdf")
+        attachment["Content-Disposition"] = 'attachment; filename="offer_letter.pdf"'
+        message.attach(attachment)
+        return message
+
+    def mixed_html_only():
+        message = MIMEMultipart("mixed")
+        related = MIMEMultipart("related")
+        related.attach(MIMEText(APPLICATION_HTML, "html"))
+        logo = MIMEApplication(rng.randbytes(1024), Name="logo.png")
+        logo["Content-Disposition"] = 'inline; filename="logo.png"'
+        related.attach(logo)
+        message.attach(related)
+        return message
+
+    def reply_chain():
+        return MIMEText(APPLICATION_TEXT + REPLY_CHAIN)
+
+    def oversized():
+        return MIMEText(APPLICATION_TEXT + "\n" + "Lorem ipsum dolor sit amet. " * 200000)
+
+    shapes = [plain, html_only, alternative, mixed_with_attachment, mixed_html_only, reply_chain, oversized]
+    weights = [30, 15, 25, 10, 10, 8, 2]
+    corpus = []
+    for shape in rng.choices(shapes, weights, k=count):
+        message = shape()
+        message["From"] = "Acme Recruiting <jobs@acme.com>"
+        message["Subject"] = "Your application"
+        message["Date"] = "Mon, 14 Oct 2024 09:30:00 -0400"
+        corpus.append((shape.__name__, {"id": str(len(corpus)), "payload": to_gmail_payload(message)}))
+    return corpus
+
+
+def load_eml_corpus(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".eml"):
+            with open(os.path.join(directory, name), "rb") as f:
+                message = message_from_binary_file(f, policy=policy.default)
+            corpus.append(("eml", {"id": name, "payload": to_gmail_payload(message)}))
+    return corpus
+
+
+def legacy_extract(msg):
+    # The parser fetch-latest-emails-pubsub used before mime_extract
+    payload = msg.get("payload", "")
+    if payload:
+        if "parts" in payload:
+            for part in payload["parts"]:
+                if part["mimeType"] == "text/plain":
+                    msg_content = base64.urlsafe_b64decode(part["body"]["data"]).decode("utf-8")
+        elif "body" in payload:
+            msg_content = base64.urlsafe_b64decode(payload["body"]["data"]).decode("utf-8")
+    return msg_content
+
+
+def run(name, extract, corpus):
+    empty = {}
+    total_chars = 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    for shape, msg in corpus:
+        try:
+            text = extract(msg)
+        except Exception:
+            text = ""
+        if not text:
+            empty[shape] = empty.get(shape, 0) + 1
+        total_chars += len(text)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:8} {len(corpus) / elapsed:8.0f} msg/s  peak {peak / 1e6:6.1f} MB  "
+          f"avg body {total_chars / len(corpus):8.0f} chars  no body: {empty or 'none'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark email body extraction.")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--eml-dir", help="Use real .eml files instead of the generated corpus")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(FETCH_LATEST_DIR))
+    from mime_extract import extract_body
+
+    corpus = load_eml_corpus(args.eml_dir) if args.eml_dir else build_corpus(args.messages)
+    print(f"{len(corpus)} messages")
+    run("legacy", legacy_extract, corpus)
+    run("mime", lambda msg: extract_body(msg["payload"]), corpus)
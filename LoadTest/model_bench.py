@@ -0,0 +1,70 @@
+"""
+Benchmark aptrack's classifier loading, cold and warm.
+
+Uses the local models/CRFO.pkl as the artifact source. Three cases are timed:
+  per-invocation  what load_CRFObject used to do on every call (copy + dill.load)
+  cold            a fresh ModelLoader with an empty cache
+  warm            ModelLoader.get() on an instance that already holds the model
+
+    python LoadTest/model_bench.py --invocations 50
+
+Needs the aptrack requirements installed (dill, scikit-learn, numpy).
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import statistics
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+APTRACK_DIR = os.path.join(ROOT, "CloudFunctions", "aptrack")
+DEFAULT_MODEL = os.path.join(ROOT, "models", "CRFO.pkl")
+
+
+def summarize(name, seconds):
+    seconds = sorted(seconds)
+    print(f"{name:15} median {statistics.median(seconds) * 1000:9.3f} ms  "
+          f"p95 {seconds[max(int(len(seconds) * 0.95) - 1, 0)] * 1000:9.3f} ms  (n={len(seconds)})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark cold and warm classifier loading.")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--invocations", type=int, default=50)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(APTRACK_DIR))
+    from dill import load
+    from model_loader import LocalModelSource, ModelLoader
+
+    workdir = tempfile.mkdtemp(prefix="model-bench-")
+    try:
+        per_invocation = []
+        for _ in range(args.invocations):
+            start = time.perf_counter()
+            shutil.copyfile(args.model, os.path.join(workdir, "CRFObject.pkl"))
+            with open(os.path.join(workdir, "CRFObject.pkl"), "rb") as f:
+                load(f)
+            per_invocation.append(time.perf_counter() - start)
+
+        cold = []
+        for i in range(min(args.invocations, 10)):
+            loader = ModelLoader(LocalModelSource(args.model), deserialize=load,
+                                 cache_dir=os.path.join(workdir, f"cold-{i}"))
+            start = time.perf_counter()
+            loader.get()
+            cold.append(time.perf_counter() - start)
+
+        warm = []
+        for _ in range(args.invocations):
+            start = time.perf_counter()
+            loader.get()
+            warm.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(workdir)
+
+    summarize("per-invocation", per_invocation)
+    summarize("cold", cold)
+    summarize("warm", warm)
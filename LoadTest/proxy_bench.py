@@ -0,0 +1,150 @@
+"""
+Benchmark the WebApp -> processquery proxy hop over TLS.
+
+Starts a local HTTPS backend (self-signed certificate) that answers after a
+fixed delay and compares, as requests/s one WebApp instance can proxy:
+  before     one sync gunicorn worker, a new requests.post connection (TCP
+             and TLS handshake) per chat message
+  reuse      the pooled session at the same concurrency, isolating the
+             handshake saving
+  after      the gthread worker: PROCESSQUERY_MAX_IN_FLIGHT calls in flight
+             over the pooled session
+
+    python LoadTest/proxy_bench.py
+    python LoadTest/proxy_bench.py --delay-ms 1500 --requests 2000
+
+The handshakes here run over loopback, so against Cloud Run each new
+connection also costs one or two network round trips on top of what is
+measured. The backend sets TCP_NODELAY like production servers do: without
+it, a keep-alive response written as headers then body waits out the
+client's delayed ACK (~40 ms on Linux), which fresh connections escape, and
+reuse looks slower than it is.
+
+For end-to-end numbers, run loadtest.py with --target webapp against the
+app under each gunicorn configuration. Needs requests and cryptography.
+"""
+import os
+import ssl
+import time
+import argparse
+import datetime
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# WebApp's default PROCESSQUERY_MAX_IN_FLIGHT
+WEBAPP_MAX_IN_FLIGHT = 48
+
+
+def make_certificate(directory):
+    """
+    Write a self-signed certificate for 127.0.0.1.
+
+    Returns:
+        tuple[str, str]: Certificate and key file paths.
+    """
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+def start_backend(port, delay_ms, cert_path, key_path):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(delay_ms / 1000)
+            body = b'{"response": "ok"}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        # The default backlog of 5 resets connections when many open at once
+        request_queue_size = 1024
+
+    server = Server(("127.0.0.1", port), Handler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    # Handshakes run in the handler threads, not in the accept loop
+    server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(name, post, url, concurrency, total, cert_path):
+    latencies = []
+    lock = threading.Lock()
+
+    def one(_):
+        start = time.perf_counter()
+        post(url, json={"content": "What is a page fault?"}, timeout=(3, 30), verify=cert_path).json()
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"{name:7} x{concurrency:<3d} {total / elapsed:8.1f} req/s per instance  "
+          f"p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms  p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pooled vs unpooled proxy calls over TLS.")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per configuration")
+    parser.add_argument("--delay-ms", type=float, default=50, help="Backend response time")
+    parser.add_argument("--max-in-flight", type=int, default=WEBAPP_MAX_IN_FLIGHT, help="PROCESSQUERY_MAX_IN_FLIGHT")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cert_path, key_path = make_certificate(directory)
+        server = start_backend(args.port, args.delay_ms, cert_path, key_path)
+        url = f"https://127.0.0.1:{args.port}/"
+
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=args.max_in_flight))
+
+        run("before", requests.post, url, 1, args.requests, cert_path)
+        run("reuse", session.post, url, 1, args.requests, cert_path)
+        run("after", session.post, url, args.max_in_flight, args.requests, cert_path)
+        server.shutdown()
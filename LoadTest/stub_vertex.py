@@ -0,0 +1,205 @@
+"""
+Run the processquery function locally with Vertex AI replaced by stubs.
+
+Text embedding, Matching Engine and Gemini calls are answered locally after
+a sleep drawn from a log-normal latency distribution with occasional spikes,
+so the real request path of processquery (batching, metrics, retrieval
+modes) can be load tested without touching GCP.
+
+Usage:
+    python LoadTest/stub_vertex.py --port 8081
+"""
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import hashlib
+from types import SimpleNamespace
+
+from flask import Flask, request
+
+PROCESSQUERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CloudFunctions", "processquery")
+
+EMBEDDING_DIMENSIONS = 768
+
+
+class Latency:
+    """
+    Log-normal latency with a median, a spread and a probability of a long spike.
+    """
+
+    def __init__(self, median_ms, sigma = 0.4, spike_prob = 0.0, spike_ms = 0):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.spike_prob = spike_prob
+        self.spike_ms = spike_ms
+
+    @classmethod
+    def from_env(cls, name, median_ms, sigma = 0.4, spike_prob = 0.01, spike_ms = 1000):
+        """
+        Read STUB_<NAME>_MEDIAN_MS, _SIGMA, _SPIKE_PROB and _SPIKE_MS, falling back to the given defaults.
+        """
+        prefix = f"STUB_{name.upper()}_"
+        return cls(
+            float(os.getenv(prefix + "MEDIAN_MS", median_ms)),
+            float(os.getenv(prefix + "SIGMA", sigma)),
+            float(os.getenv(prefix + "SPIKE_PROB", spike_prob)),
+            float(os.getenv(prefix + "SPIKE_MS", spike_ms))
+        )
+
+    def sleep(self, timeout = None):
+        """
+        Sleep for one sampled latency, or until timeout if that comes first.
+
+        Raises:
+            TimeoutError: If the latency was longer than timeout.
+        """
+        delay_ms = random.lognormvariate(math.log(self.median_ms), self.sigma)
+        if random.random() < self.spike_prob:
+            delay_ms += self.spike_ms
+        if timeout is not None and delay_ms / 1000 > timeout:
+            time.sleep(timeout)
+            raise TimeoutError(f"stub call exceeded its {timeout:.2f}s deadline")
+        time.sleep(delay_ms / 1000)
+
+
+EMBEDDING_LATENCY = Latency.from_env("embedding", 60)
+FIND_NEIGHBORS_LATENCY = Latency.from_env("find_neighbors", 40)
+READ_DATAPOINTS_LATENCY = Latency.from_env("read_datapoints", 30)
+GENERATION_LATENCY = Latency.from_env("generation", 1200, sigma=0.5, spike_ms=5000)
+
+
+def fake_vector(text):
+    seed = int(hashlib.md5(text.encode()).hexdigest(), 16)
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+
+
+def fake_neighbors(num_neighbors, with_restricts):
+    from google.cloud.aiplatform.matching_engine.matching_engine_index_endpoint import MatchNeighbor, Namespace
+
+    neighbors = []
+    for i in range(num_neighbors):
+        restricts = [Namespace("page_title", [f"Page {i}"], [])] if with_restricts else None
+        neighbors.append(MatchNeighbor(id=f"stub-{i}", distance=1.0 - i * 0.05, restricts=restricts))
+    return neighbors
+
+
+class StubEmbeddingModel:
+    @classmethod
+    def from_pretrained(cls, name):
+        return cls()
+
+    def get_embeddings(self, inputs):
+        EMBEDDING_LATENCY.sleep()
+        return [SimpleNamespace(values=fake_vector(item.text)) for item in inputs]
+
+
+class StubIndexEndpoint:
+    def __init__(self, index_endpoint_name):
+        self.resource_name = index_endpoint_name
+        self.public_endpoint_domain_name = "stub.vdb.vertexai.goog"
+
+    def find_neighbors(self, deployed_index_id, queries, num_neighbors, filter = None, numeric_filter = None, return_full_datapoint = False):
+        FIND_NEIGHBORS_LATENCY.sleep()
+        return [fake_neighbors(num_neighbors, return_full_datapoint) for _ in queries]
+
+    def read_index_datapoints(self, deployed_index_id, ids):
+        READ_DATAPOINTS_LATENCY.sleep()
+        return [
+            SimpleNamespace(
+                datapoint_id=datapoint_id,
+                restricts=[SimpleNamespace(namespace="content", allow_list=[f"Stub note content for {datapoint_id}. " * 20])]
+            )
+            for datapoint_id in ids
+        ]
+
+
+class StubMatchServiceClient:
+    def __init__(self, client_options = None):
+        pass
+
+    def find_neighbors(self, request):
+        FIND_NEIGHBORS_LATENCY.sleep()
+        nearest_neighbors = []
+        for query in request.queries:
+            neighbors = [
+                SimpleNamespace(
+                    distance=neighbor.distance,
+                    datapoint=SimpleNamespace(
+                        datapoint_id=neighbor.id,
+                        restricts=[
+                            SimpleNamespace(namespace=ns.name, allow_list=ns.allow_tokens, deny_list=ns.deny_tokens)
+                            for ns in neighbor.restricts or []
+                        ]
+                    )
+                )
+                for neighbor in fake_neighbors(query.neighbor_count, request.return_full_datapoint)
+            ]
+            nearest_neighbors.append(SimpleNamespace(neighbors=neighbors))
+        return SimpleNamespace(nearest_neighbors=nearest_neighbors)
+
+
+class StubPredictionClient:
+    """
+    Stands in for GenerativeModel's prediction client, so processquery's
+    generate_content still prepares and parses requests through the SDK.
+    """
+
+    def generate_content(self, request, timeout = None):
+        from google.cloud.aiplatform_v1.types import Candidate, Content, GenerateContentResponse, Part
+
+        GENERATION_LATENCY.sleep(timeout)
+        prompt = "".join(part.text for content in request.contents for part in content.parts)
+        text = "Stub answer based on your notes."
+        return GenerateContentResponse(
+            candidates=[Candidate(content=Content(role="model", parts=[Part(text=text)]),
+                                  finish_reason=Candidate.FinishReason.STOP)],
+            usage_metadata=GenerateContentResponse.UsageMetadata(
+                prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4)
+        )
+
+
+def load_processquery():
+    """
+    Import processquery's main module and swap its Vertex AI clients for stubs.
+
+    Returns:
+        module: The patched processquery module.
+    """
+    sys.path.insert(0, os.path.abspath(PROCESSQUERY_DIR))
+    # main builds its GenerativeModel at import, which needs a project; with
+    # one set it needs no credentials until the prediction client is created
+    import vertexai
+    vertexai.init(project=os.getenv("GOOGLE_CLOUD_PROJECT", "stub-project"), location="us-central1")
+    import main
+
+    main.vertexai = SimpleNamespace(init=lambda **kwargs: None)
+    main.aiplatform = SimpleNamespace(init=lambda **kwargs: None, MatchingEngineIndexEndpoint=StubIndexEndpoint)
+    main.TextEmbeddingModel = StubEmbeddingModel
+    main.MatchServiceClient = StubMatchServiceClient
+    # The client is a cached property; setting it on the instance keeps the real one from being built
+    main.model._prediction_client = StubPredictionClient()
+    return main
+
+
+def create_app():
+    processquery = load_processquery()
+    app = Flask(__name__)
+
+    @app.route("/", methods=["POST"])
+    @app.route("/metrics", methods=["GET"])
+    def entry_point():
+        return processquery.process_and_query_embeddings(request)
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve processquery with stubbed Vertex AI services.")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    create_app().run(host="127.0.0.1", port=args.port, threaded=True)
@@ -1,20 +1,27 @@
 import os
+import time
+import uuid
+import threading
 import logging
 import requests
 from flask import Flask, render_template, redirect, url_for, request, session
 from google_auth_oauthlib.flow import Flow
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
-from google.auth.transport.requests import Request
+from oauth_credentials import CredentialStore, credentials_from_user_data
 from googleapiclient.errors import HttpError
 import firebase_admin
 from firebase_admin import credentials, firestore
 from google.cloud.firestore_v1.transforms import DELETE_FIELD
 import requests
 from flask import jsonify
+from requests.adapters import HTTPAdapter
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)
+# A fixed key keeps sessions valid across restarts and instances; the random
+# fallback only works while a single process serves every request
+app.secret_key = os.getenv('FLASK_SECRET_KEY') or os.urandom(24)
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
 
@@ -33,6 +40,86 @@ SCOPES = ['https://www.googleapis.com/auth/userinfo.email',
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+REQUEST_ID_HEADER = 'X-Request-ID'
+CHATBOT_STAGE_SECONDS = Histogram(
+    'webapp_chatbot_stage_seconds',
+    'Time spent in each stage of the /chatbot route.',
+    ['stage'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+
+# Proxy to processquery: one pooled keep-alive session, bounded waits and a cap on in-flight calls
+PROCESSQUERY_URL = "https://processquery-v2-889977581797.us-central1.run.app"
+PROCESSQUERY_CONNECT_TIMEOUT_S = float(os.getenv('PROCESSQUERY_CONNECT_TIMEOUT_S', '3'))
+PROCESSQUERY_READ_TIMEOUT_S = float(os.getenv('PROCESSQUERY_READ_TIMEOUT_S', '30'))
+# Below the 64 gunicorn threads (app.yaml), so chats queue here and the other routes keep threads to run on
+PROCESSQUERY_MAX_IN_FLIGHT = int(os.getenv('PROCESSQUERY_MAX_IN_FLIGHT', '48'))
+PROCESSQUERY_QUEUE_TIMEOUT_S = float(os.getenv('PROCESSQUERY_QUEUE_TIMEOUT_S', '5'))
+
+processquery_session = requests.Session()
+processquery_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=PROCESSQUERY_MAX_IN_FLIGHT))
+processquery_slots = threading.BoundedSemaphore(PROCESSQUERY_MAX_IN_FLIGHT)
+
+
+def call_processquery(payload, request_id):
+    """
+    POST a chat message to processquery over the shared session.
+
+    Returns:
+        tuple: JSON body and HTTP status to send back to the browser.
+    """
+    if not processquery_slots.acquire(timeout=PROCESSQUERY_QUEUE_TIMEOUT_S):
+        return {"response": "The assistant is busy right now. Please try again.", "error": "overloaded"}, 503
+    try:
+        response = processquery_session.post(PROCESSQUERY_URL, json=payload, headers={REQUEST_ID_HEADER: request_id},
+                                             timeout=(PROCESSQUERY_CONNECT_TIMEOUT_S, PROCESSQUERY_READ_TIMEOUT_S))
+        # processquery reports typed errors (deadline_exceeded, upstream_error, ...) with a matching status
+        return response.json(), response.status_code
+    except requests.exceptions.Timeout:
+        logger.error(f"processquery timed out for request_id={request_id}")
+        return {"response": "The assistant took too long to answer. Please try again.", "error": "timeout"}, 504
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logger.error(f"processquery call failed for request_id={request_id}: {str(e)}")
+        return {"response": "There was an error generating a response.", "error": "upstream_error"}, 502
+    finally:
+        processquery_slots.release()
+
+# Read-through cache of users/{email} documents, invalidated by every write path
+# below. It is per process, which is one reason app.yaml runs a single worker.
+USER_CACHE_TTL_S = float(os.getenv('USER_CACHE_TTL_S', '60'))
+USER_CACHE_LOOKUPS = Counter('webapp_user_cache_lookups', 'User profile cache lookups.', ['result'])
+user_cache = {}
+user_cache_lock = threading.Lock()
+
+
+def get_user_data(user_email):
+    """
+    Return the Firestore users/{email} document as a dict (None if missing),
+    served from memory for up to USER_CACHE_TTL_S seconds.
+    """
+    now = time.monotonic()
+    with user_cache_lock:
+        entry = user_cache.get(user_email)
+    if entry and entry[0] > now:
+        USER_CACHE_LOOKUPS.labels('hit').inc()
+        return entry[1]
+
+    USER_CACHE_LOOKUPS.labels('miss').inc()
+    user_doc = db.collection('users').document(user_email).get()
+    user_data = user_doc.to_dict() if user_doc.exists else None
+    with user_cache_lock:
+        user_cache[user_email] = (now + USER_CACHE_TTL_S, user_data)
+    return user_data
+
+
+def invalidate_user_data(user_email):
+    with user_cache_lock:
+        user_cache.pop(user_email, None)
+
+
+# Live Gmail access tokens, refreshed at most once at a time per user
+credential_store = CredentialStore(db, on_write=invalidate_user_data)
+
 
 def save_credentials(credentials):
     user_info = build('oauth2', 'v2', credentials=credentials).userinfo().get().execute()
@@ -43,59 +130,41 @@ def save_credentials(credentials):
         'token_uri': credentials.token_uri,
         'client_id': credentials.client_id,
         'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
+        'scopes': credentials.scopes,
+        'expiry': credentials.expiry.isoformat() if credentials.expiry else None
     }
     print(user_data)
 
-    # Check if the collection exists, if not, create it
+    # merge=True creates the document if it does not exist yet
     users_collection = db.collection('users')
-    if not users_collection.document(user_email).get().exists:
-        users_collection.document(user_email).set({})
-
-    # Now update the document
     users_collection.document(user_email).set(user_data, merge=True)
+    invalidate_user_data(user_email)
+    credential_store.forget(user_email)
 
     # Set up Gmail watch
     watch_response = setup_gmail_watch(credentials, user_email)
     if watch_response:
         users_collection.document(user_email).set({'watch_expiration': watch_response['expiration']}, merge=True)
+        invalidate_user_data(user_email)
 
     return user_email
 def get_credentials(user_email):
-    user_doc = db.collection('users').document(user_email).get()
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
-        credentials = Credentials(
-            token=user_data['token'],
-            refresh_token=user_data['refresh_token'],
-            token_uri=user_data['token_uri'],
-            client_id=user_data['client_id'],
-            client_secret=user_data['client_secret'],
-            scopes=user_data['scopes']
-        )
-        return refresh_token_if_expired(credentials)
+    user_data = get_user_data(user_email)
+    if user_data:
+        try:
+            return credential_store.get(user_email, user_data)
+        except Exception as e:
+            logger.error(f"Error refreshing token: {str(e)}")
+            return credentials_from_user_data(user_data)
     return None
 def get_notion_creds(user_email):
-    user_doc = db.collection('users').document(user_email).get()
-    if user_doc.exists:
-        user_data = user_doc.to_dict()
+    user_data = get_user_data(user_email)
+    if user_data:
         if user_data.get('notion_token') and (user_data.get('notion_job_application_page') or user_data.get('notion_notes_page')):
             return True
         else:
             return False
 
-def refresh_token_if_expired(credentials):
-    if credentials and credentials.expired and credentials.refresh_token:
-        try:
-            credentials.refresh(Request())
-            db.collection('users').document(credentials.id_token['email']).update({
-                'token': credentials.token,
-                'refresh_token': credentials.refresh_token
-            })
-        except Exception as e:
-            logger.error(f"Error refreshing token: {str(e)}")
-    return credentials
-
 def setup_gmail_watch(credentials, user_email):
     gmail_service = build('gmail', 'v1', credentials=credentials)
     request = {
@@ -106,9 +175,11 @@ def setup_gmail_watch(credentials, user_email):
         response = gmail_service.users().watch(userId=user_email, body=request).execute()
         expiration = response.get('expiration')
         if expiration:
+            # Stored as a number so the renewWatch scheduler can range-query it
             db.collection('users').document(user_email).update({
-                'gmail_watch_expiration': expiration
+                'gmail_watch_expiration': int(expiration)
             })
+            invalidate_user_data(user_email)
         return response
     except HttpError as error:
         logger.error(f"Error setting up Gmail watch: {str(error)}")
@@ -142,17 +213,30 @@ def chatbot():
     user_email = session.get('user_email')
     if not user_email:
         return jsonify({"response": "Please log in to use the chatbot.", "error": "unauthorized"}), 401
-    if not get_notion_creds(user_email): #Function returns status of notion authorization
+    start = time.perf_counter()
+    notion_authorized = get_notion_creds(user_email)
+    CHATBOT_STAGE_SECONDS.labels('notion_check').observe(time.perf_counter() - start)
+    if not notion_authorized: #Function returns status of notion authorization
         return jsonify({"response": "Please Authorize Notion by going to the settings.", "error": "unauthorized"}), 401
 
     message = request.json['message']
 
-    # Call the Cloud Function
-    function_url = "https://processquery-v2-889977581797.us-central1.run.app"
+    # Same ID is logged by processquery so one slow request can be traced across both services
+    request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+    start = time.perf_counter()
+    # Conversation memory lives in processquery, keyed by this per-session ID
+    conversation_id = session.setdefault('conversation_id', uuid.uuid4().hex)
+    body, status = call_processquery({"content": message, "user_email" : user_email, "conversation_id": conversation_id,
+                                      "filters": request.json.get('filters')}, request_id)
+    elapsed = time.perf_counter() - start
+    CHATBOT_STAGE_SECONDS.labels('processquery_proxy').observe(elapsed)
+    logger.info(f"chatbot request_id={request_id} processquery_proxy_ms={elapsed * 1000:.1f}")
 
-    response = requests.post(function_url, json={"content": message, "user_email" : user_email})
+    return jsonify(body), status, {REQUEST_ID_HEADER: request_id}
 
-    return jsonify(response.json())
+@app.route('/metrics')
+def metrics():
+    return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
 
 @app.route('/settings')
 def settings():
@@ -196,6 +280,7 @@ def authorize_notion():
         user_ref.update({'notion_token': notion_token})
         user_ref.update({'notion_job_application_page': notion_job_application_page})
         user_ref.update({'notion_notes_page': notion_notes_page})
+        invalidate_user_data(user_email)
         session['notion_authorized'] = True
         return redirect(url_for('settings'))
     return render_template('settings.html')
@@ -222,6 +307,8 @@ def revoke_gmail():
 
         # Delete the user's data from your database
         db.collection('users').document(user_email).delete()
+        invalidate_user_data(user_email)
+        credential_store.forget(user_email)
 
     return redirect(url_for('settings'))
 
@@ -230,6 +317,7 @@ def revoke_notion():
     user_email = session.get('user_email')
     user_ref = db.collection('users').document(user_email)
     user_ref.update({"notion_token" : DELETE_FIELD, "notion_notes_page" : DELETE_FIELD, "notion_job_application_page" : DELETE_FIELD})
+    invalidate_user_data(user_email)
     session['notion_authorized'] = False
     return redirect(url_for('settings'))
 